@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Micro-benchmarks of the hot paths in ``encode_utils.profiles`` and of the payload generation in
+``eu_register.py``. They run offline against a synthetic profiles document, shaped like the one
+served by the Portal, and against generated input files of the requested numbers of rows.
+
+Each benchmark is run once to measure its throughput, and once more under ``tracemalloc`` to
+measure its peak memory (unless ``--no-memory`` is given). The results are written as a JSON
+document, with one entry per benchmark, so that runs can be compared over time::
+
+  python benchmarks/bench_profiles.py --rows 10000,100000,1000000 --output bench.json
+
+|
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import encode_utils.profiles as eup
+import encode_utils.MetaDataRegistration.eu_register as eur
+
+#: The number of synthetic profiles, besides the ones below that the benchmarks use. The Portal
+#: serves about this many.
+NUM_FILLER_PROFILES = 150
+#: The number of properties of each synthetic filler profile.
+NUM_FILLER_PROPS = 40
+
+
+def _prop(prop_type, **kwargs):
+    schema = {"type": prop_type}
+    schema.update(kwargs)
+    return schema
+
+
+def _schema(profile_id, props, required):
+    all_props = {
+        "schema_version": _prop("string", default="1", requestMethod=[]),
+        "uuid": _prop("string", readonly=True, format="uuid"),
+        "accession": _prop("string", readonly=True),
+        "status": _prop("string", enum=["in progress", "released", "deleted"]),
+        "aliases": _prop("array", items=_prop("string"), uniqueItems=True),
+        "award": _prop("string", linkTo="Award"),
+        "lab": _prop("string", linkTo="Lab"),
+        "submitted_by": _prop("string", linkTo="User", notSubmittable=True),
+        "date_created": _prop("string", notSubmittable=True),
+    }
+    all_props.update(props)
+    return {"id": "/profiles/{}.json".format(profile_id), "title": profile_id, "type": "object",
+            "required": required, "identifyingProperties": ["uuid", "accession", "aliases"],
+            "properties": all_props}
+
+
+def make_profiles_doc():
+    """
+    Returns:
+        `dict`: A synthetic document in the format of the Portal's profiles endpoint, with the
+        `file` and `biosample` profiles plus ``NUM_FILLER_PROFILES`` others.
+    """
+    doc = {
+        "File": _schema("file", {
+            "submitted_file_name": _prop("string"),
+            "md5sum": _prop("string", pattern="^[a-f0-9]{32}$"),
+            "file_format": _prop("string", enum=["fastq", "bam"]),
+            "read_length": _prop("integer", minimum=0),
+            "dataset": _prop("string", linkTo="Experiment"),
+        }, ["dataset", "file_format", "award", "lab"]),
+        "Biosample": _schema("biosample", {
+            "biosample_term_name": _prop("string"),
+            "description": _prop("string"),
+            "starting_amount": _prop("number"),
+            "passage_number": _prop("integer"),
+            "is_control": _prop("boolean"),
+            "fractions": _prop("array", items=_prop("integer")),
+            "documents": _prop("array", items=_prop("string", linkTo="Document")),
+            "treatment": _prop("object", properties={"name": _prop("string")}),
+        }, ["award", "lab", "biosample_term_name"]),
+        "_subtypes": {},
+        "@type": ["JSONSchemas"],
+    }
+    for i in range(NUM_FILLER_PROFILES):
+        props = {"prop_{}".format(j): _prop("string") for j in range(NUM_FILLER_PROPS)}
+        doc["Filler{}".format(i)] = _schema("filler_{}".format(i), props, ["award", "lab"])
+    return doc
+
+
+def make_tsv(path, num_rows, seed=0):
+    """
+    Writes a `biosample` input file for ``eu_register.py`` with columns of each type.
+
+    Args:
+        path: `str`. The path of the file to write.
+        num_rows: `int`. The number of rows, besides the header line.
+        seed: `int`. The seed of the random values.
+    """
+    rng = random.Random(seed)
+    fields = ["aliases", "biosample_term_name", "description", "starting_amount", "passage_number",
+              "is_control", "fractions", "documents", "treatment", "#comment"]
+    with open(path, "w") as fh:
+        fh.write("\t".join(fields) + "\n")
+        for i in range(num_rows):
+            row = [
+                "lab:bs{0},lab:bs{0}-b".format(i),
+                rng.choice(["K562", "HepG2", "GM12878"]),
+                "Sample number {}".format(i),
+                "{:.2f}".format(rng.random() * 10),
+                str(rng.randint(1, 40)),
+                rng.choice(["true", "false"]),
+                "[{},{}]".format(rng.randint(1, 9), rng.randint(1, 9)),
+                "/documents/{}/".format(rng.randint(1, 1000)),
+                json.dumps({"name": "treatment {}".format(i % 10)}),
+                "ignored",
+            ]
+            fh.write("\t".join(row) + "\n")
+
+
+def _run(func, memory):
+    """
+    Runs `func` and returns its elapsed time in seconds, and, when `memory` is set, its peak
+    memory in bytes as traced by ``tracemalloc`` in a second run.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def benchmark(name, func, ops, memory=True, **params):
+    """
+    Runs a benchmark and prints its result.
+
+    Args:
+        name: `str`. The name of the benchmark.
+        func: A function taking no argument that does `ops` operations.
+        ops: `int`. The number of operations, i.e. rows or calls.
+        memory: `bool`. `True` means to measure the peak memory too.
+        params: Recorded with the result, i.e. the number of rows.
+
+    Returns:
+        `dict`: The result.
+    """
+    elapsed, peak = _run(func, memory)
+    result = {"name": name, "ops": ops, "seconds": round(elapsed, 6),
+              "ops_per_sec": round(ops / elapsed, 1) if elapsed else None,
+              "peak_memory_bytes": peak}
+    result.update(params)
+    print("{:<40} {:>10} ops {:>12.1f} ops/s {:>10} peak KiB".format(
+        name + "".join(" {}={}".format(k, v) for k, v in sorted(params.items())), ops,
+        result["ops_per_sec"] or 0, "-" if peak is None else peak // 1024), file=sys.stderr)
+    return result
+
+
+def run_benchmarks(row_counts, memory=True, calls=100000):
+    """
+    Runs all benchmarks.
+
+    Args:
+        row_counts: `list`. The numbers of rows of the input files given to ``create_payloads()``.
+        memory: `bool`. `True` means to measure the peak memory of each benchmark.
+        calls: `int`. The number of calls made by each of the benchmarks of single functions.
+
+    Returns:
+        `list`: The result of each benchmark, as returned by ``benchmark()``.
+    """
+    results = []
+    raw = json.dumps(make_profiles_doc())
+
+    num_parses = 20
+
+    def parse_profiles():
+        for i in range(num_parses):
+            eup._format_profiles(json.loads(raw))
+    results.append(benchmark("get_profiles_parse", parse_profiles, num_parses, memory,
+                             profile_bytes=len(raw)))
+
+    raw_bytes = raw.encode("utf-8")
+
+    def stream_profiles():
+        # As get_lazy_profiles() does: only two schemas are kept.
+        for i in range(num_parses):
+            chunks = (raw_bytes[j:j + eup.PROFILES_CHUNK_SIZE]
+                      for j in range(0, len(raw_bytes), eup.PROFILES_CHUNK_SIZE))
+            {k: v for k, v in eup.iter_profiles(chunks) if k in ("file", "biosample")}
+    results.append(benchmark("iter_profiles_keep_2", stream_profiles, num_parses, memory,
+                             profile_bytes=len(raw)))
+
+    eup.Profile.set_profiles(eup._format_profiles(json.loads(raw)))
+    profile_ids = sorted(eup.Profile.PROFILES)
+
+    def init_profiles_cold():
+        eup.Profile._instances = {}
+        for profile_id in profile_ids:
+            eup.Profile(profile_id)
+    results.append(benchmark("Profile.__init__ (cold)", init_profiles_cold, len(profile_ids),
+                             memory))
+
+    def init_profiles():
+        for i in range(calls):
+            eup.Profile("biosamples")
+    results.append(benchmark("Profile.__init__ (memoized)", init_profiles, calls, memory))
+
+    profile = eup.Profile("biosample")
+    spellings = ["biosample", "biosamples", "/biosamples/ENCBS123ABC/", "Biosample", "file",
+                 "files", "filler-1s", "filler1"]
+
+    def set_profile_id():
+        for i in range(calls):
+            profile._set_profile_id(spellings[i % len(spellings)])
+    results.append(benchmark("_set_profile_id", set_profile_id, calls, memory))
+
+    record = {"uuid": "x", "accession": "ENCBS000AAA", "schema_version": "1", "status": "released",
+              "aliases": ["lab:a"], "submitted_by": "/users/u/", "date_created": "2018-01-01",
+              "biosample_term_name": "K562", "description": "d", "award": "/awards/A/",
+              "lab": "/labs/L/"}
+
+    def filter_non_writable_props():
+        for i in range(calls):
+            profile.filter_non_writable_props(dict(record))
+    results.append(benchmark("filter_non_writable_props", filter_non_writable_props, calls,
+                             memory))
+
+    value = json.dumps([{"name": "eGFP", "location": "C-terminal"}, {"name": "FLAG"}])
+
+    def check_valid_json():
+        for i in range(calls):
+            eur.check_valid_json("introduced_tags", value, i)
+    results.append(benchmark("check_valid_json", check_valid_json, calls, memory))
+
+    cases = [("12", "integer"), ("1.5", "number"), ("true", "boolean"), ("K562", "string")]
+
+    def typecast():
+        for i in range(calls):
+            eur.typecast(*cases[i % len(cases)])
+    results.append(benchmark("typecast", typecast, calls, memory))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_rows in row_counts:
+            path = os.path.join(tmp_dir, "rows_{}.tsv".format(num_rows))
+            make_tsv(path, num_rows)
+
+            def create_payloads():
+                for payload in eur.create_payloads("biosample", path):
+                    pass
+            results.append(benchmark("create_payloads", create_payloads, num_rows, memory,
+                                     rows=num_rows))
+            os.remove(path)
+    return results
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000,1000000", help="""
+    Comma-delimited numbers of rows of the input files that create_payloads() is benchmarked on
+    (default: %(default)s).""")
+    parser.add_argument("--calls", type=int, default=100000, help="""
+    The number of calls made by the benchmarks of single functions (default: %(default)s).""")
+    parser.add_argument("--no-memory", action="store_true", help="""
+    Don't measure the peak memory, which halves the run time.""")
+    parser.add_argument("-o", "--output", help="""
+    The JSON file to write the results to. Defaults to STDOUT.""")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    row_counts = [int(x) for x in args.rows.split(",") if x]
+    results = run_benchmarks(row_counts, memory=not args.no_memory, calls=args.calls)
+    report = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Reports the start-up time of the package: the time of a cold ``import encode_utils``, and the
+time that ``eu_register.py --help`` takes on top of the start-up of the interpreter itself, along
+with the ``HEAVY_MODULES`` that either imports although they are only needed once there is work
+to do, and the slowest imports::
+
+  python benchmarks/import_time.py --repeat 10
+
+Each measurement is made in fresh interpreters, ``--repeat`` times, and the median is kept. The
+budgets that both must stay under are enforced by ``encode_utils/tests/test_import_time.py``.
+
+|
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#: The root of the repository, which is put on the PYTHONPATH of the measured interpreters.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: The path to the ``eu_register.py`` script.
+EU_REGISTER = os.path.join(REPO_DIR, "encode_utils", "MetaDataRegistration", "eu_register.py")
+
+#: The modules that neither ``import encode_utils`` nor ``eu_register.py --help`` may import.
+HEAVY_MODULES = ("requests", "asyncio", "aiohttp", "botocore", "encode_utils.connection",
+                 "encode_utils.async_connection", "encode_utils.logs", "logging.handlers")
+
+def _run(args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + [x for x in [env.get("PYTHONPATH")] if x])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise Exception("{} failed:\n{}".format(" ".join(args), proc.stderr))
+    return elapsed, proc.stderr
+
+
+def parse_importtime(output):
+    """
+    Args:
+        output: `str`. What ``python -X importtime`` writes to STDERR.
+
+    Returns:
+        `dict`: The cumulative import time in seconds of each imported module.
+    """
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # The header line.
+            continue
+        times[fields[2].strip()] = cumulative / 1e6
+    return times
+
+
+def measure_import(repeat):
+    """
+    Returns:
+        `tuple`: The median time in seconds of a cold ``import encode_utils``, the heavy modules
+        that it imported, and the cumulative import time of each module in the last run.
+    """
+    samples = []
+    heavy = set()
+    for i in range(repeat):
+        elapsed, output = _run(["-c", "import encode_utils"])
+        times = parse_importtime(output)
+        samples.append(times["encode_utils"])
+        heavy.update(x for x in HEAVY_MODULES if x in times)
+    return statistics.median(samples), sorted(heavy), times
+
+
+def measure_help(repeat):
+    """
+    Returns:
+        `tuple`: The median time in seconds of ``eu_register.py --help``, less the median time of
+        an interpreter doing nothing, the heavy modules that it imported, and the cumulative import
+        time of each module in the last run.
+    """
+    baseline = statistics.median(_run(["-c", "pass"])[0] for i in range(repeat))
+    samples = []
+    heavy = set()
+    for i in range(repeat):
+        elapsed, output = _run([EU_REGISTER, "--help"])
+        samples.append(elapsed - baseline)
+        times = parse_importtime(output)
+        heavy.update(x for x in HEAVY_MODULES if x in times)
+    return max(statistics.median(samples), 0.0), sorted(heavy), times
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=5, help="""
+    The number of the slowest modules to report for each measurement, by cumulative import time,
+    leaving out those imported at the start-up of the interpreter (default: %(default)s).""")
+    parser.add_argument("--repeat", type=int, default=5, help="""
+    The number of measurements of each, of which the median is kept (default: %(default)s).""")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    # The modules imported at the start-up of the interpreter, which aren't reported.
+    startup_modules = set(parse_importtime(_run(["-c", "pass"])[1]))
+    results = []
+    for name, measure in [("import encode_utils", measure_import),
+                          ("eu_register.py --help", measure_help)]:
+        seconds, heavy, times = measure(args.repeat)
+        slowest = sorted([x for x in times.items() if x[0] not in startup_modules],
+                         key=lambda x: -x[1])[:args.top]
+        results.append({"name": name, "seconds": round(seconds, 4), "heavy_modules": heavy,
+                        "slowest_imports": [{"module": k, "seconds": round(v, 4)}
+                                            for k, v in slowest]})
+        print("{:<24} {:>8.1f} ms{}".format(
+            name, seconds * 1000,
+            "  (imports {})".format(", ".join(heavy)) if heavy else ""), file=sys.stderr)
+        for module, module_seconds in slowest:
+            print("  {:<40} {:>8.1f} ms".format(module, module_seconds * 1000), file=sys.stderr)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+End-to-end load test of ``eu_register.py`` against a local stand-in Portal
+(``encode_utils.mock_portal``), for tuning the concurrency options without touching the real
+Portals.
+
+For each worker configuration given with ``--workers``, a fresh stand-in Portal is started, and
+``eu_register.py`` is run on the input file in a subprocess with the `local` DCC mode. The
+throughput in records per second, the latency percentiles of the requests and the number of
+responses per status code are reported for each configuration, as a table on STDERR and as a JSON
+document::
+
+  python benchmarks/load_test.py --generate 2000 --workers 1,8,32 --latency 0.05 --throttle-rate 0.01
+
+Arguments after ``--`` are passed on to ``eu_register.py``, i.e. ``-- --async``.
+
+|
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import encode_utils as eu
+import encode_utils.mock_portal as eumock
+
+#: The path to the ``eu_register.py`` script.
+EU_REGISTER = os.path.join(os.path.dirname(os.path.abspath(eu.__file__)), "MetaDataRegistration",
+                           "eu_register.py")
+
+#: The number of lines at the end of the log of ``eu_register.py`` shown when it fails.
+LOG_TAIL_LINES = 20
+
+
+def make_tsv(path, num_rows, seed=0):
+    """
+    Writes a `biosample` input file matching ``encode_utils.mock_portal.get_default_profiles()``.
+
+    Args:
+        path: `str`. The path of the file to write.
+        num_rows: `int`. The number of rows, besides the header line.
+        seed: `int`. The seed of the random values.
+    """
+    rng = random.Random(seed)
+    fields = ["aliases", "biosample_term_name", "description", "starting_amount",
+              "passage_number", "is_control", "fractions"]
+    with open(path, "w") as fh:
+        fh.write("\t".join(fields) + "\n")
+        for i in range(num_rows):
+            fh.write("\t".join([
+                "lab:load-test-{}".format(i),
+                rng.choice(["K562", "HepG2", "GM12878"]),
+                "Load test sample {}".format(i),
+                "{:.2f}".format(rng.random() * 10),
+                str(rng.randint(1, 40)),
+                rng.choice(["true", "false"]),
+                "{},{}".format(rng.randint(1, 9), rng.randint(1, 9)),
+            ]) + "\n")
+
+
+def run_once(infile, profile_id, workers, portal_kwargs, extra_args, work_dir):
+    """
+    Runs ``eu_register.py`` once against a fresh stand-in Portal.
+
+    Args:
+        infile: `str`. The input file.
+        profile_id: `str`. The profile of the rows.
+        workers: `int`. The value of the --workers option.
+        portal_kwargs: `dict`. The arguments of ``encode_utils.mock_portal.MockPortal``.
+        extra_args: `list`. More arguments for ``eu_register.py``.
+        work_dir: `str`. The directory for the journals and logs.
+
+    Returns:
+        `dict`: The result of the run.
+
+    Raises:
+        `RuntimeError`: ``eu_register.py`` exited with a non-zero status. The end of its log is
+        part of the message.
+    """
+    with eumock.MockPortal(**portal_kwargs) as portal:
+        env = dict(os.environ)
+        env.update({
+            "EU_LOCAL_DCC_URL": portal.url,
+            "EU_PROFILES_URL": portal.url + "/profiles/",
+            "EU_PROFILES_CACHE_DIR": "",
+            "EU_PROFILES_SNAPSHOT": "",
+            "DCC_API_KEY": env.get("DCC_API_KEY", "load-test"),
+            "DCC_SECRET_KEY": env.get("DCC_SECRET_KEY", "load-test"),
+            "DCC_LAB": env.get("DCC_LAB", "/labs/load-test/"),
+            "DCC_AWARD": env.get("DCC_AWARD", "/awards/load-test/"),
+            # Run the same encode_utils as this script.
+            "PYTHONPATH": os.pathsep.join(
+                [os.path.dirname(os.path.dirname(os.path.abspath(eu.__file__)))]
+                + [x for x in [env.get("PYTHONPATH")] if x]),
+        })
+        cmd = [sys.executable, EU_REGISTER, "-m", eu.DCC_LOCAL_MODE, "-p", profile_id,
+               "-i", infile, "--workers", str(workers),
+               "--journal-dir", os.path.join(work_dir, "journals")] + extra_args
+        log_path = os.path.join(work_dir, "eu_register.{}.log".format(workers))
+        start = time.time()
+        with open(log_path, "w") as log:
+            returncode = subprocess.call(cmd, env=env, cwd=work_dir, stdout=log,
+                                         stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+        stats = portal.stats()
+    if returncode:
+        with open(log_path) as log:
+            tail = log.readlines()[-LOG_TAIL_LINES:]
+        raise RuntimeError(
+            "eu_register.py exited with status {} with --workers {}; see {}:\n{}".format(
+                returncode, workers, log_path, "".join(tail)))
+    written = stats["records_written"]
+    errors = sum(count for method in stats["methods"].values()
+                 for status, count in method["statuses"].items() if int(status) >= 400)
+    return {
+        "workers": workers,
+        "args": extra_args,
+        "returncode": returncode,
+        "seconds": round(elapsed, 3),
+        "records_written": written,
+        "records_per_sec": round(written / elapsed, 1) if elapsed else None,
+        "error_responses": errors,
+        "methods": stats["methods"],
+        "log": log_path,
+    }
+
+
+def _format_row(result):
+    latencies = [m["latency"] for m in result["methods"].values()]
+    p50 = max([x["p50"] for x in latencies] or [0])
+    p99 = max([x["p99"] for x in latencies] or [0])
+    statuses = {}
+    for method in result["methods"].values():
+        for status, count in method["statuses"].items():
+            statuses[status] = statuses.get(status, 0) + count
+    return "{:>7} {:>8.2f} {:>10} {:>10.1f} {:>9.1f} {:>9.1f} {:>5}  {}".format(
+        result["workers"], result["seconds"], result["records_written"],
+        result["records_per_sec"] or 0, p50 * 1000, p99 * 1000, result["returncode"],
+        " ".join("{}:{}".format(k, v) for k, v in sorted(statuses.items())))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-i", "--infile", help="""
+    The input file of eu_register.py. Its rows must fit the profiles served by the stand-in
+    Portal (see --profiles).""")
+    group.add_argument("--generate", type=int, metavar="ROWS", help="""
+    Generate an input file of this many biosample rows instead.""")
+    parser.add_argument("-p", "--profile-id", default="biosample", help="""
+    The profile of the rows of the input file (default: %(default)s).""")
+    parser.add_argument("--workers", default="1,4,16", help="""
+    Comma-delimited values of the --workers option of eu_register.py to run with, one run each
+    (default: %(default)s).""")
+    parser.add_argument("--profiles", help="""
+    A JSON file holding the profiles document that the stand-in Portal serves. Defaults to
+    encode_utils.mock_portal.get_default_profiles().""")
+    parser.add_argument("--latency", type=float, default=0.02, help="""
+    The minimum number of seconds each request takes (default: %(default)s).""")
+    parser.add_argument("--jitter", type=float, default=0.0, help="""
+    The maximum number of seconds added at random to --latency (default: %(default)s).""")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="""
+    The fraction of requests answered with a 500 error (default: %(default)s).""")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="""
+    The fraction of requests answered with a 429 error (default: %(default)s).""")
+    parser.add_argument("--retry-after", type=int, default=1, help="""
+    The value of the Retry-After header of the 429 responses (default: %(default)s).""")
+    parser.add_argument("--capacity", type=int, help="""
+    The maximum number of requests that the stand-in Portal handles at once. Default: no limit.""")
+    parser.add_argument("--seed", type=int, default=0, help="""
+    The seed of the random errors and jitter (default: %(default)s).""")
+    parser.add_argument("-o", "--output", help="""
+    The JSON file to write the results to. Defaults to STDOUT.""")
+    parser.add_argument("eu_register_args", nargs="*", help="""
+    Arguments passed on to eu_register.py, after '--'.""")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    profiles = None
+    if args.profiles:
+        with open(args.profiles) as fh:
+            profiles = json.load(fh)
+    portal_kwargs = {
+        "profiles": profiles, "latency": args.latency, "jitter": args.jitter,
+        "error_rate": args.error_rate, "throttle_rate": args.throttle_rate,
+        "retry_after": args.retry_after, "capacity": args.capacity, "seed": args.seed}
+    work_dir = tempfile.mkdtemp(prefix="eu_load_test.")
+    infile = args.infile
+    if args.generate:
+        infile = os.path.join(work_dir, "rows.tsv")
+        make_tsv(infile, args.generate)
+    infile = os.path.abspath(infile)
+
+    print("{:>7} {:>8} {:>10} {:>10} {:>9} {:>9} {:>5}  {}".format(
+        "workers", "seconds", "records", "records/s", "p50 ms", "p99 ms", "exit", "statuses"),
+        file=sys.stderr)
+    results = []
+    for workers in [int(x) for x in args.workers.split(",") if x]:
+        try:
+            result = run_once(infile, args.profile_id, workers, portal_kwargs,
+                              args.eu_register_args, work_dir)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print(_format_row(result), file=sys.stderr)
+        results.append(result)
+    report = {
+        "infile": infile,
+        "profile_id": args.profile_id,
+        "portal": {k: v for k, v in portal_kwargs.items() if k != "profiles"},
+        "runs": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
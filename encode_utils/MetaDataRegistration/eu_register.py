@@ -33,22 +33,33 @@ and the `attachment` object will be constructed for you.
 """
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import json
+import logging
 import os
 import re
 import sys
-import requests
 
+import encode_utils as eu
 import encode_utils.utils as euu
-import encode_utils.connection as euc
+import encode_utils.journal as eujournal
+import encode_utils.metrics as eumetrics
 from encode_utils.parent_argparser import dcc_login_parser
 import encode_utils.profiles as eup
+import encode_utils.readers as eureaders
 
 # Check that Python3 is being used
 v = sys.version_info
 if v < (3, 3):
     raise Exception("Requires Python 3.3 or greater.")
 
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+#: An error ``logging`` instance.
+ERROR_LOGGER = logging.getLogger(eu.ERROR_LOGGER_NAME + "." + __name__)
+
 #: RECORD_ID_FIELD is a special field that won't be skipped in the create_payload() function.
 #: It is used when patching objects to indicate the identifier of the record to patch.
 RECORD_ID_FIELD = "record_id"
@@ -108,7 +119,20 @@ def get_parser():
 
     Some profiles (most) require specification of the 'award' and 'lab' attributes. These may be set
     as fields in the input file, or can be left out, in which case the default values for these
-    attributes will be pulled from the environment variables DCC_AWARD and DCC_LAB, respectively.""")
+    attributes will be pulled from the environment variables DCC_AWARD and DCC_LAB, respectively.
+
+    The input file may also be in the JSON Lines format, with one JSON object per line whose keys
+    are the field names, or in the Parquet format; see --input-format. Text files may be gzip or
+    zstd compressed, and are decompressed on the fly. Use '-' to read the input from STDIN.""")
+
+    parser.add_argument("--input-format", choices=sorted(eureaders.READERS), help="""
+    The format of the input file. By default, it's detected from the content of the file: Parquet
+    files are recognized by their magic number, JSON Lines files by a first line starting with a
+    '{', and anything else is read as tab-delimited. In JSON Lines and Parquet files, the values
+    that aren't strings are submitted as they are, rather than parsed as in a tab-delimited file.
+    Parquet files are read in record batches, so that memory use doesn't grow with the size of the
+    file. Reading zstd compressed files requires the zstandard package, and reading Parquet files
+    the pyarrow package.""")
 
     parser.add_argument("--patch", action="store_true", help="""
     Presence of this option indicates to PATCH an existing DCC record rather than register a new one.""")
@@ -119,39 +143,1115 @@ def get_parser():
     to patch. The default action is to extend the array value with the patch value and then to remove
     any duplicates.""")
 
+    parser.add_argument("--workers", type=int, default=1, help="""
+    The largest number of records to submit concurrently (default: 1). When greater than 1, the
+    records are submitted through a pool of threads sharing the same connection, the outcome of
+    each line is reported in input order, and a failing record doesn't stop the run; instead, a
+    summary of the failed lines is given at the end and the exit status is non-zero. The number of
+    submissions in flight starts low and adapts to the load of the Portal within this limit: it
+    grows while the Portal keeps up, and is halved when the Portal answers with 429 or 5xx
+    statuses or slows down (see --latency-target). Submissions rejected with 429 are retried after
+    a backoff, or after the delay given by the Retry-After header. Don't use this if some rows
+    reference the aliases of rows that come earlier in the input file.""")
+
+    parser.add_argument("--rate-limit", type=float, help="""
+    The largest number of requests per second sent to the Portal. Defaults to the environment
+    variable EU_RATE_LIMIT, or else no limit.""")
+
+    parser.add_argument("--latency-target", type=float, help="""
+    The latency in seconds above which the Portal is taken to be overloaded, so that fewer
+    submissions are kept in flight. By default, this is a few times the lowest latency seen in the
+    run.""")
+
+    parser.add_argument("--validate-only", action="store_true", help="""
+    Only check the input file against the profile, without submitting anything. The checks cover
+    required properties, the types, enums and patterns of the values, and non-writable properties.
+    Each error is written to STDOUT as a tab-delimited line giving the line number, the field name
+    and the error message. The exit status is 1 if any error was found.""")
+
+    parser.add_argument("--no-validate", action="store_true", help="""
+    By default, the input file is checked as with --validate-only before anything is submitted, and
+    nothing is submitted if any error is found. This option turns that check off.""")
+
+    parser.add_argument("--waves", action="store_true", help="""
+    Only has meaning in combination with --workers or --async. Use this when some rows reference
+    other rows of the input file by alias, i.e. a replicate pointing to a library that is
+    registered in an earlier row. The rows are then submitted in waves, where a row is only
+    submitted once all the rows that it references have been submitted in a prior wave; the rows of
+    a given wave are submitted concurrently. Rows that reference a row that failed are not submitted.
+    Note that this reads the entire input file into memory.""")
+
+    parser.add_argument("--resume", action="store_true", help="""
+    Resume an interrupted run by skipping the rows that were already submitted successfully. The
+    outcome of each row is recorded in a journal (unless --dry-run is set), which is keyed on the
+    content of the input file, the profile and whether --patch is set. Without this option, the
+    journal of a prior run on the same input file is overwritten.""")
+
+    parser.add_argument("--journal-dir", default=eujournal.JOURNAL_DIR, help="""
+    The directory in which the journals are stored (default: {}).""".format(eujournal.JOURNAL_DIR))
+
+    parser.add_argument("--preflight", action="store_true", help="""
+    Before submitting anything, look up the records that the rows refer to with a few batched
+    searches on the Portal, rather than one request per row. When POSTING, these are the records
+    having any of the aliases of a row; such rows already exist and are reported as succeeded
+    without being POSTED. When PATCHING, these are the records given in the '{}' field;
+    rows whose record doesn't exist are reported as failed without being PATCHED.""".format(
+        RECORD_ID_FIELD))
+
+    parser.add_argument("--skip-unchanged", action="store_true", help="""
+    Only has meaning in combination with the --patch option. Fetch the records to PATCH in bulk, as
+    with --preflight, and compare each row with its record, so that only the properties whose
+    values differ are PATCHED, and rows that wouldn't change their record aren't PATCHED at all.
+    Array values are extended and deduplicated locally (unless --overwrite-array-values is set),
+    rather than by fetching each record again before its PATCH. The number of rows skipped is
+    reported at the end. This makes re-runs on large input files mostly free of writes.""")
+
+    parser.add_argument("--md5-processes", type=int, default=min(4, os.cpu_count() or 1), help="""
+    Only has meaning when POSTING file records. The number of processes that calculate the md5sums
+    of the files whose rows lack the 'md5sum' field (default: %(default)s). The md5sums are
+    calculated a few rows ahead of the submission, so that hashing and submitting overlap, and are
+    cached (see encode_utils.MD5_CACHE_PATH) so that unchanged files are never hashed twice.
+    Set to 0 to have the md5sums calculated during the POST instead. With --async, the md5sums are
+    always calculated during the POST, off the event loop.""")
+
+    parser.add_argument("--async", dest="use_async", action="store_true", help="""
+    Submit the records from a single asyncio event loop rather than from threads, with up to
+    --workers requests in flight at once. Requires the aiohttp package. The outcome of each line is
+    reported as with --workers.""")
+
+    parser.add_argument("--upload-workers", type=int, default=2, help="""
+    Only has meaning with --async when POSTING file records. The number of files uploaded to AWS S3
+    at once (default: %(default)s). The uploads run in background threads, so that the metadata of
+    the next rows is POSTED while the files of the prior rows are uploading. Rows whose upload
+    fails are reported as failed at the end of the run, and --resume uploads them again. Set to 0
+    to upload each file with the AWS CLI right after its POST instead.""")
+
+    parser.add_argument("--upload-part-size", type=int, default=64, help="""
+    Only has meaning with --upload-workers. Files larger than this many MB are uploaded in parts of
+    this size (default: %(default)s). Each part is retried on failure, and an interrupted upload of
+    the same file resumes from the parts already uploaded.""")
+
+    parser.add_argument("--upload-part-workers", type=int, default=4, help="""
+    Only has meaning with --upload-workers. The number of parts of a file uploaded at once
+    (default: %(default)s).""")
+
+    parser.add_argument("--metrics-file", help="""
+    A file to write the metrics of the run to every --metrics-interval seconds: the latency
+    histograms and error counts of the requests, uploads and md5sum calculations, the number of
+    rows submitted, the rows per second and the ETA. Files ending in '.prom' are written in the
+    Prometheus text format (i.e. for the textfile collector of the node exporter), others as JSON.
+    See also --metrics-format.""")
+
+    parser.add_argument("--metrics-format", choices=["prometheus", "json"], help="""
+    The format of --metrics-file, overriding the one implied by its extension.""")
+
+    parser.add_argument("--metrics-interval", type=float, default=10, help="""
+    The number of seconds between updates of --metrics-file, and between the progress lines
+    (rows done, rows per second and ETA) that are logged (default: %(default)s).""")
+
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="""
+    The level of the messages logged to STDOUT. Defaults to the environment variable EU_LOG_LEVEL,
+    or else DEBUG.""")
+
+    parser.add_argument("--log-json", action="store_true", help="""
+    Log one JSON object per line, rather than plain text. The default is taken from the
+    environment variable EU_LOG_FORMAT ('text' or 'json'). The log files in EU_Logs can be rotated
+    by size or time with the environment variables EU_LOG_MAX_BYTES or EU_LOG_ROTATE_WHEN, along
+    with EU_LOG_BACKUP_COUNT.""")
+
+    parser.add_argument("--profile-run", action="store_true", help="""
+    Break the time of the run down by stage: reading the input file ('read'), converting its values
+    into payloads ('convert', which includes the typecasting), checking the JSON values
+    ('check_valid_json'), the validation ('validate'), loading the profiles ('profile_load'), md5sum
+    calculation ('md5'), submitting the payloads ('submit', and 'http' for the requests
+    themselves), journaling ('journal'), reporting ('report') and logging ('logging').
+    The number of calls, total time and self time (which leaves out the nested stages) of each
+    stage, and the latency of each kind of request, are printed to STDERR at the end of the run,
+    and written to --profile-dir. The timers cost one or two microseconds per call, and nothing when
+    this option isn't given. See also --profile-with.""")
+
+    parser.add_argument("--profile-with", action="append", default=[],
+                        choices=["cprofile", "tracemalloc"], help="""
+    Only has meaning with --profile-run. 'cprofile' runs the cProfile profiler on all threads, and
+    writes its statistics to a .prof file that can be opened with 'python -m pstats' or viewers
+    such as SnakeViz. 'tracemalloc' traces the memory allocations, prints the peak and the top
+    allocation sites, and writes a snapshot to a .tracemalloc file. May be given twice for both.
+    Both slow the run down.""")
+
+    parser.add_argument("--profile-dir", default="EU_Profiling", help="""
+    Only has meaning with --profile-run. The directory that the results are written to, in files
+    named after the start time of the run (default: %(default)s).""")
+
     return parser
 
 
+def count_rows(infile, input_format=None):
+    """
+    Counts the rows of an input file that ``iter_payloads()`` turns into payloads, without parsing
+    them.
+
+    Args:
+        infile: str. The path to the input file.
+        input_format: str. See ``iter_payloads()``.
+
+    Returns:
+        int: The number of rows, besides the header line.
+    """
+    with eureaders.get_reader(infile, input_format) as reader:
+        return reader.count_rows()
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
+    if args.log_level or args.log_json:
+        import encode_utils.logs as eulogs
+        eulogs.configure_logging(level=args.log_level, fmt="json" if args.log_json else None)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if args.upload_part_size < 5 or args.upload_part_workers < 1:
+        parser.error("--upload-part-size must be at least 5 and --upload-part-workers at least 1.")
+    if args.skip_unchanged and not args.patch:
+        parser.error("--skip-unchanged requires --patch.")
+
+    profiler = None
+    if args.profile_run:
+        profiler = start_profiler(args)
+    try:
+        register(args)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.report(eumetrics.METRICS.snapshot()["operations"])
+
+
+def register(args):
+    """
+    Validates the input file, unless told not to, and submits its rows.
+
+    Args:
+        args: argparse.Namespace. The parsed command-line arguments.
+    """
     profile_id = args.profile_id
-    dcc_mode = args.dcc_mode
     dry_run = args.dry_run
     no_aliases = args.no_aliases
-    overwrite_array_values = args.overwrite_array_values
+    if args.infile == eureaders.STDIN:
+        # The input is read more than once.
+        args.infile = eureaders.spool_stdin()
+        atexit.register(os.remove, args.infile)
+    infile = args.infile
+    input_format = args.input_format
+    patch = args.patch
+    # The number of rows, for the ETA. Taken from the validation when it's done, so as not to read
+    # the input file once more.
+    counts = {}
+    if args.validate_only or not args.no_validate:
+        num_errors = report_validation_errors(
+            profile_id=profile_id, infile=infile, patch=patch, no_aliases=no_aliases,
+            input_format=input_format, counts=counts)
+        if args.validate_only or num_errors:
+            sys.exit(1 if num_errors else 0)
+
+    journal = None
+    if not dry_run:
+        journal_path = eujournal.get_journal_path(
+            infile=infile, profile_id=profile_id, patch=patch, journal_dir=args.journal_dir)
+        journal = eujournal.SubmissionJournal(journal_path, resume=args.resume)
+    num_rows = counts.get("rows")
+    # The ETA is only shown in --metrics-file and in the progress lines logged at the DEBUG level.
+    show_eta = args.metrics_file or eumetrics.DEBUG_LOGGER.isEnabledFor(logging.DEBUG)
+    if num_rows is None and show_eta:
+        num_rows = count_rows(infile, input_format)
+    if num_rows is not None and journal:
+        num_rows -= len(journal.completed)
+    eumetrics.METRICS.start_run(num_rows)
+    exporter = eumetrics.MetricsExporter(
+        args.metrics_file, interval=args.metrics_interval, fmt=args.metrics_format)
+    exporter.start()
+    try:
+        if args.use_async:
+            run_async(args, journal)
+        else:
+            run(args, journal)
+    finally:
+        exporter.stop()
+        if journal:
+            journal.close()
 
-    if dcc_mode:
-        conn = euc.Connection(dcc_mode, dry_run)
+
+def start_profiler(args):
+    """
+    Implements the --profile-run option: times the stages of the run, and starts the profilers
+    given with --profile-with.
+
+    Args:
+        args: argparse.Namespace. The parsed command-line arguments.
+
+    Returns:
+        encode_utils.profiling.RunProfiler: The profiler, to be stopped at the end of the run.
+    """
+    import encode_utils.profiling as euprofiling
+
+    profiler = euprofiling.RunProfiler(
+        args.profile_dir, use_cprofile="cprofile" in args.profile_with,
+        use_tracemalloc="tracemalloc" in args.profile_with)
+    module = sys.modules[__name__]
+    stages = [
+        (eureaders, "spool_stdin", "read"),
+        (module, "iter_payloads", "convert"),
+        (module, "check_valid_json", "check_valid_json"),
+        (module, "validate", "validate"),
+        (eup.Profile, "load_profiles", "profile_load"),
+        (module, "add_md5sums", "md5"),
+        (euu, "get_md5sum", "md5"),
+        (module, "skip_unchanged", "skip_unchanged"),
+        (module, "submit_payload", "submit"),
+        (module, "submit_payload_async", "submit"),
+        (eujournal.SubmissionJournal, "record", "journal"),
+        (Report, "add", "report"),
+        (logging.Logger, "handle", "logging"),
+    ]
+    for reader_class in set(eureaders.READERS.values()):
+        stages.append((reader_class, "iter_rows", "read"))
+        stages.append((reader_class, "count_rows", "read"))
+    if args.use_async:
+        import encode_utils.async_connection as euac
+        stages.append((euac.AsyncConnection, "_send", "http"))
+    else:
+        import encode_utils.connection as euc
+        stages.append((euc.Connection, "_request", "http"))
+    for owner, name, stage in stages:
+        profiler.instrument(owner, name, stage)
+    profiler.start()
+    return profiler
+
+
+def run(args, journal=None):
+    """
+    Submits the rows through an ``encode_utils.connection.Connection``, either one at a time or
+    with the --workers option, through a pool of threads.
+
+    Args:
+        args: argparse.Namespace. The parsed command-line arguments.
+        journal: encode_utils.journal.SubmissionJournal. Records the outcome of each row. The rows
+          that it lists as completed are skipped.
+    """
+    import encode_utils.connection as euc
+    import encode_utils.sessions as eusessions
+    import encode_utils.throttle as euthrottle
+
+    # One pooled connection per thread.
+    eusessions.set_pool_size(args.workers)
+    if args.dcc_mode:
+        conn = euc.Connection(args.dcc_mode, args.dry_run)
     else:
         # Default dcc_mode taken from environment variable DCC_MODE.
         conn = euc.Connection()
+    is_file_profile = eup.Profile(args.profile_id).profile_id == eup.Profile.FILE_PROFILE_ID
+    # The Connection sends its requests itself, so the submissions are paced as a whole. When
+    # POSTING files, these include the uploads, whose duration says nothing of the Portal's load.
+    throttle = euthrottle.Throttle(get_host(args.dcc_mode), args.workers, rate=args.rate_limit,
+                                   latency_target=args.latency_target,
+                                   adapt_to_latency=args.patch or not is_file_profile)
 
-    infile = args.infile
-    patch = args.patch
-    gen = create_payloads(profile_id=profile_id, infile=infile)
-    for payload in gen:
-        if not patch:
-            conn.post(payload, require_aliases=not no_aliases)
+    def submit(payload):
+        # A copy of the payload is submitted, since it's modified and may be submitted again.
+        return throttle.call(
+            lambda: submit_payload(conn=conn, payload=dict(payload), patch=args.patch,
+                                   no_aliases=args.no_aliases,
+                                   overwrite_array_values=overwrite_array_values),
+            method="PATCH" if args.patch else "POST")
+
+    # With --skip-unchanged, the arrays are already extended in the payloads.
+    overwrite_array_values = args.overwrite_array_values or args.skip_unchanged
+    rows = skip_completed(iter_payloads(profile_id=args.profile_id, infile=args.infile,
+                                        input_format=args.input_format), journal)
+    report = Report(journal)
+    if args.preflight or args.skip_unchanged:
+        records = []
+        link_fields = get_link_fields(eup.Profile(args.profile_id)) if args.skip_unchanged else ()
+        for query in get_preflight_queries(
+                iter_payloads(profile_id=args.profile_id, infile=args.infile,
+                              input_format=args.input_format),
+                args.patch, full_records=args.skip_unchanged, link_fields=link_fields):
+            records.extend(conn.search(query))
+        record_index = get_record_index(records)
+        rows = apply_preflight(rows, record_index, args.patch, report)
+        if args.skip_unchanged:
+            rows = skip_unchanged(rows, record_index, eup.Profile(args.profile_id), report,
+                                  extend_arrays=not args.overwrite_array_values)
+    if is_file_profile and not args.patch and args.md5_processes > 0:
+        rows = add_md5sums(rows, processes=args.md5_processes)
+    if args.workers == 1:
+        # Stop at the first failure.
+        for line, payload in rows:
+            try:
+                response = submit(payload)
+            except Exception as e:
+                report.add(Result(line=line, response=None, error=e))
+                raise
+            report.add(Result(line=line, response=response, error=None))
+    elif args.waves:
+        for wave in get_waves(rows, get_link_fields(eup.Profile(args.profile_id))):
+            wave_rows = report.skip_failed_dependencies(wave)
+            for result in submit_concurrently(submit=submit, rows=wave_rows, workers=args.workers):
+                report.add(result)
+    else:
+        for result in submit_concurrently(submit=submit, rows=rows, workers=args.workers):
+            report.add(result)
+    report.finish()
+
+
+#: The number of identifiers looked up per search request by ``get_preflight_queries()``.
+PREFLIGHT_BATCH_SIZE = 100
+
+#: Matches UUIDs.
+UUID_REGX = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+#: Matches ENCODE accessions, i.e. ENCBS123ABC, as well as TSTBS123ABC on the test Portal.
+ACCESSION_REGX = re.compile(r'^(ENC|TST)[A-Z]{2}\d{3}[A-Z]{3}$')
+
+
+def get_search_field(identifier):
+    """
+    Determines the property to search on to find the record with a given identifier.
+
+    Args:
+        identifier: str. An accession, UUID, alias or `@id` of a record.
+
+    Returns:
+        tuple: The property name ('accession', 'uuid' or 'aliases') and the value to search for.
+    """
+    value = identifier.strip("/").split("/")[-1]
+    if ACCESSION_REGX.match(value):
+        return "accession", value
+    if UUID_REGX.match(value):
+        return "uuid", value
+    return eu.ALIAS_PROP_NAME, identifier
+
+
+def get_row_identifiers(payload, patch=False):
+    """
+    Args:
+        payload: dict. A payload generated by ``create_payloads()``.
+        patch: bool. True if the payload is to be PATCHED.
+
+    Returns:
+        list: The identifiers that the pre-flight looks up for the payload, which are its aliases
+        when POSTING, or the value of the RECORD_ID_FIELD field when PATCHING.
+    """
+    if patch:
+        record_id = payload.get(RECORD_ID_FIELD)
+        return [record_id] if record_id else []
+    return payload.get(eu.ALIAS_PROP_NAME, [])
+
+
+def _iter_link_values(value):
+    # The identifiers held by the value of a link property.
+    for item in value if isinstance(value, list) else [value]:
+        if isinstance(item, str):
+            yield item
+
+
+def _get_search_queries(field, values, batch_size, full_records):
+    queries = []
+    values = sorted(values)
+    for i in range(0, len(values), batch_size):
+        query = [("frame", "object")]
+        if not full_records:
+            query.extend([("field", eu.ALIAS_PROP_NAME), ("field", "accession"),
+                          ("field", "uuid")])
+        query.extend((field, x) for x in values[i:i + batch_size])
+        queries.append(query)
+    return queries
+
+
+def get_preflight_queries(rows, patch=False, batch_size=PREFLIGHT_BATCH_SIZE, full_records=False,
+                          link_fields=()):
+    """
+    Builds the search queries that look up, in bulk, the records identified in the rows (see
+    ``get_row_identifiers()``).
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples, i.e. ``iter_payloads()``.
+        patch: bool. True if the rows are to be PATCHED.
+        batch_size: int. The maximum number of identifiers per query.
+        full_records: bool. True means to fetch all the properties of the records, as needed by
+          ``skip_unchanged()``, rather than only their identifiers.
+        link_fields: The names of the link properties (see ``get_link_fields()``) whose aliases
+          are looked up as well, for their identifiers only, so that ``skip_unchanged()`` can
+          resolve them to `@id`s. Their queries come last.
+
+    Returns:
+        list: The queries, each a list of (parameter, value) tuples to pass to the `search()`
+        method of a connection. Repeated parameters are OR'ed by the Portal.
+    """
+    identifiers = collections.defaultdict(set)
+    link_aliases = set()
+    for line, payload in rows:
+        for identifier in get_row_identifiers(payload, patch):
+            field, value = get_search_field(identifier)
+            identifiers[field].add(value)
+        for field in link_fields:
+            for value in _iter_link_values(payload.get(field)):
+                if get_search_field(value)[0] == eu.ALIAS_PROP_NAME:
+                    link_aliases.add(value)
+    link_aliases.difference_update(identifiers.get(eu.ALIAS_PROP_NAME, ()))
+    queries = []
+    for field in sorted(identifiers):
+        queries.extend(_get_search_queries(field, identifiers[field], batch_size, full_records))
+    queries.extend(_get_search_queries(eu.ALIAS_PROP_NAME, link_aliases, batch_size, False))
+    DEBUG_LOGGER.debug("Pre-flight: looking up {} identifiers with {} searches.".format(
+        sum(len(x) for x in identifiers.values()) + len(link_aliases), len(queries)))
+    return queries
+
+
+def get_record_index(records):
+    """
+    Args:
+        records: list. The records returned by the pre-flight searches.
+
+    Returns:
+        dict: Maps each identifier of the records (aliases, accession, UUID and `@id`) to the
+        record. A record listed more than once is indexed as first listed, so that the full
+        records looked up by ``get_preflight_queries()`` win over the identifiers of the linked
+        records, which come last.
+    """
+    index = {}
+    for record in records:
+        for alias in record.get(eu.ALIAS_PROP_NAME, []):
+            index.setdefault(alias, record)
+        for key in ["accession", "uuid", "@id"]:
+            if record.get(key):
+                index.setdefault(record[key], record)
+                index.setdefault(record[key].strip("/"), record)
+    return index
+
+
+def find_record(payload, record_index, patch):
+    """
+    Args:
+        payload: dict. A payload generated by ``create_payloads()``.
+        record_index: dict. The return value of ``get_record_index()``.
+        patch: bool. True if the payload is to be PATCHED.
+
+    Returns:
+        dict: The record that the payload refers to (see ``get_row_identifiers()``), or None if it
+        isn't in the index.
+    """
+    for identifier in get_row_identifiers(payload, patch):
+        field, value = get_search_field(identifier)
+        record = record_index.get(value) or record_index.get(identifier)
+        if record:
+            return record
+    return None
+
+
+def apply_preflight(rows, record_index, patch, report):
+    """
+    Partitions the rows using the result of the pre-flight searches into new rows, rows whose
+    record already exists, and rows whose record to PATCH is missing. Only the rows to submit are
+    passed on: new rows when POSTING, and rows with an existing record when PATCHING. The others
+    are reported right away, as succeeded (with the existing record) or failed, respectively.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples.
+        record_index: dict. The return value of ``get_record_index()``.
+        patch: bool. True if the rows are to be PATCHED.
+        report: Report. Where the rows that aren't submitted are reported.
+
+    Yields:
+        tuple: The (line number, payload) tuples of the rows to submit.
+    """
+    counts = collections.Counter()
+    for line, payload in rows:
+        record = find_record(payload, record_index, patch)
+        if patch and not record:
+            counts["missing target"] += 1
+            report.add(Result(line=line, response=None, error=Exception(
+                "Record to PATCH not found on the Portal.")))
+        elif not patch and record:
+            counts["already exists"] += 1
+            report.add(Result(line=line, response=record, error=None))
+        else:
+            counts["existing target" if patch else "new"] += 1
+            yield line, payload
+    DEBUG_LOGGER.debug("Pre-flight: {}.".format(
+        ", ".join("{} {}".format(counts[x], x) for x in sorted(counts))))
+
+
+def _link_key(value):
+    # The last part of an identifier, i.e. 'ENCBS123ABC' for '/biosamples/ENCBS123ABC/'.
+    return value.strip("/").split("/")[-1]
+
+
+def resolve_links(props, link_fields, record_index):
+    """
+    Replaces the identifiers in the values of link properties that are found in the index, i.e.
+    aliases, with the `@id`s of their records, which is how the `object` frame of a record holds
+    them. Identifiers of the same record in an array are then only kept once.
+
+    Args:
+        props: dict. The properties to PATCH.
+        link_fields: The names of the link properties. See ``get_link_fields()``.
+        record_index: dict. The return value of ``get_record_index()``.
+
+    Returns:
+        dict: The properties, with the links resolved where possible.
+    """
+    def resolve(value):
+        if not isinstance(value, str):
+            return value
+        record = record_index.get(value) or record_index.get(value.strip("/"))
+        return record.get("@id", value) if record else value
+
+    resolved = dict(props)
+    for prop in link_fields:
+        value = props.get(prop)
+        if isinstance(value, list):
+            items = []
+            for item in map(resolve, value):
+                if not any(same_value(item, x, is_link=True) for x in items):
+                    items.append(item)
+            resolved[prop] = items
+        elif value is not None:
+            resolved[prop] = resolve(value)
+    return resolved
+
+
+def same_value(new, current, is_link=False):
+    """
+    Tells whether a value to PATCH equals the current value of a property. The values of link
+    properties are equal when they point to the same record by accession, UUID or `@id`, i.e.
+    'ENCBS123ABC' equals '/biosamples/ENCBS123ABC/'. A link given by alias never equals the `@id`
+    of a record, so that it's PATCHED rather than wrongly deemed unchanged, unless it was resolved
+    beforehand with ``resolve_links()``.
+
+    Args:
+        new: The value to PATCH.
+        current: The current value, from the `object` frame of the record.
+        is_link: bool. True if the property links to other records (see ``get_link_fields()``).
+
+    Returns:
+        bool.
+    """
+    if new == current:
+        return True
+    if isinstance(new, list) and isinstance(current, list):
+        return len(new) == len(current) and all(
+            same_value(x, y, is_link) for x, y in zip(new, current))
+    if is_link and isinstance(new, str) and isinstance(current, str):
+        return _link_key(new) == _link_key(current)
+    return False
+
+
+def get_patch_diff(props, record, link_fields=(), extend_arrays=True):
+    """
+    Determines the properties of a PATCH that would change a record.
+
+    Args:
+        props: dict. The properties to PATCH.
+        record: dict. The writable properties of the current record (see
+          ``encode_utils.profiles.Profile.filter_non_writable_props()``).
+        link_fields: The names of the link properties. See ``same_value()``.
+        extend_arrays: bool. True means that array values extend the current arrays, with the
+          duplicates removed, rather than replace them; this is the default of the --patch option.
+
+    Returns:
+        dict: The properties whose values differ from those of the record. With `extend_arrays`,
+        array values are already extended, so the PATCH must overwrite the arrays of the record.
+    """
+    diff = {}
+    for prop, new in props.items():
+        is_link = prop in link_fields
+        if prop not in record:
+            diff[prop] = new
+            continue
+        current = record[prop]
+        if extend_arrays and isinstance(new, list) and isinstance(current, list):
+            extended = list(current)
+            for item in new:
+                if not any(same_value(item, x, is_link) for x in extended):
+                    extended.append(item)
+            if len(extended) > len(current):
+                diff[prop] = extended
+        elif not same_value(new, current, is_link):
+            diff[prop] = new
+    return diff
+
+
+def skip_unchanged(rows, record_index, profile, report, extend_arrays=True):
+    """
+    Implements the --skip-unchanged option: reduces each row to PATCH to the properties that would
+    change its record, and reports the rows that wouldn't change anything as succeeded, without
+    passing them on.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples of rows whose record is in the index,
+          i.e. as passed on by ``apply_preflight()``.
+        record_index: dict. The return value of ``get_record_index()``, for full records. The
+          link aliases of the rows found in it are resolved to `@id`s (see ``resolve_links()``).
+        profile: encode_utils.profiles.Profile. The profile of the records.
+        report: Report. Where the rows that aren't PATCHED are reported.
+        extend_arrays: bool. See ``get_patch_diff()``.
+
+    Yields:
+        tuple: The (line number, payload) tuples of the rows to PATCH, with the payloads reduced to
+        the properties that change.
+    """
+    link_fields = set(get_link_fields(profile))
+    kept_keys = (RECORD_ID_FIELD, eu.PROFILE_KEY)
+    num_changed = 0
+    for line, payload in rows:
+        record = find_record(payload, record_index, patch=True)
+        props = resolve_links({k: v for k, v in payload.items() if k not in kept_keys},
+                              link_fields, record_index)
+        diff = get_patch_diff(props, profile.filter_non_writable_props(dict(record)),
+                              link_fields, extend_arrays)
+        if not diff:
+            report.add_unchanged(line, record)
+            continue
+        num_changed += 1
+        diff.update((k, payload[k]) for k in kept_keys if k in payload)
+        yield line, diff
+    DEBUG_LOGGER.debug("Skip unchanged: {} rows to PATCH, {} unchanged.".format(
+        num_changed, report.unchanged))
+
+
+def _get_md5sum_result(line, payload, cache_key, future, cache):
+    if future:
+        file_path = payload[eup.Profile.SUBMITTED_FILE_PROP_NAME]
+        try:
+            md5sum, seconds = future.result()
+        except OSError as e:
+            # Leave it to the POST to fail on this row.
+            ERROR_LOGGER.error("Line {}: Can't calculate the md5sum of {}: {}".format(
+                line, file_path, e))
+            return line, payload
+        eumetrics.METRICS.observe(eumetrics.OP_MD5, seconds)
+        payload[eup.Profile.MD5SUM_NAME_PROP_NAME] = md5sum
+        if cache is not None:
+            cache.set(cache_key, md5sum)
+    return line, payload
+
+
+def add_md5sums(rows, processes, cache=None):
+    """
+    Sets the `md5sum` of the file records that lack it, for those whose `submitted_file_name` is a
+    local path. The md5sums are calculated in a pool of processes, for up to twice as many rows
+    ahead as there are processes, so that hashing the upcoming files overlaps with submitting the
+    current rows.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples of file records.
+        processes: int. The number of processes.
+        cache: encode_utils.utils.Md5Cache. Defaults to ``encode_utils.utils.get_md5_cache()``.
+
+    Yields:
+        tuple: The (line number, payload) tuples, in order.
+    """
+    if cache is None:
+        cache = euu.get_md5_cache()
+    file_prop = eup.Profile.SUBMITTED_FILE_PROP_NAME
+    md5sum_prop = eup.Profile.MD5SUM_NAME_PROP_NAME
+    max_pending = 2 * processes
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for line, payload in rows:
+            cache_key = None
+            future = None
+            file_path = payload.get(file_prop)
+            if file_path and md5sum_prop not in payload and not file_path.startswith("s3://"):
+                try:
+                    if cache is not None:
+                        cache_key = cache.get_key(file_path)
+                        md5sum = cache.get(cache_key)
+                        if md5sum:
+                            payload[md5sum_prop] = md5sum
+                    if md5sum_prop not in payload:
+                        future = executor.submit(euu.calculate_md5sum_timed, file_path)
+                except OSError:
+                    pass  # Leave it to the POST to fail on this row.
+            pending.append((line, payload, cache_key, future))
+            while pending and (len(pending) >= max_pending or not pending[0][3]
+                               or pending[0][3].done()):
+                yield _get_md5sum_result(*pending.popleft(), cache=cache)
+        while pending:
+            yield _get_md5sum_result(*pending.popleft(), cache=cache)
+
+
+def skip_completed(rows, journal):
+    """
+    Filters out the rows that the journal lists as completed.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples, i.e. ``iter_payloads()``.
+        journal: encode_utils.journal.SubmissionJournal. May be None, in which case no row is
+          filtered out.
+
+    Yields:
+        tuple: The (line number, payload) tuples of the rows to submit.
+    """
+    num_skipped = 0
+    for line, payload in rows:
+        if journal and journal.is_completed(line):
+            num_skipped += 1
+            continue
+        yield line, payload
+    if num_skipped:
+        DEBUG_LOGGER.debug("Skipped {} rows that were already submitted.".format(num_skipped))
+
+
+def track_upload_lines(rows, upload_lines):
+    """
+    Passes the rows on, while recording the line number of each file to upload, so that failed
+    uploads, which are reported by file path, can be traced back to their rows.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples.
+        upload_lines: dict. Filled in with the line number of each value of the
+          `submitted_file_name` field.
+
+    Yields:
+        tuple: The (line number, payload) tuples.
+    """
+    file_prop = eup.Profile.SUBMITTED_FILE_PROP_NAME
+    for line, payload in rows:
+        if payload.get(file_prop):
+            upload_lines[payload[file_prop]] = line
+        yield line, payload
+
+
+def run_async(args, journal=None):
+    """
+    Implements the --async option: submits the rows through an
+    ``encode_utils.async_connection.AsyncConnection``, with up to --workers requests in flight.
+
+    Args:
+        args: argparse.Namespace. The parsed command-line arguments.
+        journal: encode_utils.journal.SubmissionJournal. See ``run()``.
+    """
+    import asyncio
+    import encode_utils.async_connection as euac
+    import encode_utils.throttle as euthrottle
+
+    async def run():
+        rows = skip_completed(
+            iter_payloads(profile_id=args.profile_id, infile=args.infile,
+                          input_format=args.input_format),
+            journal)
+        report = Report(journal)
+        pipeline = None
+        is_file_profile = eup.Profile(args.profile_id).profile_id == eup.Profile.FILE_PROFILE_ID
+        if is_file_profile and not args.patch and not args.dry_run and args.upload_workers > 0:
+            import encode_utils.s3_upload as eus3
+            pipeline = eus3.UploadPipeline(
+                max_uploads=args.upload_workers, part_size=args.upload_part_size * 1024 * 1024,
+                max_concurrency=args.upload_part_workers)
+            upload_lines = {}
+            rows = track_upload_lines(rows, upload_lines)
+        throttle = euthrottle.Throttle(get_host(args.dcc_mode), args.workers,
+                                       rate=args.rate_limit, latency_target=args.latency_target)
+        async with euac.AsyncConnection(args.dcc_mode, args.dry_run, limit=args.workers,
+                                        upload_pipeline=pipeline, throttle=throttle) as conn:
+            if args.preflight or args.skip_unchanged:
+                link_fields = ()
+                if args.skip_unchanged:
+                    link_fields = get_link_fields(eup.Profile(args.profile_id))
+                queries = get_preflight_queries(
+                    iter_payloads(profile_id=args.profile_id, infile=args.infile,
+                                  input_format=args.input_format),
+                    args.patch, full_records=args.skip_unchanged, link_fields=link_fields)
+                results = await asyncio.gather(*[conn.search(query) for query in queries])
+                records = [record for result in results for record in result]
+                record_index = get_record_index(records)
+                rows = apply_preflight(rows, record_index, args.patch, report)
+                if args.skip_unchanged:
+                    rows = skip_unchanged(rows, record_index, eup.Profile(args.profile_id), report,
+                                          extend_arrays=not args.overwrite_array_values)
+            async def submit(payload):
+                return await submit_payload_async(
+                    conn=conn, payload=payload, patch=args.patch, no_aliases=args.no_aliases,
+                    overwrite_array_values=args.overwrite_array_values or args.skip_unchanged)
+            if args.waves:
+                link_fields = get_link_fields(eup.Profile(args.profile_id))
+                for wave in get_waves(rows, link_fields):
+                    wave_rows = report.skip_failed_dependencies(wave)
+                    async for result in submit_concurrently_async(submit=submit, rows=wave_rows,
+                                                                  workers=args.workers):
+                        report.add(result)
+            else:
+                async for result in submit_concurrently_async(submit=submit, rows=rows,
+                                                              workers=args.workers):
+                    report.add(result)
+        if pipeline:
+            DEBUG_LOGGER.debug("Waiting for the uploads to finish.")
+            failures = await asyncio.get_running_loop().run_in_executor(None, pipeline.close)
+            for file_path, error in failures:
+                report.add_upload_failure(upload_lines[file_path], error)
+        report.finish()
+
+    asyncio.run(run())
+
+
+class Report:
+    """
+    Logs the outcome of each submitted row, and a summary once all rows are submitted.
+
+    Args:
+        journal: encode_utils.journal.SubmissionJournal. If set, the outcome of each row is also
+          recorded in it.
+    """
+
+    def __init__(self, journal=None):
+        self.journal = journal
+        #: The number of rows submitted so far.
+        self.total = 0
+        #: The line numbers of the rows that failed.
+        self.failed_lines = []
+        #: The number of rows that weren't PATCHED since they wouldn't change their record.
+        self.unchanged = 0
+
+    def add(self, result):
+        """
+        Args:
+            result: Result. The outcome of a row.
+        """
+        self.total += 1
+        eumetrics.METRICS.add_row(ok=not result.error)
+        if result.error:
+            self.failed_lines.append(result.line)
+            message = "{}: {}".format(type(result.error).__name__, result.error)
+            ERROR_LOGGER.error("Line {}: {}".format(result.line, message))
+            if self.journal:
+                self.journal.record(result.line, eujournal.STATUS_ERROR, message=message)
         else:
-            record_id = payload.get(RECORD_ID_FIELD, False)
-            if not record_id:
-                raise Exception(
-                    "Can't patch payload {} since there isn't a '{}' field indiciating an identifer for the record to be PATCHED.".format(
-                        euu.print_format_dict(payload), RECORD_ID_FIELD))
-            payload.pop(RECORD_ID_FIELD)
-            payload.update({conn.ENCID_KEY: record_id})
-            conn.patch(payload=payload, extend_array_values=not overwrite_array_values)
+            record_id = get_record_id(result.response)
+            DEBUG_LOGGER.debug("Line {}: OK {}".format(result.line, record_id))
+            if self.journal:
+                self.journal.record(result.line, eujournal.STATUS_OK, record_id=record_id)
+
+    def add_unchanged(self, line, record):
+        """
+        Reports a row that wasn't PATCHED since it wouldn't change its record as succeeded.
+
+        Args:
+            line: int. The line number of the row.
+            record: dict. The record.
+        """
+        self.unchanged += 1
+        eumetrics.METRICS.inc("rows_unchanged")
+        self.add(Result(line=line, response=record, error=None))
+
+    def add_upload_failure(self, line, error):
+        """
+        Reports a row whose record was POSTED, but whose file failed to upload, as failed.
+
+        Args:
+            line: int. The line number of the row.
+            error: Exception. The error of the upload.
+        """
+        self.failed_lines.append(line)
+        eumetrics.METRICS.inc("upload_failures")
+        message = "Upload failed: {}: {}".format(type(error).__name__, error)
+        ERROR_LOGGER.error("Line {}: {}".format(line, message))
+        if self.journal:
+            self.journal.record(line, eujournal.STATUS_ERROR, message=message)
+
+    def skip_failed_dependencies(self, wave):
+        """
+        Reports the rows of a wave that reference a row that failed as failed themselves.
+
+        Args:
+            wave: list. A wave of rows, as given by ``get_waves()``.
+
+        Returns:
+            list: The (line number, payload) tuples of the remaining rows.
+        """
+        failed_lines = set(self.failed_lines)
+        rows = []
+        for line, payload, dependency_lines in wave:
+            failed_dependencies = sorted(failed_lines.intersection(dependency_lines))
+            if failed_dependencies:
+                error = Exception("Not submitted since it references the failed line(s) {}.".format(
+                    ", ".join(str(x) for x in failed_dependencies)))
+                self.add(Result(line=line, response=None, error=error))
+            else:
+                rows.append((line, payload))
+        return rows
+
+    def finish(self):
+        """
+        Logs the summary, and exits with status 1 if any row failed.
+        """
+        DEBUG_LOGGER.debug("Submitted {} rows: {} succeeded, {} failed.{}".format(
+            self.total, self.total - len(self.failed_lines), len(self.failed_lines),
+            " {} rows were skipped as unchanged.".format(self.unchanged) if self.unchanged else ""))
+        if self.failed_lines:
+            ERROR_LOGGER.error("Failed lines: {}".format(
+                ", ".join(str(x) for x in self.failed_lines)))
+            sys.exit(1)
+
+
+def get_host(dcc_mode=None):
+    """
+    Args:
+        dcc_mode: str. The --dcc-mode option. Defaults to the environment variable DCC_MODE.
+
+    Returns:
+        str: The host name of the Portal, by which the requests to it are rate limited.
+    """
+    dcc_mode = dcc_mode or os.environ.get("DCC_MODE", "")
+    return eu.DCC_MODES.get(dcc_mode, {}).get("host", dcc_mode)
+
+
+def submit_payload(conn, payload, patch=False, no_aliases=False, overwrite_array_values=False):
+    """
+    POSTS or PATCHES a single payload generated by ``create_payloads()``.
+
+    Args:
+        conn: encode_utils.connection.Connection. The connection to the Portal.
+        payload: dict. The payload.
+        patch: bool. True means to PATCH the record identified in the RECORD_ID_FIELD field of the
+          payload, rather than POST a new record.
+        no_aliases: bool. See the --no-aliases option.
+        overwrite_array_values: bool. See the --overwrite-array-values option.
+
+    Returns:
+        The return value of ``conn.post()`` or ``conn.patch()``.
+
+    Raises:
+        Exception: `patch` is set, but the payload lacks the RECORD_ID_FIELD field.
+    """
+    if not patch:
+        return conn.post(payload, require_aliases=not no_aliases)
+    set_patch_id(conn, payload)
+    return conn.patch(payload=payload, extend_array_values=not overwrite_array_values)
+
+
+async def submit_payload_async(conn, payload, patch=False, no_aliases=False,
+                               overwrite_array_values=False):
+    """
+    Same as ``submit_payload()``, but for an
+    ``encode_utils.async_connection.AsyncConnection``.
+    """
+    if not patch:
+        return await conn.post(payload, require_aliases=not no_aliases)
+    set_patch_id(conn, payload)
+    return await conn.patch(payload=payload, extend_array_values=not overwrite_array_values)
+
+
+def set_patch_id(conn, payload):
+    """
+    Replaces the RECORD_ID_FIELD field of a payload with the key that the connection expects for
+    the identifier of the record to PATCH.
+
+    Args:
+        conn: The connection to the Portal.
+        payload: dict. The payload.
+
+    Raises:
+        Exception: The payload lacks the RECORD_ID_FIELD field.
+    """
+    record_id = payload.get(RECORD_ID_FIELD, False)
+    if not record_id:
+        raise Exception(
+            "Can't patch payload {} since there isn't a '{}' field indiciating an identifer for the record to be PATCHED.".format(
+                json.dumps(payload, indent=4), RECORD_ID_FIELD))
+    payload.pop(RECORD_ID_FIELD)
+    payload.update({conn.ENCID_KEY: record_id})
+
+
+def get_record_id(response):
+    """
+    Extracts the identifier of a record from the JSON returned by the Portal for it.
+
+    Args:
+        response: The return value of ``submit_payload()``.
+
+    Returns:
+        str: The accession of the record if it has one, otherwise its UUID, or the empty string if
+        neither can be found.
+    """
+    if not isinstance(response, dict):
+        return ""
+    if response.get("@graph"):
+        response = response["@graph"][0]
+    return response.get("accession") or response.get("uuid") or ""
+
+
+#: Stores the outcome of submitting the payload from a given line of the input file.
+#: `line` is the line number, `response` the return value of the submission function and
+#: `error` the exception that it raised, if any.
+Result = collections.namedtuple("Result", ["line", "response", "error"])
+
+
+def _get_result(line, future):
+    try:
+        return Result(line=line, response=future.result(), error=None)
+    except Exception as e:
+        return Result(line=line, response=None, error=e)
+
+
+def submit_concurrently(submit, rows, workers, max_pending=None):
+    """
+    Submits payloads through a pool of threads, while keeping memory use flat regardless of the
+    number of rows: at most `max_pending` payloads are in flight or waiting for their result to be
+    reported, and `rows` isn't advanced further until the oldest of these has completed.
+
+    Args:
+        submit: callable. Submits a single payload, i.e. a wrapper around ``submit_payload()``.
+        rows: iterable. Yields (line number, payload) tuples, i.e. ``iter_payloads()``.
+        workers: int. The number of threads.
+        max_pending: int. Defaults to four times `workers`.
+
+    Yields:
+        Result: One per row, in the order of `rows`. Exceptions raised by `submit` are stored in the
+        result rather than raised.
+    """
+    if not max_pending:
+        max_pending = 4 * workers
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for line, payload in rows:
+            pending.append((line, executor.submit(submit, payload)))
+            while pending and (len(pending) >= max_pending or pending[0][1].done()):
+                yield _get_result(*pending.popleft())
+        while pending:
+            yield _get_result(*pending.popleft())
+
+
+async def _get_result_async(line, task):
+    try:
+        return Result(line=line, response=await task, error=None)
+    except Exception as e:
+        return Result(line=line, response=None, error=e)
+
+
+async def submit_concurrently_async(submit, rows, workers, max_pending=None):
+    """
+    The asyncio counterpart of ``submit_concurrently()``, where `submit` is a coroutine function
+    and up to `workers` calls of it run at once on the event loop.
+
+    Yields:
+        Result: One per row, in the order of `rows`.
+    """
+    import asyncio
+
+    if not max_pending:
+        max_pending = 4 * workers
+    semaphore = asyncio.Semaphore(workers)
+
+    async def limited_submit(payload):
+        async with semaphore:
+            return await submit(payload)
+
+    pending = collections.deque()
+    for line, payload in rows:
+        pending.append((line, asyncio.ensure_future(limited_submit(payload))))
+        while pending and (len(pending) >= max_pending or pending[0][1].done()):
+            yield await _get_result_async(*pending.popleft())
+    while pending:
+        yield await _get_result_async(*pending.popleft())
 
 
 def check_valid_json(prop, val, row_count):
@@ -164,7 +1264,7 @@ def check_valid_json(prop, val, row_count):
         row_count: int. The line number from the input file that is currently being processed.
 
     Raises:
-        ValueError: The input is malformed JSON.
+        ValueError: The input is malformed JSON. The message names the field and the row.
     """
 
     # Don't try to break down the individual pieces of a nested object. That will be too complext for this script, and will also
@@ -172,108 +1272,455 @@ def check_valid_json(prop, val, row_count):
     # for a nested object.
     try:
         json_val = json.loads(val)
-    except ValueError:
-        print("Error: Invalid JSON in field '{}', row '{}'".format(prop, row_count))
-        raise
+    except ValueError as e:
+        # Not printed, since STDOUT carries the report of ``report_validation_errors()``.
+        raise ValueError("Invalid JSON in field '{}', row '{}': {}".format(prop, row_count, e))
     return json_val
 
 
 def typecast(value, value_type):
     """
+    Casts a value from the input file to the given JSON schema type.
+
+    Args:
+        value: str. The value to cast.
+        value_type: str. The JSON schema type, i.e. 'integer', 'number', 'boolean' or 'string'.
+
+    Returns:
+        The cast value. Values of types other than the ones mentioned above are returned as is.
+
+    Raises:
+        ValueError: The value can't be cast to the given type.
     """
-    if value_type == "integer":
-        return int(value)
+    caster = TYPECASTS.get(value_type)
+    if caster:
+        return caster(value)
     return value
 
 
-def create_payloads(profile_id, infile):
+def _to_number(value):
+    """
+    Casts a value to a JSON schema 'number', keeping whole numbers as ints.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _to_boolean(value):
+    """
+    Casts a value to a JSON schema 'boolean'. Accepts 'true' and 'false' in any case.
+    """
+    lowered = value.lower()
+    if lowered == "true":
+        return True
+    if lowered == "false":
+        return False
+    raise ValueError("Invalid boolean value '{}'. Expected 'true' or 'false'.".format(value))
+
+
+#: Maps the scalar JSON schema types that values need to be cast to, to the function that casts
+#: them. Used by ``typecast()``.
+TYPECASTS = {
+    "integer": int,
+    "number": _to_number,
+    "boolean": _to_boolean
+}
+
+
+def get_converter(field, prop_schema):
+    """
+    Builds the function that converts the values of a given column of the input file into the
+    form they need to take in the payload. This does all of the schema lookups for the column once,
+    rather than for each of its values.
+
+    Args:
+        field: str. The name of the column, which is a property name in the profile.
+        prop_schema: dict. The JSON schema of the property.
+
+    Returns:
+        A function taking the stripped, non-empty value of a cell and the line number of the row
+        it's from, and returning the converted value.
+    """
+    STR_REGX = re.compile(r'\'|"')
+    schema_val_type = prop_schema["type"]
+    if schema_val_type == "object":
+        # Must be proper JSON
+        def convert(val, line_count):
+            return check_valid_json(field, val, line_count)
+    elif schema_val_type == "array":
+        item_val_type = prop_schema["items"]["type"]
+        if item_val_type == "object":
+            # Must be valid JSON
+            def convert(val, line_count):
+                # Check if user supplied optional JSON array literal. If not, I'll add it.
+                if not val.startswith("["):
+                    val = "[" + val
+                if not val.endswith("]"):
+                    val += "]"
+                return check_valid_json(field, val, line_count)
+        else:
+            caster = TYPECASTS.get(item_val_type)
+
+            def convert(val, line_count):
+                # User is allowed to enter values in string literals. I'll remove them if I find them,
+                # since I'm splitting on the ',' to create a list of strings anyway:
+                val = STR_REGX.sub("", val)
+                # Remove optional JSON array literal since I'm tokenizing and then converting
+                # to an array regardless.
+                if val.startswith("["):
+                    val = val[1:]
+                if val.endswith("]"):
+                    val = val[:-1]
+                val = [x.strip() for x in val.split(",")]
+                # Type cast tokens if need be, i.e. to integers:
+                if caster:
+                    val = [caster(x) for x in val]
+                return val
+    else:
+        caster = TYPECASTS.get(schema_val_type)
+        if caster:
+            def convert(val, line_count):
+                return caster(val)
+        else:
+            def convert(val, line_count):
+                return val
+    return convert
+
+
+def _keep_value(val, line_count):
+    """
+    Converter of the RECORD_ID_FIELD column, whose values are used as is.
+    """
+    return val
+
+
+def get_columns(header_fields, profile):
+    """
+    Parses the header line of the input file into the list of columns that make up a payload.
+
+    Args:
+        header_fields: list. The field names in the header line.
+        profile: encode_utils.profiles.Profile. The profile that the records belong to.
+
+    Returns:
+        tuple: One (index, field, converter) tuple per column, in order, where index is the
+        position of the column in a row, field is the property name and converter is the function
+        built by ``get_converter()``. Non-schematic columns, which start with a '#', are left out.
+
+    Raises:
+        Exception: A field name isn't a property of the profile.
+    """
+    columns = []
+    for fi_count, field in enumerate(header_fields):
+        if field.startswith("#"):  # non-schema field
+            continue
+        if field == RECORD_ID_FIELD:  # Not an actual schema property.
+            columns.append((fi_count, field, _keep_value))
+            continue
+        if field not in profile.properties:
+            raise Exception(
+                "Unknown field name '{}', which is not registered as a property in the specified schema at {}.".format(
+                    field, profile.profile_id))
+        columns.append((fi_count, field, get_converter(field, profile.property(field))))
+    return tuple(columns)
+
+
+def create_payloads(profile_id, infile, input_format=None):
     """
     Generates the payload for each row in 'infile'.
 
+    The header line is parsed once into a converter per column (see ``get_columns()``), which is
+    then applied to each row.
+
     Args:
         profile_id: str. The identifier for a profile on the Portal. For example, use
           genetic_modificaiton for the profile https://www.encodeproject.org/profiles/genetic_modification.json.
         infile - str. Path to input file.
+        input_format: str. A key of ``encode_utils.readers.READERS``, i.e. 'tsv', 'jsonl' or
+          'parquet'. Detected from the content of the file when not set.
 
     Yields  : dict. The payload that can be used to either register or patch the metadata for each row.
     """
-    STR_REGX = reg = re.compile(r'\'|"')
-    profile = eup.Profile(profile_id)
+    for line_count, payload in iter_payloads(profile_id=profile_id, infile=infile,
+                                             input_format=input_format):
+        yield payload
+
+
+def iter_payloads(profile_id, infile, input_format=None):
+    """
+    Like ``create_payloads()``, but also provides the line number that each payload comes from.
+
+    Args:
+        profile_id: str. See ``create_payloads()``.
+        infile: str. See ``create_payloads()``.
+        input_format: str. See ``create_payloads()``.
+
+    Yields:
+        tuple: (line number, payload).
+    """
     # Fetch the schema from the ENCODE Portal so we can set attr values to the
     # right type when generating the  payload (dict).
-    schema = profile.get_profile()
-    schema_props = schema["properties"]
-    schema_props.update({RECORD_ID_FIELD: 1})  # Not an actual schema property.
-    field_index = {}
-    fh = open(infile, 'r')
-    header_fields = fh.readline().strip("\n").split("\t")
-    skip_field_indices = []
-    fi_count = -1  # field index count
-    for field in header_fields:
-        fi_count += 1
-        if field.startswith("#"):  # non-schema field
-            skip_field_indices.append(fi_count)
-            continue
-        if field not in schema_props:
-            raise Exception(
-                "Unknown field name '{}', which is not registered as a property in the specified schema at {}.".format(
-                    field, profile.profile_id))
-        field_index[fi_count] = field
+    profile = eup.Profile(profile_id)
+    profile_key = eu.PROFILE_KEY
+    with eureaders.get_reader(infile, input_format) as reader:
+        columns = get_columns(reader.header, profile)
+        for line_count, values in reader:
+            num_values = len(values)
+            payload = {}
+            payload[profile_key] = profile.profile_id
+            for fi_count, field, convert in columns:
+                if fi_count >= num_values:
+                    break
+                val = values[fi_count]
+                if not isinstance(val, str):
+                    # Already typed, i.e. in a JSON Lines or Parquet file.
+                    if val is not None:
+                        payload[field] = val
+                    continue
+                val = val.strip()
+                if not val:
+                    # Then skip. For ex., the biosample schema has a 'date_obtained' property, and if that is
+                    # empty it'll be treated as a formatting error, and the Portal will return a a 422.
+                    continue
+                payload[field] = convert(val, line_count)
+            yield line_count, payload
 
-    line_count = 1  # already read header line
-    for line in fh:
-        line_count += 1
-        line = line.strip("\n")
-        if not line.strip() or line[0].startswith("#"):
-            continue
-        line = line.split("\t")
-        payload = {}
-        payload[euc.Connection.PROFILE_KEY] = profile.profile_id
-        fi_count = -1
-        for val in line:
-            fi_count += 1
-            if fi_count in skip_field_indices:
-                continue
-            val = val.strip()
-            if not val:
-                # Then skip. For ex., the biosample schema has a 'date_obtained' property, and if that is
-                # empty it'll be treated as a formatting error, and the Portal will return a a 422.
-                continue
-            field = field_index[fi_count]
+
+def get_link_fields(profile):
+    """
+    Args:
+        profile: encode_utils.profiles.Profile. The profile that the records belong to.
+
+    Returns:
+        list: The names of the properties of the profile that link to other records, which are
+        those having the `linkTo` keyword in their schema or in the schema of their array items.
+    """
+    link_fields = []
+    for prop, prop_schema in profile.properties.items():
+        if "linkTo" in prop_schema or "linkTo" in prop_schema.get("items", {}):
+            link_fields.append(prop)
+    return link_fields
+
+
+def get_waves(rows, link_fields):
+    """
+    Groups rows into waves that can be submitted one after the other, where the rows within a wave
+    can be submitted concurrently. A row references another when one of its `link_fields` holds an
+    alias of the other row (with or without the ``encode_utils.LAB_PREFIX``). A row is placed in the
+    wave after the last wave holding a row that it references.
+
+    Args:
+        rows: iterable. Yields (line number, payload) tuples, i.e. ``iter_payloads()``.
+        link_fields: list. The names of the properties that reference other records, i.e.
+          ``get_link_fields()``.
+
+    Returns:
+        list: The waves, in order. Each wave is a list of (line number, payload, dependency line
+        numbers) tuples, in input order, where the dependency line numbers are those of the rows
+        that the row references.
+
+    Raises:
+        Exception: Some rows reference each other in a cycle.
+    """
+    rows = list(rows)
+    alias_lines = {}
+    for line, payload in rows:
+        for alias in payload.get(eu.ALIAS_PROP_NAME, []):
+            alias_lines[alias] = line
+
+    dependencies = {}
+    for line, payload in rows:
+        dependency_lines = set()
+        for field in link_fields:
+            values = payload.get(field, [])
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                dep_line = alias_lines.get(value) or alias_lines.get(eu.LAB_PREFIX + value)
+                if dep_line and dep_line != line:
+                    dependency_lines.add(dep_line)
+        dependencies[line] = dependency_lines
+
+    # Kahn's algorithm, one wave at a time.
+    dependents = collections.defaultdict(list)
+    num_pending = {}
+    for line, dependency_lines in dependencies.items():
+        num_pending[line] = len(dependency_lines)
+        for dep_line in dependency_lines:
+            dependents[dep_line].append(line)
+    wave_numbers = {}
+    ready = [line for line, payload in rows if not num_pending[line]]
+    wave_number = 0
+    while ready:
+        next_ready = []
+        for line in ready:
+            wave_numbers[line] = wave_number
+            for dependent in dependents[line]:
+                num_pending[dependent] -= 1
+                if not num_pending[dependent]:
+                    next_ready.append(dependent)
+        ready = next_ready
+        wave_number += 1
+    if len(wave_numbers) < len(rows):
+        raise Exception("The rows on lines {} reference each other in a cycle.".format(
+            ", ".join(str(line) for line, payload in rows if line not in wave_numbers)))
+
+    waves = [[] for i in range(wave_number)]
+    for line, payload in rows:
+        waves[wave_numbers[line]].append((line, payload, dependencies[line]))
+    DEBUG_LOGGER.debug("Scheduled {} rows in {} waves.".format(len(rows), len(waves)))
+    return waves
+
+
+#: Stores an error found by ``validate()``. `line` is the line number of the row in the input file,
+#: or ``HEADER_LINE`` for the errors of the field names, `field` the field name and `message` a
+#: description of the error.
+ValidationError = collections.namedtuple("ValidationError", ["line", "field", "message"])
+
+#: The `line` of the ``ValidationError`` objects that concern the field names rather than a row,
+#: since the field names of some formats don't come from a line of the file.
+HEADER_LINE = "header"
+
+
+def validate(profile_id, infile, patch=False, no_aliases=False, batch_size=10000,
+             input_format=None, counts=None):
+    """
+    Checks the input file against the profile, without any network I/O besides loading the profile.
+
+    The file is streamed in batches of rows, and each batch is checked one column at a time using
+    the converter of the column and the compiled check of the property (see
+    ``encode_utils.profiles.Profile.get_property_check()``). Since many columns hold the same few
+    values over and over (i.e. `lab` or `status`), the values that passed are remembered per column
+    and not checked again.
+
+    Args:
+        profile_id: str. See ``create_payloads()``.
+        infile: str. See ``create_payloads()``.
+        patch: bool. True means that the rows are to be PATCHED, in which case the RECORD_ID_FIELD
+          field is required and the profile's required properties aren't.
+        no_aliases: bool. See the --no-aliases option.
+        batch_size: int. The number of rows held in memory at once.
+        input_format: str. See ``create_payloads()``.
+        counts: dict. If given, the number of rows read is stored in it under the 'rows' key, once
+          the errors are all yielded.
+
+    Yields:
+        ValidationError: The errors, in the order of the columns within a batch, after those of the
+        rows of the batch that can't be read.
+    """
+    profile = eup.Profile(profile_id)
+    with eureaders.get_reader(infile, input_format) as reader:
+        try:
+            columns = get_columns(reader.header, profile)
+        except Exception as e:
+            yield ValidationError(line=HEADER_LINE, field=None, message=str(e))
+            return
+
+        fields = [field for fi_count, field, convert in columns]
+        for field in fields:
+            if field in profile.non_writable_props:
+                yield ValidationError(
+                    line=HEADER_LINE, field=field, message="Property isn't writable.")
+
+        required = set()
+        if patch:
+            required.add(RECORD_ID_FIELD)
+        else:
+            required.update(profile.required_properties())
+            if profile.profile_id not in eup.Profile.AWARDLESS_PROFILE_IDS:
+                # Defaults are taken from the environment when present.
+                required.difference_update(eu.AWARD)
+                required.difference_update(eu.LAB)
+            if not no_aliases and eu.ALIAS_PROP_NAME in profile.properties:
+                required.add(eu.ALIAS_PROP_NAME)
+        for field in sorted(required.difference(fields)):
+            yield ValidationError(
+                line=HEADER_LINE, field=field, message="Missing required field.")
+
+        checks = []
+        for fi_count, field, convert in columns:
             if field == RECORD_ID_FIELD:
-                payload[field] = val
-                continue
-            schema_val_type = schema_props[field]["type"]
-            if schema_val_type == "object":
-                # Must be proper JSON
-                val = check_valid_json(field, val, line_count)
-            elif schema_val_type == "array":
-                item_val_type = schema_props[field]["items"]["type"]
-                if item_val_type == "object":
-                    # Must be valid JSON
-                    # Check if user supplied optional JSON array literal. If not, I'll add it.
-                    if not val.startswith("["):
-                        val = "[" + val
-                    if not val.endswith("]"):
-                        val += "]"
-                    val = check_valid_json(field, val, line_count)
-                else:
-                    # User is allowed to enter values in string literals. I'll remove them if I find them,
-                    # since I'm splitting on the ',' to create a list of strings anyway:
-                    val = STR_REGX.sub("", val)
-                    # Remove optional JSON array literal since I'm tokenizing and then converting
-                    # to an array regardless.
-                    if val.startswith("["):
-                        val = val[1:]
-                    if val.endswith("]"):
-                        val = val[:-1]
-                    val = [x.strip() for x in val.split(",")]
-                    # Type cast tokens if need be, i.e. to integers:
-                    val = [typecast(value=x, value_type=item_val_type) for x in val]
+                check = None
             else:
-                val = typecast(value=val, value_type=schema_val_type)
-            payload[field] = val
-        yield payload
+                check = profile.get_property_check(field)
+            checks.append((fi_count, field, convert, check, field in required))
+
+        # The rows that can't be read are reported and skipped.
+        row_errors = []
+        rows = reader.iter_rows(on_error=row_errors.append)
+        num_rows = 0
+        while True:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    break
+            for error in row_errors:
+                yield ValidationError(line=error.line, field=None, message=error.message)
+            del row_errors[:]
+            if not batch:
+                break
+            num_rows += len(batch)
+            for fi_count, field, convert, check, is_required in checks:
+                valid_values = set()
+                for row_line, values in batch:
+                    val = values[fi_count] if fi_count < len(values) else None
+                    if isinstance(val, str):
+                        val = val.strip()
+                    if val is None or val == "":
+                        if is_required:
+                            yield ValidationError(
+                                line=row_line, field=field, message="Missing required value.")
+                        continue
+                    if not isinstance(val, str):
+                        # Already typed, i.e. in a JSON Lines or Parquet file.
+                        error = check and check(val)
+                        if error:
+                            yield ValidationError(line=row_line, field=field, message=error)
+                        continue
+                    if val in valid_values:
+                        continue
+                    try:
+                        error = check and check(convert(val, row_line))
+                    except ValueError as e:
+                        error = str(e)
+                    if error:
+                        yield ValidationError(line=row_line, field=field, message=error)
+                    else:
+                        valid_values.add(val)
+        if counts is not None:
+            counts["rows"] = num_rows
+
+
+def report_validation_errors(profile_id, infile, patch=False, no_aliases=False, input_format=None,
+                             counts=None):
+    """
+    Writes the errors found by ``validate()`` to STDOUT, one tab-delimited line per error, and
+    logs a summary.
+
+    Args:
+        profile_id: str. See ``validate()``.
+        infile: str. See ``validate()``.
+        patch: bool. See ``validate()``.
+        no_aliases: bool. See ``validate()``.
+        input_format: str. See ``validate()``.
+        counts: dict. See ``validate()``.
+
+    Returns:
+        int: The number of errors.
+    """
+    num_errors = 0
+    for error in validate(profile_id=profile_id, infile=infile, patch=patch, no_aliases=no_aliases,
+                          input_format=input_format, counts=counts):
+        num_errors += 1
+        print("{}\t{}\t{}".format(error.line, error.field or "", error.message))
+    if num_errors:
+        ERROR_LOGGER.error("Found {} errors in {}.".format(num_errors, infile))
+    else:
+        DEBUG_LOGGER.debug("No errors found in {}.".format(infile))
+    return num_errors
 
 
 if __name__ == "__main__":
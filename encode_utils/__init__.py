@@ -7,12 +7,15 @@
 ###
 
 """An API and scripts for submitting datasetss to the ENCODE Portal.
+
+Importing the package is kept cheap: the submodules (i.e. ``encode_utils.profiles``) are only
+imported when first accessed as attributes of the package or imported explicitly, and the logging
+is only set up once the first message is logged.
 """
 
-import os
-import json
+import importlib
 import logging
-import sys
+import os
 
 # see to it that only upper-case vars get exported
 package_path = __path__[0]
@@ -30,6 +33,16 @@ ALIAS_PROP_NAME = "aliases"
 #: The lab property name that is common to all ENCODE Portal object profiles.
 LAB_PROP_NAME = "lab"
 
+#: The non-schematic key of a payload that gives the profile to POST it to, i.e. 'file'. It is
+#: removed from the payload before submission. Same as
+#: ``encode_utils.connection.Connection.PROFILE_KEY``.
+PROFILE_KEY = "_profile"
+
+#: The non-schematic key of a payload that gives the record to PATCH, i.e. its accession. It is
+#: removed from the payload before submission. Same as
+#: ``encode_utils.connection.Connection.ENCID_KEY``.
+ENCID_KEY = "_enc_id"
+
 #: dict. Stores the lab property to the value of the environment variable `DCC_LAB` to serve as
 #: the default lab when submitting an object to the Portal.
 #: ``encode_utils.connection.Connection.post()`` will use this default if this property doesn't
@@ -60,20 +73,87 @@ try:
 except KeyError:
     pass
 
-#: THE ENCODE Portal URL that points to all the profiles (schemas).
-PROFILES_URL = "https://www.encodeproject.org/profiles/"
+#: THE ENCODE Portal URL that points to all the profiles (schemas). Can be overridden with the
+#: environment variable `EU_PROFILES_URL`, i.e. to point at a local stand-in for the Portal.
+PROFILES_URL = os.environ.get("EU_PROFILES_URL", "https://www.encodeproject.org/profiles/")
+
+#: str. The directory in which the profiles downloaded from the Portal are cached between runs,
+#: with one sub-directory per DCC host.  Defaults to `~/.encode_utils/profiles` and can be
+#: overridden with the environment variable `EU_PROFILES_CACHE_DIR`. Set that variable to the empty
+#: string to disable the on-disk cache, in which case the profiles are downloaded on each run.
+PROFILES_CACHE_DIR = os.environ.get(
+    "EU_PROFILES_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".encode_utils", "profiles"))
+
+#: int. The number of seconds for which the cached profiles are used as-is. After that, they are
+#: revalidated against the Portal by means of a conditional request. Can be overridden with the
+#: environment variable `EU_PROFILES_CACHE_TTL`.
+PROFILES_CACHE_TTL = int(os.environ.get("EU_PROFILES_CACHE_TTL", 24 * 60 * 60))
+
+#: list. The IDs of the profiles whose schemas are kept in memory when the profiles are downloaded
+#: without the on-disk cache, i.e. `biosample,file`. Of the other profiles, only the property names
+#: are kept, and the schema is downloaded again should it be needed. Empty means to keep all of
+#: them. Taken from the comma-delimited environment variable `EU_PROFILES_KEEP`.
+PROFILES_KEEP = [x.strip() for x in os.environ.get("EU_PROFILES_KEEP", "").split(",") if x.strip()]
+
+#: int. The largest total size in bytes of the records kept in memory by the record cache (see
+#: ``encode_utils.record_cache``). Taken from the environment variable
+#: `EU_RECORD_CACHE_MAX_BYTES`. Set that variable to 0 to disable the cache.
+RECORD_CACHE_MAX_BYTES = int(os.environ.get("EU_RECORD_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+#: float. The number of seconds for which a cached record is used without revalidating it against
+#: the Portal. Taken from the environment variable `EU_RECORD_CACHE_TTL`.
+RECORD_CACHE_TTL = float(os.environ.get("EU_RECORD_CACHE_TTL", 300))
+#: str. The directory in which the record cache also writes the records, so that they are kept
+#: between runs. Taken from the environment variable `EU_RECORD_CACHE_DIR`. Empty means to keep
+#: them in memory only.
+RECORD_CACHE_DIR = os.environ.get("EU_RECORD_CACHE_DIR", "")
+
+#: str. The path to the file caching the md5sums of local files, so that unchanged files are never
+#: hashed twice (see ``encode_utils.utils.Md5Cache``). Defaults to
+#: `~/.encode_utils/md5sums.jsonl` and can be overridden with the environment variable
+#: `EU_MD5_CACHE`. Set that variable to the empty string to disable the cache.
+MD5_CACHE_PATH = os.environ.get(
+    "EU_MD5_CACHE", os.path.join(os.path.expanduser("~"), ".encode_utils", "md5sums.jsonl"))
+
+#: str. The path to a profiles snapshot file written by
+#: ``encode_utils.profiles.export_profiles_snapshot()``. When set, the profiles are loaded from
+#: this file instead of from the Portal, which is useful on hosts without network access. Taken
+#: from the environment variable `EU_PROFILES_SNAPSHOT`.
+PROFILES_SNAPSHOT = os.environ.get("EU_PROFILES_SNAPSHOT", "")
+
+#: str. The endpoint of the S3 service that files are uploaded to by
+#: ``encode_utils.s3_upload.S3Upload``. Empty means AWS. Can be set to a local S3-compatible
+#: server for testing. Taken from the environment variable `EU_S3_ENDPOINT_URL`.
+S3_ENDPOINT_URL = os.environ.get("EU_S3_ENDPOINT_URL", "")
 
 DCC_DEV_MODE = "dev"
 DCC_PROD_MODE = "prod"
+#: The mode of a local stand-in for the Portal, such as the one run by ``encode_utils.mock_portal``.
+#: Its URL is taken from the environment variable `EU_LOCAL_DCC_URL`.
+DCC_LOCAL_MODE = "local"
+LOCAL_DCC_URL = os.environ.get("EU_LOCAL_DCC_URL", "http://127.0.0.1:8000")
 
 DCC_MODES = {
     DCC_DEV_MODE: {"host": "test.encodedcc.org", "url": "https://test.encodedcc.org"},
-    DCC_PROD_MODE: {"host": "www.encodeproject.org", "url": "https://www.encodeproject.org"}
+    DCC_PROD_MODE: {"host": "www.encodeproject.org", "url": "https://www.encodeproject.org"},
+    DCC_LOCAL_MODE: {"host": LOCAL_DCC_URL.split("://")[-1], "url": LOCAL_DCC_URL}
 }
 
 #: The timeout in seconds when making HTTP requests via the ``requests`` module.
 TIMEOUT = 20
 
+#: int. The default number of keep-alive connections per host of the HTTP session shared by the
+#: package (see ``encode_utils.sessions``). Taken from the environment variable
+#: `EU_HTTP_POOL_SIZE`.
+HTTP_POOL_SIZE = int(os.environ.get("EU_HTTP_POOL_SIZE", 10))
+#: int. The number of times that a failed idempotent HTTP request is retried (see
+#: ``encode_utils.sessions``). Taken from the environment variable `EU_HTTP_RETRIES`.
+HTTP_RETRIES = int(os.environ.get("EU_HTTP_RETRIES", 3))
+#: float. The largest number of requests per second sent to a Portal host (see
+#: ``encode_utils.throttle``); 0 means no limit. Taken from the environment variable
+#: `EU_RATE_LIMIT`.
+RATE_LIMIT = float(os.environ.get("EU_RATE_LIMIT", 0))
+
 #: The name of the debug ``logging`` instance.
 DEBUG_LOGGER_NAME = "debug"
 #: The name of the error ``logging`` instance created in ``encode_utils.connection.Connection()``,
@@ -83,14 +163,61 @@ ERROR_LOGGER_NAME = "error"
 #: and referenced elsewhere.
 POST_LOGGER_NAME = "post"
 
-#: A ``logging`` instance that logs all messages sent to it to STDOUT.
+#: str. The level of the messages that the debug logger writes to STDOUT. Taken from the
+#: environment variable `EU_LOG_LEVEL`, and defaults to DEBUG.
+LOG_LEVEL = os.environ.get("EU_LOG_LEVEL", "DEBUG")
+#: str. The format of the log messages: 'text', or 'json' for one JSON object per line. Taken from
+#: the environment variable `EU_LOG_FORMAT`.
+LOG_FORMAT = os.environ.get("EU_LOG_FORMAT", "text")
+#: The directory, relative to the calling directory, in which the log files are written.
+LOG_DIR = "EU_Logs"
+#: int. The size in bytes at which a log file is rotated; 0 means never. Taken from the environment
+#: variable `EU_LOG_MAX_BYTES`.
+LOG_MAX_BYTES = int(os.environ.get("EU_LOG_MAX_BYTES", 0))
+#: str. When set, the log files are rotated by time instead, i.e. 'midnight' or 'H' (see
+#: ``logging.handlers.TimedRotatingFileHandler``). Taken from the environment variable
+#: `EU_LOG_ROTATE_WHEN`.
+LOG_ROTATE_WHEN = os.environ.get("EU_LOG_ROTATE_WHEN", "")
+#: int. The number of rotated log files kept. Taken from the environment variable
+#: `EU_LOG_BACKUP_COUNT`.
+LOG_BACKUP_COUNT = int(os.environ.get("EU_LOG_BACKUP_COUNT", 5))
+
+#: The submodules that are imported on first access as attributes of the package, i.e.
+#: ``encode_utils.profiles`` after a mere ``import encode_utils``.
+SUBMODULES = ("async_connection", "connection", "journal", "logs", "metrics", "mock_portal",
+              "parent_argparser", "profiles", "profiling", "readers", "record_cache", "s3_upload",
+              "sessions", "throttle", "utils")
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+class _DeferredLoggingHandler(logging.Handler):
+    """
+    Stands in for the handlers of the debug logger until the first message is logged, at which
+    point it sets up the logging with ``encode_utils.logs.configure_logging()`` (unless that was
+    done already) and detaches itself. The handlers added by the set-up come after this one, so
+    that the first message is passed on to them by the logger as any other.
+    """
+
+    def emit(self, record):
+        logger = logging.getLogger(DEBUG_LOGGER_NAME)
+        if self not in logger.handlers:
+            return
+        import encode_utils.logs
+        if not encode_utils.logs.is_configured():
+            encode_utils.logs.configure_logging()
+        # Replace the list rather than modify it, since the logger may be iterating over it.
+        logger.handlers = [x for x in logger.handlers if x is not self]
+
+
+#: A ``logging`` instance that logs all messages sent to it to STDOUT, through the background
+#: thread of ``encode_utils.logs``.
 debug_logger = logging.getLogger(DEBUG_LOGGER_NAME)
-level = logging.DEBUG
-debug_logger.setLevel(level)
-f_formatter = logging.Formatter('%(asctime)s:%(name)s:\t%(message)s')
-ch = logging.StreamHandler(stream=sys.stdout)
-ch.setLevel(level)
-ch.setFormatter(f_formatter)
-debug_logger.addHandler(ch)
+debug_logger.setLevel(LOG_LEVEL.upper())
+debug_logger.addHandler(_DeferredLoggingHandler())
 
 del package_path
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains an ``AsyncConnection`` class for talking to the ENCODE Portal from asyncio code. It
+mirrors the main methods of ``encode_utils.connection.Connection``, but each of them is a
+coroutine, so that a single process can keep many requests in flight at once.
+
+This module requires the optional `aiohttp` package, which can be installed along with this
+package via ``pip install encode-utils[async]``.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import encode_utils as eu
+import encode_utils.logs as eulogs
+import encode_utils.metrics as eumetrics
+import encode_utils.record_cache as eurc
+import encode_utils.throttle as euthrottle
+import encode_utils.utils as euu
+import encode_utils.profiles as eup
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+#: An error ``logging`` instance.
+ERROR_LOGGER = logging.getLogger(eu.ERROR_LOGGER_NAME + "." + __name__)
+#: A ``logging`` instance for the records that are successfully POSTED.
+POST_LOGGER = logging.getLogger(eu.POST_LOGGER_NAME + "." + __name__)
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "The aiohttp package is required for encode_utils.async_connection. "
+            "Install it with 'pip install aiohttp'.")
+    return aiohttp
+
+
+class AsyncConnection:
+    """
+    Handles communication with the Portal from asyncio code. Payloads use the same conventions as
+    those of ``encode_utils.connection.Connection``, i.e. the ``PROFILE_KEY`` and ``ENCID_KEY``
+    keys.
+
+    The underlying HTTP session is created on first use, and should be closed with
+    ``self.close()``, or by using the instance as an asynchronous context manager::
+
+      async with AsyncConnection("dev") as conn:
+          rec = await conn.get("ENCSR161EAA")
+
+    Args:
+        dcc_mode: `str`. The ENCODE Portal site ('prod' or 'dev', or a custom host name) to connect
+          to. Defaults to the value of the environment variable `DCC_MODE`.
+        dry_run: `bool`. Set to `True` to log the POST, PATCH and upload requests instead of
+          sending them.
+        limit: `int`. The maximum number of connections open at once to the Portal.
+        upload_pipeline: `encode_utils.s3_upload.UploadPipeline`. If set, the local files of the
+          file records that are POSTED are queued for upload in it, instead of being uploaded with
+          the AWS CLI before ``self.post()`` returns. The caller is then responsible for closing the
+          pipeline and checking for failed uploads.
+        throttle: `encode_utils.throttle.Throttle`. Paces the requests, adapting the number in
+          flight (up to `limit`) to the load of the Portal, and retries those rejected for
+          overload. Defaults to one with the default settings.
+        record_cache: `encode_utils.record_cache.RecordCache`. Caches the records GOTTEN by
+          ``self.get()``. Defaults to the one shared by the package (see
+          ``encode_utils.record_cache.get_record_cache()``).
+    """
+    #: Same as ``encode_utils.PROFILE_KEY``.
+    PROFILE_KEY = eu.PROFILE_KEY
+    #: Same as ``encode_utils.ENCID_KEY``.
+    ENCID_KEY = eu.ENCID_KEY
+    #: The statuses of a file record whose file hasn't been fully uploaded.
+    INCOMPLETE_UPLOAD_STATUSES = ("uploading", "upload failed")
+
+    def __init__(self, dcc_mode=None, dry_run=False, limit=100, upload_pipeline=None,
+                 throttle=None, record_cache=None):
+        if not dcc_mode:
+            try:
+                dcc_mode = os.environ["DCC_MODE"]
+            except KeyError:
+                raise Exception(
+                    "You must supply the dcc_mode argument or set the environment variable DCC_MODE.")
+        if dcc_mode in eu.DCC_MODES:
+            host = eu.DCC_MODES[dcc_mode]["host"]
+            url = eu.DCC_MODES[dcc_mode]["url"]
+        else:
+            host = dcc_mode
+            url = "https://" + dcc_mode
+        #: The host name of the Portal.
+        self.dcc_host = host
+        #: The URL of the Portal.
+        self.dcc_url = url
+        self.dry_run = dry_run
+        self.limit = limit
+        self.upload_pipeline = upload_pipeline
+        self.throttle = throttle or euthrottle.Throttle(host, max_concurrency=limit)
+        self.record_cache = record_cache if record_cache is not None else eurc.get_record_cache()
+        # Same log files as those of encode_utils.connection.Connection.
+        eulogs.add_dcc_log_files(dcc_mode)
+        self.auth = (os.environ.get("DCC_API_KEY"), os.environ.get("DCC_SECRET_KEY"))
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None:
+            aiohttp = _import_aiohttp()
+            auth = None
+            if all(self.auth):
+                auth = aiohttp.BasicAuth(*self.auth)
+            self._session = aiohttp.ClientSession(
+                auth=auth,
+                headers=euu.REQUEST_HEADERS_JSON,
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=eu.TIMEOUT))
+        return self._session
+
+    async def close(self):
+        """Closes the underlying HTTP session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, url, payload=None, op=None):
+        """
+        Sends a request with ``self._send()`` and decodes the JSON response.
+
+        Returns:
+            `tuple`: The HTTP status code and the decoded JSON response.
+        """
+        data = None
+        if payload is not None:
+            data = json.dumps(payload)
+        status, headers, text = await self._send(method, url, data, op)
+        return status, self._decode(text)
+
+    @staticmethod
+    def _decode(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {}
+
+    async def _send(self, method, url, data=None, op=None, headers=None):
+        """
+        Sends a request through ``self.throttle``. The latency of each attempt is recorded in
+        ``encode_utils.metrics.METRICS`` under the operation `op`, which defaults to the
+        lower-cased method, and counted as an error if the request fails or gets an error status
+        other than 404 and 409, which are normal outcomes of lookups and POSTS.
+
+        Returns:
+            `tuple`: The HTTP status code, the headers and the text of the response.
+        """
+        aiohttp = _import_aiohttp()
+        attempt = 0
+        while True:
+            await self.throttle.acquire_async()
+            start = time.perf_counter()
+            status = None
+            retry_after = None
+            error = None
+            try:
+                async with self._get_session().request(method, url, data=data,
+                                                       headers=headers) as response:
+                    status = response.status
+                    response_headers = response.headers
+                    retry_after = response_headers.get("Retry-After")
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                latency = time.perf_counter() - start
+                eumetrics.METRICS.observe(op or method.lower(), latency,
+                                          error=status is None or (
+                                              status >= 400 and status not in (404, 409)))
+                self.throttle.release(latency, status, failed=status is None)
+            delay = None
+            if error or status >= 400:
+                delay = self.throttle.get_retry_delay(method, attempt, status, retry_after)
+            if delay is None:
+                if error:
+                    raise error
+                break
+            DEBUG_LOGGER.debug("{} {} failed with {}; retrying in {:.1f}s.".format(
+                method, url, status or type(error).__name__, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+        return status, response_headers, text
+
+    def _raise_for_status(self, method, url, status, response_json):
+        if status >= 400:
+            message = "{} {} failed with status {}: {}".format(method, url, status, response_json)
+            ERROR_LOGGER.error(message)
+            raise Exception(message)
+
+    async def get(self, rec_id, ignore404=True, frame=None, revalidate=False):
+        """
+        GETs a record from the Portal, going through ``self.record_cache``: a record GOTTEN
+        recently is returned from the cache, and an older one is only transferred again if it
+        changed.
+
+        Args:
+            rec_id: `str`. An identifier of the record, i.e. an accession, UUID or alias.
+            ignore404: `bool`. Only has meaning when the record doesn't exist. `True` means to
+              return an empty `dict`; otherwise an exception is raised.
+            frame: `str`. The value of the `frame` query parameter, i.e. 'edit'.
+            revalidate: `bool`. `True` means to check a cached record with the Portal even when
+              it's fresh, i.e. before a read-modify-write.
+
+        Returns:
+            `dict`: The JSON serialization of the record.
+        """
+        url = "{}/{}/?format=json&datastore=database".format(
+            self.dcc_url, urllib.parse.quote(rec_id.strip("/"), safe="/:"))
+        if frame:
+            url += "&frame=" + frame
+        cached = None
+        headers = None
+        generation = None
+        if self.record_cache is not None:
+            generation = self.record_cache.get_generation()
+            cached = self.record_cache.lookup(self.dcc_host, rec_id, frame)
+            if cached and cached.fresh and not revalidate:
+                return json.loads(cached.text)
+            if cached and cached.etag:
+                headers = {"If-None-Match": cached.etag}
+        DEBUG_LOGGER.debug(">>>>>>GETTING {} From DCC with URL {}".format(rec_id, url))
+        status, response_headers, text = await self._send("GET", url, headers=headers)
+        if status == 304 and cached:
+            self.record_cache.revalidated(self.dcc_host, rec_id, frame)
+            return json.loads(cached.text)
+        response_json = self._decode(text)
+        if status == 404 and ignore404:
+            return {}
+        self._raise_for_status("GET", url, status, response_json)
+        if self.record_cache is not None:
+            self.record_cache.store(self.dcc_host, rec_id, frame, text,
+                                    response_headers.get("ETag"), response_json, generation)
+        return response_json
+
+    def _invalidate(self, rec_id, record=None):
+        # Drops the cached frames of a record that was just written to.
+        if self.record_cache is not None:
+            rec_ids = {rec_id}
+            if record:
+                rec_ids.update(eurc.get_record_ids(record))
+            self.record_cache.invalidate(self.dcc_host, rec_ids)
+
+    async def search(self, query):
+        """
+        Searches the Portal.
+
+        Args:
+            query: `list`. The query parameters as (parameter, value) tuples, which will be URL
+              encoded, i.e. ``[("type", "Biosample"), ("aliases", "lab:b1")]``.
+
+        Returns:
+            `list`: The matching records.
+        """
+        url = "{}/search/?{}&format=json&limit=all".format(
+            self.dcc_url, urllib.parse.urlencode(query, doseq=True))
+        DEBUG_LOGGER.debug("Searching DCC with query {}.".format(url))
+        status, response_json = await self._request("GET", url, op=eumetrics.OP_SEARCH)
+        if status == 404:
+            # The Portal answers a search without results with a 404.
+            return []
+        self._raise_for_status("GET", url, status, response_json)
+        return response_json["@graph"]
+
+    async def get_profiles(self):
+        """
+        Fetches the profiles of the Portal.
+
+        Returns:
+            `dict`: Same format as the return value of ``encode_utils.profiles.get_profiles()``.
+        """
+        url = self.dcc_url + "/profiles/?format=json"
+        status, response_json = await self._request("GET", url, op=eumetrics.OP_PROFILE_LOAD)
+        self._raise_for_status("GET", url, status, response_json)
+        return eup._format_profiles(response_json)
+
+    async def post(self, payload, require_aliases=True):
+        """
+        POSTS a new record to the Portal. The profile to POST to is given by the ``PROFILE_KEY``
+        key of the payload. As with ``encode_utils.connection.Connection.post()``, the `award` and
+        `lab` properties default to ``encode_utils.AWARD`` and ``encode_utils.LAB``, and when
+        POSTING a file record, the md5sum is calculated if missing and the file is uploaded to AWS
+        S3 afterwards (or queued for upload, see the `upload_pipeline` argument of the constructor).
+
+        Args:
+            payload: `dict`. The record to POST.
+            require_aliases: `bool`. `True` means to refuse to POST a record that lacks aliases
+              under a profile that supports them.
+
+        Returns:
+            `dict`: The JSON serialization of the new record, or of the existing record should the
+            Portal report a conflict.
+
+        Raises:
+            Exception: The payload lacks the ``PROFILE_KEY`` key, or aliases when required.
+        """
+        payload = dict(payload)
+        try:
+            profile_id = payload.pop(self.PROFILE_KEY)
+        except KeyError:
+            raise Exception("Payload is missing the '{}' key.".format(self.PROFILE_KEY))
+        profile = eup.Profile(profile_id)
+        profile_id = profile.profile_id
+        if profile_id not in eup.Profile.AWARDLESS_PROFILE_IDS:
+            if eu.AWARD_PROP_NAME not in payload:
+                payload.update(eu.AWARD)
+            if eu.LAB_PROP_NAME not in payload:
+                payload.update(eu.LAB)
+        if require_aliases and profile_id not in eup.Profile.NO_ALIAS_PROFILE_IDS:
+            if not payload.get(eu.ALIAS_PROP_NAME):
+                raise Exception("Missing property '{}' in payload {}.".format(
+                    eu.ALIAS_PROP_NAME, payload))
+
+        file_path = None
+        if profile_id == eup.Profile.FILE_PROFILE_ID:
+            file_path = payload.get(eup.Profile.SUBMITTED_FILE_PROP_NAME)
+            if file_path and not file_path.startswith("s3://"):
+                if eup.Profile.MD5SUM_NAME_PROP_NAME not in payload:
+                    loop = asyncio.get_running_loop()
+                    payload[eup.Profile.MD5SUM_NAME_PROP_NAME] = await loop.run_in_executor(
+                        None, euu.get_md5sum, file_path)
+                payload[eup.Profile.SUBMITTED_FILE_PROP_NAME] = os.path.basename(file_path)
+
+        url = "{}/{}/".format(self.dcc_url, profile_id)
+        alias = payload.get(eu.ALIAS_PROP_NAME, [""])[0]
+        DEBUG_LOGGER.debug("<<<<<< POSTING {} To DCC with URL {}".format(alias, url))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping POST.")
+            return {}
+        status, response_json = await self._request("POST", url, payload)
+        if status == 409 and alias:
+            DEBUG_LOGGER.debug("Will not POST {} since it already exists.".format(alias))
+            record = await self.get(alias)
+            if (file_path and self.upload_pipeline and not file_path.startswith("s3://")
+                    and record.get("status") in self.INCOMPLETE_UPLOAD_STATUSES):
+                # The upload of a prior run didn't complete, i.e. when resuming.
+                await self._queue_upload(record, file_path)
+            return record
+        self._raise_for_status("POST", url, status, response_json)
+        record = response_json["@graph"][0]
+        self._invalidate(record["@id"], record)
+        POST_LOGGER.info("Successfully POSTED {} {}: {}".format(
+            profile_id, alias, record.get("accession", record.get("uuid"))))
+        if file_path:
+            if self.upload_pipeline and not file_path.startswith("s3://"):
+                await self._queue_upload(record, file_path)
+            else:
+                await self.upload_file(record, file_path)
+        return record
+
+    async def _queue_upload(self, file_record, file_path):
+        creds = file_record.get("upload_credentials")
+        if not creds:
+            creds = await self.get_upload_credentials(file_record["@id"])
+        self.upload_pipeline.submit(file_path, creds["upload_url"], creds)
+
+    async def patch(self, payload, extend_array_values=True):
+        """
+        PATCHES a record on the Portal. The record is given by the ``ENCID_KEY`` key of the
+        payload.
+
+        Args:
+            payload: `dict`. The properties to PATCH.
+            extend_array_values: `bool`. `True` means that array values in the payload extend the
+              corresponding arrays of the record (with duplicates removed), rather than replace
+              them.
+
+        Returns:
+            `dict`: The JSON serialization of the PATCHED record.
+        """
+        payload = dict(payload)
+        try:
+            rec_id = payload.pop(self.ENCID_KEY)
+        except KeyError:
+            raise Exception("Payload is missing the '{}' key.".format(self.ENCID_KEY))
+        if extend_array_values:
+            # Revalidated, since extending arrays from an outdated copy would drop the items
+            # added to them since.
+            rec_json = await self.get(rec_id, ignore404=False, frame="edit", revalidate=True)
+            for key, val in payload.items():
+                if isinstance(val, list) and key in rec_json:
+                    extended = []
+                    for item in rec_json[key] + val:
+                        if item not in extended:
+                            extended.append(item)
+                    payload[key] = extended
+        url = "{}/{}".format(self.dcc_url, rec_id.strip("/"))
+        DEBUG_LOGGER.debug("<<<<<< PATCHING {} To DCC with URL {}".format(rec_id, url))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping PATCH.")
+            return {}
+        status, response_json = await self._request("PATCH", url, payload)
+        # Whatever the outcome, the record may have changed.
+        self._invalidate(rec_id, (response_json.get("@graph") or [None])[0])
+        self._raise_for_status("PATCH", url, status, response_json)
+        return response_json["@graph"][0]
+
+    async def get_upload_credentials(self, file_id):
+        """
+        Requests new AWS S3 upload credentials for a file record.
+
+        Args:
+            file_id: `str`. An identifier of the file record.
+
+        Returns:
+            `dict`: The upload credentials.
+        """
+        url = "{}/{}/@@upload".format(self.dcc_url, file_id.strip("/"))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping request for upload credentials.")
+            return {}
+        status, response_json = await self._request("POST", url, {}, op="upload_credentials")
+        # New credentials change the record.
+        self._invalidate(file_id)
+        self._raise_for_status("POST", url, status, response_json)
+        return response_json["@graph"][0]["upload_credentials"]
+
+    async def upload_file(self, file_record, file_path):
+        """
+        Uploads a file to AWS S3 by means of the AWS CLI, using the upload credentials of the file
+        record.  The upload runs in a subprocess, so it doesn't block the event loop.
+
+        Args:
+            file_record: `dict`. The JSON serialization of the file record, as returned by the POST.
+            file_path: `str`. The local path or S3 URI of the file to upload.
+
+        Raises:
+            Exception: The upload failed.
+        """
+        creds = file_record.get("upload_credentials")
+        if not creds:
+            creds = await self.get_upload_credentials(file_record["@id"])
+        env = dict(os.environ)
+        env.update({
+            "AWS_ACCESS_KEY_ID": creds["access_key"],
+            "AWS_SECRET_ACCESS_KEY": creds["secret_key"],
+            "AWS_SECURITY_TOKEN": creds["session_token"],
+            "AWS_SESSION_TOKEN": creds["session_token"]
+        })
+        DEBUG_LOGGER.debug("Uploading file {} to {}.".format(file_path, creds["upload_url"]))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping upload.")
+            return
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            "aws", "s3", "cp", file_path, creds["upload_url"], "--quiet",
+            env=env, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        eumetrics.METRICS.observe(eumetrics.OP_UPLOAD, time.perf_counter() - start,
+                                  error=bool(process.returncode))
+        if process.returncode:
+            message = "Failed to upload {}: {}".format(file_path, stderr.decode().strip())
+            ERROR_LOGGER.error(message)
+            raise Exception(message)
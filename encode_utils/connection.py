@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains a ``Connection`` class for talking to the ENCODE Portal, i.e. to GET, search, POST and
+PATCH records, and to upload the files of file records to AWS S3.
+"""
+
+import base64
+import json
+import logging
+import mimetypes
+import os
+import subprocess
+import time
+import urllib.parse
+
+import encode_utils as eu
+import encode_utils.logs as eulogs
+import encode_utils.metrics as eumetrics
+import encode_utils.record_cache as eurc
+import encode_utils.sessions as eusessions
+import encode_utils.utils as euu
+import encode_utils.profiles as eup
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+#: An error ``logging`` instance.
+ERROR_LOGGER = logging.getLogger(eu.ERROR_LOGGER_NAME + "." + __name__)
+#: A ``logging`` instance for the records that are successfully POSTED.
+POST_LOGGER = logging.getLogger(eu.POST_LOGGER_NAME + "." + __name__)
+
+
+class Connection:
+    """
+    Handles communication with the Portal regarding data submission and retrieval.
+
+    Payloads to POST give the profile of the new record in the ``PROFILE_KEY`` key, and payloads
+    to PATCH give the record to PATCH in the ``ENCID_KEY`` key. Both keys are removed from the
+    payload before it's sent.
+
+    The `attachment` property of a payload, i.e. in the `document` profile, can be given as a
+    single-key object of the form ``{"path": "/path/to/myfile"}``, in which case the `attachment`
+    object is built from the file before the payload is sent.
+
+    The instance can be shared by several threads.
+
+    Args:
+        dcc_mode: `str`. The ENCODE Portal site ('prod' or 'dev', or a custom host name) to connect
+          to. Defaults to the value of the environment variable `DCC_MODE`.
+        dry_run: `bool`. Set to `True` to log the POST, PATCH and upload requests instead of
+          sending them.
+        record_cache: `encode_utils.record_cache.RecordCache`. Caches the records GOTTEN by
+          ``self.get()``. Defaults to the one shared by the package (see
+          ``encode_utils.record_cache.get_record_cache()``).
+    """
+    #: Same as ``encode_utils.PROFILE_KEY``.
+    PROFILE_KEY = eu.PROFILE_KEY
+    #: Same as ``encode_utils.ENCID_KEY``.
+    ENCID_KEY = eu.ENCID_KEY
+    #: The name of the property that holds an attachment, i.e. in the `document` profile.
+    ATTACHMENT_PROP_NAME = "attachment"
+
+    def __init__(self, dcc_mode=None, dry_run=False, record_cache=None):
+        if not dcc_mode:
+            try:
+                dcc_mode = os.environ["DCC_MODE"]
+            except KeyError:
+                raise Exception(
+                    "You must supply the dcc_mode argument or set the environment variable DCC_MODE.")
+        if dcc_mode in eu.DCC_MODES:
+            host = eu.DCC_MODES[dcc_mode]["host"]
+            url = eu.DCC_MODES[dcc_mode]["url"]
+        else:
+            host = dcc_mode
+            url = "https://" + dcc_mode
+        #: The host name of the Portal.
+        self.dcc_host = host
+        #: The URL of the Portal.
+        self.dcc_url = url
+        self.dry_run = dry_run
+        self.record_cache = record_cache if record_cache is not None else eurc.get_record_cache()
+        eulogs.add_dcc_log_files(dcc_mode)
+        self.auth = (os.environ.get("DCC_API_KEY"), os.environ.get("DCC_SECRET_KEY"))
+
+    @property
+    def session(self):
+        """
+        The ``requests.Session`` shared by the package (see
+        ``encode_utils.sessions.get_session()``), whose connections are kept alive between
+        requests. The credentials are sent with each request rather than set on the session.
+        """
+        return eusessions.get_session()
+
+    def _request(self, method, url, payload=None, op=None, headers=None):
+        """
+        Sends a request to the Portal. The latency of the request is recorded in
+        ``encode_utils.metrics.METRICS`` under the operation `op`, which defaults to the lower-cased
+        method, and counted as an error if the request fails or gets an error status other than
+        404 and 409, which are normal outcomes of lookups and POSTS.
+
+        Args:
+            headers: `dict`. Headers to send besides ``encode_utils.utils.REQUEST_HEADERS_JSON``.
+
+        Returns:
+            `requests.Response`.
+        """
+        data = None
+        if payload is not None:
+            data = json.dumps(payload)
+        if headers:
+            headers = dict(euu.REQUEST_HEADERS_JSON, **headers)
+        start = time.perf_counter()
+        status = None
+        try:
+            response = self.session.request(
+                method, url, data=data, timeout=eu.TIMEOUT,
+                headers=headers or euu.REQUEST_HEADERS_JSON,
+                auth=self.auth if all(self.auth) else None)
+            status = response.status_code
+        finally:
+            eumetrics.METRICS.observe(op or method.lower(), time.perf_counter() - start,
+                                      error=status is None or (
+                                          status >= 400 and status not in (404, 409)))
+        return response
+
+    def _raise_for_status(self, method, url, response):
+        """
+        Logs and raises a ``requests.HTTPError`` if the response has an error status.
+        """
+        if response.status_code >= 400:
+            ERROR_LOGGER.error("{} {} failed with status {}: {}".format(
+                method, url, response.status_code, response.text))
+            response.raise_for_status()
+
+    def get(self, rec_id, ignore404=True, frame=None, revalidate=False):
+        """
+        GETs a record from the Portal, going through ``self.record_cache``: a record GOTTEN
+        recently is returned from the cache, and an older one is only transferred again if it
+        changed.
+
+        Args:
+            rec_id: `str`. An identifier of the record, i.e. an accession, UUID or alias.
+            ignore404: `bool`. Only has meaning when the record doesn't exist. `True` means to
+              return an empty `dict`; otherwise a ``requests.HTTPError`` is raised.
+            frame: `str`. The value of the `frame` query parameter, i.e. 'edit'.
+            revalidate: `bool`. `True` means to check a cached record with the Portal even when
+              it's fresh, i.e. before a read-modify-write.
+
+        Returns:
+            `dict`: The JSON serialization of the record.
+        """
+        url = "{}/{}/?format=json&datastore=database".format(
+            self.dcc_url, urllib.parse.quote(rec_id.strip("/"), safe="/:"))
+        if frame:
+            url += "&frame=" + frame
+        cached = None
+        headers = None
+        generation = None
+        if self.record_cache is not None:
+            generation = self.record_cache.get_generation()
+            cached = self.record_cache.lookup(self.dcc_host, rec_id, frame)
+            if cached and cached.fresh and not revalidate:
+                return json.loads(cached.text)
+            if cached and cached.etag:
+                headers = {"If-None-Match": cached.etag}
+        DEBUG_LOGGER.debug(">>>>>>GETTING {} From DCC with URL {}".format(rec_id, url))
+        response = self._request("GET", url, headers=headers)
+        if response.status_code == 304 and cached:
+            self.record_cache.revalidated(self.dcc_host, rec_id, frame)
+            return json.loads(cached.text)
+        if response.status_code == 404 and ignore404:
+            return {}
+        self._raise_for_status("GET", url, response)
+        record = response.json()
+        if self.record_cache is not None:
+            self.record_cache.store(self.dcc_host, rec_id, frame, response.text,
+                                    response.headers.get("ETag"), record, generation)
+        return record
+
+    def _invalidate(self, rec_id, record=None):
+        # Drops the cached frames of a record that was just written to.
+        if self.record_cache is not None:
+            rec_ids = {rec_id}
+            if record:
+                rec_ids.update(eurc.get_record_ids(record))
+            self.record_cache.invalidate(self.dcc_host, rec_ids)
+
+    def search(self, query):
+        """
+        Searches the Portal.
+
+        Args:
+            query: `list`. The query parameters as (parameter, value) tuples, which will be URL
+              encoded, i.e. ``[("type", "Biosample"), ("aliases", "lab:b1")]``.
+
+        Returns:
+            `list`: The matching records.
+        """
+        url = "{}/search/?{}&format=json&limit=all".format(
+            self.dcc_url, urllib.parse.urlencode(query, doseq=True))
+        DEBUG_LOGGER.debug("Searching DCC with query {}.".format(url))
+        response = self._request("GET", url, op=eumetrics.OP_SEARCH)
+        if response.status_code == 404:
+            # The Portal answers a search without results with a 404.
+            return []
+        self._raise_for_status("GET", url, response)
+        return response.json()["@graph"]
+
+    def set_attachment(self, payload):
+        """
+        Builds the `attachment` object of a payload whose attachment is given as
+        ``{"path": "/path/to/myfile"}``, by embedding the file as a data URI. Other payloads are
+        left unchanged.
+
+        Args:
+            payload: `dict`. The payload, which is modified in place.
+        """
+        attachment = payload.get(self.ATTACHMENT_PROP_NAME)
+        if not isinstance(attachment, dict) or list(attachment) != ["path"]:
+            return
+        path = os.path.expanduser(attachment["path"])
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        with open(path, "rb") as fh:
+            data = base64.b64encode(fh.read()).decode("ascii")
+        payload[self.ATTACHMENT_PROP_NAME] = {
+            "download": os.path.basename(path),
+            "type": mime_type,
+            "href": "data:{};base64,{}".format(mime_type, data)
+        }
+
+    def post(self, payload, require_aliases=True):
+        """
+        POSTS a new record to the Portal. The profile to POST to is given by the ``PROFILE_KEY``
+        key of the payload. The `award` and `lab` properties default to ``encode_utils.AWARD`` and
+        ``encode_utils.LAB``. When POSTING a file record, the md5sum is calculated if missing,
+        `submitted_file_name` is reduced to the file's name, and the file is uploaded to AWS S3
+        afterwards.
+
+        Args:
+            payload: `dict`. The record to POST.
+            require_aliases: `bool`. `True` means to refuse to POST a record that lacks aliases
+              under a profile that supports them.
+
+        Returns:
+            `dict`: The JSON serialization of the new record, or of the existing record should the
+            Portal report a conflict. Empty in dry-run mode.
+
+        Raises:
+            Exception: The payload lacks the ``PROFILE_KEY`` key, or aliases when required.
+            requests.HTTPError: The Portal refused the POST.
+        """
+        payload = dict(payload)
+        try:
+            profile_id = payload.pop(self.PROFILE_KEY)
+        except KeyError:
+            raise Exception("Payload is missing the '{}' key.".format(self.PROFILE_KEY))
+        profile = eup.Profile(profile_id)
+        profile_id = profile.profile_id
+        if profile_id not in eup.Profile.AWARDLESS_PROFILE_IDS:
+            if eu.AWARD_PROP_NAME not in payload:
+                payload.update(eu.AWARD)
+            if eu.LAB_PROP_NAME not in payload:
+                payload.update(eu.LAB)
+        if require_aliases and profile_id not in eup.Profile.NO_ALIAS_PROFILE_IDS:
+            if not payload.get(eu.ALIAS_PROP_NAME):
+                raise Exception("Missing property '{}' in payload {}.".format(
+                    eu.ALIAS_PROP_NAME, payload))
+        self.set_attachment(payload)
+
+        file_path = None
+        if profile_id == eup.Profile.FILE_PROFILE_ID:
+            file_path = payload.get(eup.Profile.SUBMITTED_FILE_PROP_NAME)
+            if file_path and not file_path.startswith("s3://"):
+                if eup.Profile.MD5SUM_NAME_PROP_NAME not in payload:
+                    payload[eup.Profile.MD5SUM_NAME_PROP_NAME] = euu.get_md5sum(file_path)
+                payload[eup.Profile.SUBMITTED_FILE_PROP_NAME] = os.path.basename(file_path)
+
+        url = "{}/{}/".format(self.dcc_url, profile_id)
+        alias = payload.get(eu.ALIAS_PROP_NAME, [""])[0]
+        DEBUG_LOGGER.debug("<<<<<< POSTING {} To DCC with URL {}".format(alias, url))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping POST.")
+            return {}
+        response = self._request("POST", url, payload)
+        if response.status_code == 409 and alias:
+            DEBUG_LOGGER.debug("Will not POST {} since it already exists.".format(alias))
+            return self.get(alias, ignore404=False)
+        self._raise_for_status("POST", url, response)
+        record = response.json()["@graph"][0]
+        self._invalidate(record["@id"], record)
+        POST_LOGGER.info("Successfully POSTED {} {}: {}".format(
+            profile_id, alias, record.get("accession", record.get("uuid"))))
+        if file_path:
+            self.upload_file(record, file_path)
+        return record
+
+    def patch(self, payload, extend_array_values=True):
+        """
+        PATCHES a record on the Portal. The record is given by the ``ENCID_KEY`` key of the
+        payload.
+
+        Args:
+            payload: `dict`. The properties to PATCH.
+            extend_array_values: `bool`. `True` means that array values in the payload extend the
+              corresponding arrays of the record (with duplicates removed), rather than replace
+              them.
+
+        Returns:
+            `dict`: The JSON serialization of the PATCHED record. Empty in dry-run mode.
+
+        Raises:
+            Exception: The payload lacks the ``ENCID_KEY`` key.
+            requests.HTTPError: The Portal refused the PATCH.
+        """
+        payload = dict(payload)
+        try:
+            rec_id = payload.pop(self.ENCID_KEY)
+        except KeyError:
+            raise Exception("Payload is missing the '{}' key.".format(self.ENCID_KEY))
+        self.set_attachment(payload)
+        if extend_array_values:
+            # Revalidated, since extending arrays from an outdated copy would drop the items
+            # added to them since.
+            rec_json = self.get(rec_id, ignore404=False, frame="edit", revalidate=True)
+            for key, val in payload.items():
+                if isinstance(val, list) and key in rec_json:
+                    extended = []
+                    for item in rec_json[key] + val:
+                        if item not in extended:
+                            extended.append(item)
+                    payload[key] = extended
+        url = "{}/{}".format(self.dcc_url, rec_id.strip("/"))
+        DEBUG_LOGGER.debug("<<<<<< PATCHING {} To DCC with URL {}".format(rec_id, url))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping PATCH.")
+            return {}
+        response = self._request("PATCH", url, payload)
+        # Whatever the outcome, the record may have changed.
+        record = None
+        if response.status_code < 400:
+            record = response.json()["@graph"][0]
+        self._invalidate(rec_id, record)
+        self._raise_for_status("PATCH", url, response)
+        return record
+
+    def get_upload_credentials(self, file_id):
+        """
+        Requests new AWS S3 upload credentials for a file record.
+
+        Args:
+            file_id: `str`. An identifier of the file record.
+
+        Returns:
+            `dict`: The upload credentials. Empty in dry-run mode.
+        """
+        url = "{}/{}/@@upload".format(self.dcc_url, file_id.strip("/"))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping request for upload credentials.")
+            return {}
+        response = self._request("POST", url, {}, op="upload_credentials")
+        # New credentials change the record.
+        self._invalidate(file_id)
+        self._raise_for_status("POST", url, response)
+        return response.json()["@graph"][0]["upload_credentials"]
+
+    def upload_file(self, file_record, file_path):
+        """
+        Uploads a file to AWS S3 by means of the AWS CLI, using the upload credentials of the file
+        record.
+
+        Args:
+            file_record: `dict`. The JSON serialization of the file record, as returned by the POST.
+            file_path: `str`. The local path or S3 URI of the file to upload.
+
+        Raises:
+            Exception: The upload failed.
+        """
+        creds = file_record.get("upload_credentials")
+        if not creds:
+            creds = self.get_upload_credentials(file_record["@id"])
+        DEBUG_LOGGER.debug("Uploading file {} to {}.".format(file_path, creds.get("upload_url")))
+        if self.dry_run:
+            DEBUG_LOGGER.debug("Dry run: skipping upload.")
+            return
+        env = dict(os.environ)
+        env.update({
+            "AWS_ACCESS_KEY_ID": creds["access_key"],
+            "AWS_SECRET_ACCESS_KEY": creds["secret_key"],
+            "AWS_SECURITY_TOKEN": creds["session_token"],
+            "AWS_SESSION_TOKEN": creds["session_token"]
+        })
+        start = time.perf_counter()
+        process = subprocess.run(
+            ["aws", "s3", "cp", file_path, creds["upload_url"], "--quiet"],
+            env=env, stderr=subprocess.PIPE)
+        eumetrics.METRICS.observe(eumetrics.OP_UPLOAD, time.perf_counter() - start,
+                                  error=bool(process.returncode))
+        if process.returncode:
+            message = "Failed to upload {}: {}".format(file_path, process.stderr.decode().strip())
+            ERROR_LOGGER.error(message)
+            raise Exception(message)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains a ``SubmissionJournal`` class that records the outcome of each row of an input file
+submitted by ``eu_register.py``, so that an interrupted run can be resumed without submitting the
+completed rows again.
+"""
+
+import json
+import logging
+import os
+import time
+
+import encode_utils as eu
+import encode_utils.utils as euu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The default directory, relative to the calling directory, in which the journals are stored.
+JOURNAL_DIR = "EU_Journals"
+
+#: The status recorded for a row that was submitted successfully.
+STATUS_OK = "ok"
+#: The status recorded for a row that failed.
+STATUS_ERROR = "error"
+
+
+def get_journal_path(infile, profile_id, patch=False, journal_dir=JOURNAL_DIR):
+    """
+    Determines the path of the journal of an input file. The journal is keyed on the md5sum of the
+    content of the input file, so that a changed input file gets a new journal, as well as on the
+    profile and on whether the rows are POSTED or PATCHED.
+
+    Args:
+        infile: `str`. The path to the input file.
+        profile_id: `str`. The profile of the records in the input file.
+        patch: `bool`. `True` if the rows are PATCHED rather than POSTED.
+        journal_dir: `str`. The directory holding the journals.
+
+    Returns:
+        `str`: The path to the journal.
+    """
+    name = "{}.{}.{}.journal".format(
+        euu.calculate_md5sum(infile), profile_id, "patch" if patch else "post")
+    return os.path.join(journal_dir, name)
+
+
+class SubmissionJournal:
+    """
+    An append-only journal storing one JSON line per submitted row of an input file, with the line
+    number of the row, its status (``STATUS_OK`` or ``STATUS_ERROR``), and the identifier of the
+    record or the error message.
+
+    Writes are buffered, and flushed and fsynced to disk once `sync_every` rows have been recorded
+    or `sync_interval` seconds have elapsed since the last sync, whichever comes first, as well as
+    when the journal is closed. Should the process die, at most the rows recorded since the last
+    sync are lost, and these will simply be submitted again when resuming. A partially written
+    last line is cut off the journal when resuming.
+
+    Args:
+        path: `str`. The path to the journal, i.e. the return value of ``get_journal_path()``.
+        resume: `bool`. `True` means to load the existing journal, if any, and append to it.
+          Otherwise, any existing journal is overwritten.
+        sync_every: `int`. See above.
+        sync_interval: `float`. See above.
+    """
+
+    def __init__(self, path, resume=False, sync_every=100, sync_interval=1.0):
+        #: The path to the journal.
+        self.path = path
+        #: `dict` mapping the line numbers of the rows that were submitted successfully to the
+        #: identifiers of their records.
+        self.completed = {}
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        if resume and os.path.exists(path):
+            self._load()
+            DEBUG_LOGGER.debug("Resuming from journal {}: {} rows already completed.".format(
+                path, len(self.completed)))
+        elif os.path.exists(path):
+            DEBUG_LOGGER.debug("Overwriting journal {}.".format(path))
+        journal_dir = os.path.dirname(path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        self._fh = open(path, "a" if resume else "w")
+        self._num_unsynced = 0
+        self._last_sync = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _load(self):
+        """
+        Loads the journal for resuming. A torn last line is cut off the file, and a last entry
+        lacking its newline gets one, so that the entries appended next start on a line of their
+        own rather than being glued to it, which would make them unreadable on the next resume.
+        """
+        # The size of the lines that are kept.
+        end = 0
+        ends_with_newline = True
+        with open(self.path, "rb") as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    if line.endswith(b"\n"):
+                        end += len(line)
+                    continue  # Torn write.
+                end += len(line)
+                ends_with_newline = line.endswith(b"\n")
+                if entry["status"] == STATUS_OK:
+                    self.completed[entry["line"]] = entry.get("id", "")
+                else:
+                    self.completed.pop(entry["line"], None)
+        if end < os.path.getsize(self.path) or not ends_with_newline:
+            with open(self.path, "r+b") as fh:
+                fh.truncate(end)
+                if not ends_with_newline:
+                    fh.seek(end)
+                    fh.write(b"\n")
+            DEBUG_LOGGER.debug("Repaired the last line of journal {}.".format(self.path))
+
+    def is_completed(self, line):
+        """
+        Args:
+            line: `int`. A line number of the input file.
+        Returns:
+            `bool`: `True` if the row on that line was submitted successfully.
+        """
+        return line in self.completed
+
+    def record(self, line, status, record_id="", message=""):
+        """
+        Records the outcome of a row.
+
+        Args:
+            line: `int`. The line number of the row.
+            status: `str`. ``STATUS_OK`` or ``STATUS_ERROR``.
+            record_id: `str`. The identifier of the record, i.e. its accession.
+            message: `str`. The error message, for a failed row.
+        """
+        entry = {"line": line, "status": status}
+        if record_id:
+            entry["id"] = record_id
+        if message:
+            entry["message"] = message
+        self._fh.write(json.dumps(entry) + "\n")
+        if status == STATUS_OK:
+            self.completed[line] = record_id
+        self._num_unsynced += 1
+        if (self._num_unsynced >= self.sync_every
+                or time.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """
+        Flushes the recorded rows and fsyncs them to disk.
+        """
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._num_unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        """
+        Syncs and closes the journal.
+        """
+        if not self._fh.closed:
+            self.sync()
+            self._fh.close()
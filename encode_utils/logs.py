@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Sets up the logging of the package so that it doesn't slow down the code that logs. Handlers
+are attached to the loggers through ``add_handler()``, which wraps them behind a
+``logging.handlers.QueueHandler``: the calling thread only puts the record on a queue, and the
+formatting and I/O are done by a single background thread (a ``logging.handlers.QueueListener``).
+The queue is drained when the interpreter exits. Unless ``configure_logging()`` is called
+beforehand, it's called with the defaults when the first message is logged.
+
+The levels, the format (plain text or JSON lines) and the rotation of the log files are
+configurable, with defaults taken from ``encode_utils.LOG_LEVEL``, ``encode_utils.LOG_FORMAT``,
+``encode_utils.LOG_MAX_BYTES``, ``encode_utils.LOG_BACKUP_COUNT`` and
+``encode_utils.LOG_ROTATE_WHEN``.
+"""
+
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+import encode_utils as eu
+
+
+#: The format of the text log lines.
+TEXT_FORMAT = "%(asctime)s:%(name)s:\t%(message)s"
+
+#: The attributes of every ``logging.LogRecord``, which ``JsonFormatter`` doesn't repeat as extra
+#: fields.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a JSON object on one line, with the `time`, `level`, `logger` and
+    `message` keys, as well as an `exception` key when there is a traceback, and any fields passed
+    through the `extra` argument of the logging call::
+
+      DEBUG_LOGGER.debug("POSTED", extra={"accession": "ENCBS000AAA", "seconds": 0.3})
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def get_formatter(fmt=None):
+    """
+    Args:
+        fmt: `str`. 'text' or 'json'. Defaults to ``encode_utils.LOG_FORMAT``.
+
+    Returns:
+        `logging.Formatter`: The formatter.
+    """
+    if fmt is None:
+        fmt = eu.LOG_FORMAT
+    if fmt == "json":
+        return JsonFormatter()
+    if fmt == "text":
+        return logging.Formatter(TEXT_FORMAT)
+    raise ValueError("Unknown log format '{}'.".format(fmt))
+
+
+class _AsyncHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records of a logger on the queue of the background listener, tagged with the handlers
+    that they are destined to.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        #: The handlers that the background listener passes the records on to. Replaced rather than
+        #: modified, so that each queued record keeps the handlers it was logged to.
+        self.targets = ()
+
+    def enqueue(self, record):
+        if _listener is None:
+            _start_listener()
+        self.queue.put_nowait((self.targets, record))
+
+    def prepare(self, record):
+        # Merge the arguments into the message and render the traceback now, since these may not
+        # be usable later on in another thread, but leave the formatting to the target handlers.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    """
+    Passes each record on to the handlers it's tagged with, in a background thread.
+    """
+
+    def handle(self, item):
+        targets, record = item
+        for handler in targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+_exc_formatter = logging.Formatter()
+_queue = queue.SimpleQueue()
+_listener = None
+_lock = threading.Lock()
+_flush_registered = False
+
+
+def _start_listener():
+    global _listener, _flush_registered
+    with _lock:
+        if _listener is None:
+            _listener = _Listener(_queue)
+            _listener.start()
+            if not _flush_registered:
+                atexit.register(flush)
+                _flush_registered = True
+
+
+def flush():
+    """
+    Waits for the queued records to be written, and stops the background thread. It's started
+    again by the next record logged.
+    """
+    global _listener
+    # The lock is held until the listener has stopped, so that a record logged meanwhile can't
+    # start a second listener on the same queue, which could take the stop sentinel of this one.
+    with _lock:
+        listener = _listener
+        if listener is None:
+            return
+        listener.stop()
+        _listener = None
+        # Pass on the records queued behind the stop sentinel.
+        while True:
+            try:
+                item = _queue.get_nowait()
+            except queue.Empty:
+                break
+            listener.handle(item)
+        for item in iter_handlers():
+            item.flush()
+
+
+def iter_handlers():
+    """
+    Yields:
+        `logging.Handler`: The handlers attached through ``add_handler()``.
+    """
+    for name in [None] + list(logging.Logger.manager.loggerDict):
+        logger = logging.getLogger(name)
+        for handler in getattr(logger, "handlers", []):
+            if isinstance(handler, _AsyncHandler):
+                yield from handler.targets
+
+
+def add_handler(logger, handler):
+    """
+    Attaches a handler to a logger, so that the records are handled in the background thread.
+
+    Args:
+        logger: `logging.Logger`. The logger.
+        handler: `logging.Handler`. The handler, which should have its level and formatter set.
+    """
+    async_handler = None
+    for existing in logger.handlers:
+        if isinstance(existing, _AsyncHandler):
+            async_handler = existing
+    if async_handler is None:
+        async_handler = _AsyncHandler(_queue)
+        logger.addHandler(async_handler)
+    async_handler.targets += (handler,)
+
+
+def remove_handler(logger, handler):
+    """
+    Detaches a handler attached with ``add_handler()``, and closes it once the records already
+    queued for it are written.
+
+    Args:
+        logger: `logging.Logger`. The logger.
+        handler: `logging.Handler`. The handler.
+    """
+    for existing in logger.handlers:
+        if isinstance(existing, _AsyncHandler) and handler in existing.targets:
+            existing.targets = tuple(x for x in existing.targets if x is not handler)
+            flush()
+            handler.close()
+
+
+#: The handler writing the debug logger to STDOUT, set by ``configure_logging()``.
+_stream_handler = None
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """
+    Sets up the debug logger (see ``encode_utils.DEBUG_LOGGER_NAME``) to log to STDOUT. May be
+    called again to change the level or format.
+
+    Args:
+        level: `str` or `int`. The level, i.e. 'INFO'. Defaults to ``encode_utils.LOG_LEVEL``.
+        fmt: `str`. 'text' or 'json'. Defaults to ``encode_utils.LOG_FORMAT``.
+        stream: The stream to log to. Defaults to `sys.stdout`.
+    """
+    global _stream_handler
+    if level is None:
+        level = eu.LOG_LEVEL
+    if isinstance(level, str):
+        level = level.upper()
+    logger = logging.getLogger(eu.DEBUG_LOGGER_NAME)
+    logger.setLevel(level)
+    handler = logging.StreamHandler(stream=stream or sys.stdout)
+    handler.setLevel(level)
+    handler.setFormatter(get_formatter(fmt))
+    if _stream_handler is not None:
+        remove_handler(logger, _stream_handler)
+    add_handler(logger, handler)
+    _stream_handler = handler
+
+
+def is_configured():
+    """
+    Returns:
+        `bool`: `True` once ``configure_logging()`` has been called.
+    """
+    return _stream_handler is not None
+
+
+def get_file_handler(path, level=logging.DEBUG, fmt=None, max_bytes=None, backup_count=None,
+                     when=None):
+    """
+    Creates a handler writing to a log file, rotated by size when `max_bytes` is set, or by time
+    when `when` is set. The file is only created once something is logged.
+
+    Args:
+        path: `str`. The path to the log file. Its directory is created if need be.
+        level: `int`. The level of the handler.
+        fmt: `str`. See ``get_formatter()``.
+        max_bytes: `int`. The size at which the file is rotated. Defaults to
+          ``encode_utils.LOG_MAX_BYTES``; 0 means no rotation by size.
+        backup_count: `int`. The number of rotated files to keep. Defaults to
+          ``encode_utils.LOG_BACKUP_COUNT``.
+        when: `str`. The interval of the rotation by time, as understood by
+          ``logging.handlers.TimedRotatingFileHandler``, i.e. 'midnight' or 'H'. Defaults to
+          ``encode_utils.LOG_ROTATE_WHEN``; empty means no rotation by time.
+
+    Returns:
+        `logging.Handler`: The handler.
+    """
+    if max_bytes is None:
+        max_bytes = eu.LOG_MAX_BYTES
+    if backup_count is None:
+        backup_count = eu.LOG_BACKUP_COUNT
+    if when is None:
+        when = eu.LOG_ROTATE_WHEN
+    log_dir = os.path.dirname(path)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    if max_bytes:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    elif when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=backup_count, delay=True)
+    else:
+        handler = logging.FileHandler(path, delay=True)
+    handler.setLevel(level)
+    handler.setFormatter(get_formatter(fmt))
+    return handler
+
+
+def get_log_file_path(dcc_mode, tag, log_dir=None):
+    """
+    Args:
+        dcc_mode: `str`. The DCC mode, i.e. 'prod'.
+        tag: `str`. The kind of log, i.e. 'debug', 'error' or 'posted'.
+        log_dir: `str`. Defaults to ``encode_utils.LOG_DIR``.
+
+    Returns:
+        `str`: The path to the log file, i.e. EU_Logs/log_eu_prod_debug.txt.
+    """
+    if log_dir is None:
+        log_dir = eu.LOG_DIR
+    return os.path.join(log_dir, "log_eu_{}_{}.txt".format(dcc_mode, tag))
+
+
+#: The paths of the log files set up by ``add_dcc_log_files()``.
+_dcc_log_files = set()
+
+
+def add_dcc_log_files(dcc_mode, log_dir=None):
+    """
+    Sets up the log files of a DCC mode in ``encode_utils.LOG_DIR``: one for each of the debug,
+    error and POST loggers. Files already set up are left alone.
+
+    Args:
+        dcc_mode: `str`. The DCC mode, i.e. 'prod'.
+        log_dir: `str`. Defaults to ``encode_utils.LOG_DIR``.
+    """
+    for logger_name, tag, level in [(eu.DEBUG_LOGGER_NAME, "debug", logging.DEBUG),
+                                    (eu.ERROR_LOGGER_NAME, "error", logging.ERROR),
+                                    (eu.POST_LOGGER_NAME, "posted", logging.INFO)]:
+        path = os.path.abspath(get_log_file_path(dcc_mode, tag, log_dir))
+        with _lock:
+            if path in _dcc_log_files:
+                continue
+            _dcc_log_files.add(path)
+        logger = logging.getLogger(logger_name)
+        if logger.level == logging.NOTSET or logger.level > level:
+            logger.setLevel(level)
+        add_handler(logger, get_file_handler(path, level=level))
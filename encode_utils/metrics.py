@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains a ``Metrics`` registry of timings and counters, which the rest of the package fills in as
+it works: the latency of each operation (i.e. GET, POST, PATCH, upload, md5sum calculation and
+loading of the profiles) in a histogram per operation, the number of rows submitted, and the
+progress of a run. The module-level ``METRICS`` registry is the one used by the package.
+
+A ``MetricsExporter`` writes a snapshot of a registry to a file at an interval, either in the
+Prometheus text format (i.e. for the textfile collector of the node exporter) or as JSON.
+"""
+
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import encode_utils as eu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+
+#: The prefix of the names of the exported Prometheus metrics.
+PROMETHEUS_PREFIX = "encode_utils_"
+
+#: The operation names used by the package.
+OP_GET = "get"
+OP_POST = "post"
+OP_PATCH = "patch"
+OP_SEARCH = "search"
+OP_UPLOAD = "upload"
+OP_MD5 = "md5"
+OP_PROFILE_LOAD = "profile_load"
+
+
+class Metrics:
+    """
+    A thread-safe registry of latency histograms, counters and progress.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all metrics."""
+        with self._lock:
+            #: Maps each operation to its bucket counts, followed by the total count, the sum of
+            #: the latencies and the number of errors.
+            self._histograms = {}
+            self._counters = {}
+            self._rows_done = 0
+            self._rows_expected = None
+            self._start = time.time()
+
+    def observe(self, op, seconds, error=False):
+        """
+        Records the latency of an operation.
+
+        Args:
+            op: `str`. The operation, i.e. ``OP_POST``.
+            seconds: `float`. The latency.
+            error: `bool`. `True` if the operation failed.
+        """
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(op)
+            if histogram is None:
+                histogram = self._histograms[op] = [0] * (len(LATENCY_BUCKETS) + 3)
+            if index < len(LATENCY_BUCKETS):
+                histogram[index] += 1
+            histogram[-3] += 1
+            histogram[-2] += seconds
+            if error:
+                histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, op):
+        """
+        A context manager recording the latency of the operation that it wraps, which is counted
+        as an error should it raise::
+
+          with METRICS.timer(OP_UPLOAD):
+              upload()
+
+        Args:
+            op: `str`. The operation.
+        """
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(op, time.perf_counter() - start, error)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        Args:
+            name: `str`. The name of the counter.
+            value: `int`. The increment.
+            labels: The labels of the counter, i.e. status="ok".
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def start_run(self, num_rows=None):
+        """
+        Marks the start of a run: restarts the clock from which the rows per second are computed,
+        and sets the number of rows that the run is expected to process, from which the ETA is
+        computed.
+
+        Args:
+            num_rows: `int`. The number of rows, if known.
+        """
+        with self._lock:
+            self._rows_done = 0
+            self._rows_expected = num_rows
+            self._start = time.time()
+
+    def add_row(self, ok=True):
+        """
+        Counts a processed row.
+
+        Args:
+            ok: `bool`. `False` if the row failed.
+        """
+        self.inc("rows", status="ok" if ok else "failed")
+        with self._lock:
+            self._rows_done += 1
+
+    def progress(self):
+        """
+        Returns:
+            `dict`: The number of rows done and expected, the elapsed seconds, the rows per second
+            and the ETA in seconds (`None` when unknown).
+        """
+        with self._lock:
+            elapsed = time.time() - self._start
+            done = self._rows_done
+            expected = self._rows_expected
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if expected is not None and rate > 0:
+            eta = max(expected - done, 0) / rate
+        return {"rows_done": done, "rows_expected": expected, "elapsed": elapsed,
+                "rows_per_sec": rate, "eta": eta}
+
+    def snapshot(self):
+        """
+        Returns:
+            `dict`: All metrics, in a form that can be serialized as JSON.
+        """
+        with self._lock:
+            histograms = {op: list(x) for op, x in self._histograms.items()}
+            counters = dict(self._counters)
+        operations = {}
+        for op, histogram in sorted(histograms.items()):
+            count = histogram[-3]
+            cumulative = 0
+            buckets = {}
+            for bound, num in zip(LATENCY_BUCKETS, histogram):
+                cumulative += num
+                buckets[str(bound)] = cumulative
+            buckets["+Inf"] = count
+            operations[op] = {"count": count, "errors": histogram[-1], "sum": histogram[-2],
+                              "mean": histogram[-2] / count if count else None,
+                              "buckets": buckets}
+        return {
+            "time": time.time(),
+            "progress": self.progress(),
+            "operations": operations,
+            "counters": [dict(name=name, labels=dict(labels), value=value)
+                         for (name, labels), value in sorted(counters.items())],
+        }
+
+    def to_prometheus(self):
+        """
+        Returns:
+            `str`: All metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        name = PROMETHEUS_PREFIX + "operation_seconds"
+        lines = ["# HELP {} Latency of the operations.".format(name),
+                 "# TYPE {} histogram".format(name)]
+        for op, stats in snapshot["operations"].items():
+            for bound, count in stats["buckets"].items():
+                lines.append('{}_bucket{{op="{}",le="{}"}} {}'.format(name, op, bound, count))
+            lines.append('{}_sum{{op="{}"}} {}'.format(name, op, stats["sum"]))
+            lines.append('{}_count{{op="{}"}} {}'.format(name, op, stats["count"]))
+        errors_name = PROMETHEUS_PREFIX + "operation_errors_total"
+        lines.extend(["# HELP {} Failed operations.".format(errors_name),
+                      "# TYPE {} counter".format(errors_name)])
+        for op, stats in snapshot["operations"].items():
+            lines.append('{}{{op="{}"}} {}'.format(errors_name, op, stats["errors"]))
+        names = sorted(set(x["name"] for x in snapshot["counters"]))
+        for counter_name in names:
+            full_name = PROMETHEUS_PREFIX + counter_name + "_total"
+            lines.append("# TYPE {} counter".format(full_name))
+            for counter in snapshot["counters"]:
+                if counter["name"] == counter_name:
+                    labels = ",".join('{}="{}"'.format(k, v) for k, v in counter["labels"].items())
+                    lines.append("{}{} {}".format(
+                        full_name, "{" + labels + "}" if labels else "", counter["value"]))
+        progress = snapshot["progress"]
+        for key in ["rows_expected", "rows_per_sec", "eta", "elapsed"]:
+            if progress[key] is not None:
+                gauge = PROMETHEUS_PREFIX + key + ("_seconds" if key in ("eta", "elapsed") else "")
+                lines.append("# TYPE {} gauge".format(gauge))
+                lines.append("{} {}".format(gauge, progress[key]))
+        return "\n".join(lines) + "\n"
+
+
+#: The registry used by the package.
+METRICS = Metrics()
+
+
+def format_progress(progress):
+    """
+    Args:
+        progress: `dict`. The return value of ``Metrics.progress()``.
+
+    Returns:
+        `str`: A one-line summary, i.e. '1200/5000 rows, 85.3 rows/s, ETA 44s'.
+    """
+    text = "{}{} rows, {:.1f} rows/s".format(
+        progress["rows_done"],
+        "" if progress["rows_expected"] is None else "/{}".format(progress["rows_expected"]),
+        progress["rows_per_sec"])
+    if progress["eta"] is not None:
+        text += ", ETA {:.0f}s".format(progress["eta"])
+    return text
+
+
+class MetricsExporter:
+    """
+    Writes a snapshot of a registry to a file every `interval` seconds from a background thread,
+    and once more when stopped, and logs the progress of the run each time. The file is replaced
+    atomically, so that readers never see a partial snapshot.
+
+    Args:
+        path: `str`. The file to write. May be `None` to only log the progress.
+        interval: `float`. The number of seconds between snapshots.
+        fmt: `str`. 'prometheus' or 'json'. Defaults to 'prometheus' when `path` ends with '.prom',
+          and to 'json' otherwise.
+        metrics: ``Metrics``. Defaults to ``METRICS``.
+    """
+
+    def __init__(self, path, interval=10.0, fmt=None, metrics=None):
+        self.path = path
+        self.interval = interval
+        if fmt is None:
+            fmt = "prometheus" if path and path.endswith(".prom") else "json"
+        if fmt not in ("prometheus", "json"):
+            raise ValueError("Unknown metrics format '{}'.".format(fmt))
+        self.fmt = fmt
+        self.metrics = metrics if metrics is not None else METRICS
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Starts exporting in the background."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops exporting, after a last snapshot."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+    def export(self):
+        """Writes a snapshot and logs the progress."""
+        DEBUG_LOGGER.debug("Progress: {}.".format(format_progress(self.metrics.progress())))
+        if not self.path:
+            return
+        if self.fmt == "prometheus":
+            data = self.metrics.to_prometheus()
+        else:
+            data = json.dumps(self.metrics.snapshot(), indent=2)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(data)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+A local, in-memory stand-in for the ENCODE Portal, for measuring and testing submissions without
+touching the production or test Portals. It serves the profiles endpoint and single profiles,
+searches, and GET (conditional on the `ETag`), POST, PATCH and PUT requests on records, and can be
+made to answer slowly, to fail a fraction of the requests, or to throttle them with 429 responses.
+It also keeps statistics on the requests it answered, which it serves at ``/_stats``.
+
+Run it with::
+
+  python -m encode_utils.mock_portal --port 8000 --latency 0.05 --throttle-rate 0.01
+
+and point the clients at it with the `local` DCC mode::
+
+  export EU_LOCAL_DCC_URL=http://127.0.0.1:8000
+  export EU_PROFILES_URL=http://127.0.0.1:8000/profiles/
+  eu_register.py -m local -p biosample -i biosamples.tsv
+
+It can also be run from Python code through the ``MockPortal`` class.
+"""
+
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+import encode_utils as eu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The query parameters of a search that don't filter the records.
+NON_FILTER_PARAMS = {"type", "format", "limit", "field", "frame", "datastore"}
+
+#: The properties that the Portal computes, and that thus aren't part of the `edit` frame.
+CALCULATED_PROPS = {"@id", "@type", "upload_credentials"}
+
+
+def _prop(prop_type, **kwargs):
+    schema = {"type": prop_type}
+    schema.update(kwargs)
+    return schema
+
+
+def _schema(profile_id, props, required):
+    all_props = {
+        "schema_version": _prop("string", default="1", requestMethod=[]),
+        "uuid": _prop("string", readonly=True, format="uuid"),
+        "accession": _prop("string", readonly=True),
+        "status": _prop("string", enum=["in progress", "released", "deleted", "uploading",
+                                        "upload failed"]),
+        "aliases": _prop("array", items=_prop("string"), uniqueItems=True),
+        "award": _prop("string", linkTo="Award"),
+        "lab": _prop("string", linkTo="Lab"),
+        "documents": _prop("array", items=_prop("string", linkTo="Document")),
+        "submitted_by": _prop("string", linkTo="User", notSubmittable=True),
+        "date_created": _prop("string", notSubmittable=True),
+    }
+    all_props.update(props)
+    return {"id": "/profiles/{}.json".format(profile_id), "title": profile_id, "type": "object",
+            "required": required, "identifyingProperties": ["uuid", "accession", "aliases"],
+            "properties": all_props}
+
+
+def get_default_profiles():
+    """
+    Returns:
+        `dict`: A small profiles document, in the format served by the Portal's profiles endpoint,
+        with the `file`, `biosample`, `library`, `replicate` and `document` profiles.
+    """
+    return {
+        "File": _schema("file", {
+            "submitted_file_name": _prop("string"),
+            "md5sum": _prop("string", pattern="^[a-f0-9]{32}$"),
+            "file_format": _prop("string", enum=["fastq", "bam", "bed", "bigWig"]),
+            "output_type": _prop("string"),
+            "read_length": _prop("integer", minimum=0),
+            "paired_end": _prop("string", enum=["1", "2"]),
+            "dataset": _prop("string", linkTo="Experiment"),
+            "replicate": _prop("string", linkTo="Replicate"),
+            "derived_from": _prop("array", items=_prop("string", linkTo="File")),
+        }, ["dataset", "file_format", "award", "lab"]),
+        "Biosample": _schema("biosample", {
+            "biosample_term_name": _prop("string"),
+            "description": _prop("string"),
+            "starting_amount": _prop("number"),
+            "passage_number": _prop("integer"),
+            "is_control": _prop("boolean"),
+            "fractions": _prop("array", items=_prop("integer")),
+            "part_of": _prop("string", linkTo="Biosample"),
+            "treatment": _prop("object", properties={"name": _prop("string")}),
+        }, ["award", "lab", "biosample_term_name"]),
+        "Library": _schema("library", {
+            "biosample": _prop("string", linkTo="Biosample"),
+            "nucleic_acid_term_name": _prop("string", enum=["DNA", "RNA"]),
+        }, ["award", "lab", "nucleic_acid_term_name"]),
+        "Replicate": _schema("replicate", {
+            "library": _prop("string", linkTo="Library"),
+            "experiment": _prop("string", linkTo="Experiment"),
+            "biological_replicate_number": _prop("integer"),
+            "technical_replicate_number": _prop("integer"),
+        }, ["experiment", "biological_replicate_number", "technical_replicate_number"]),
+        "Document": _schema("document", {
+            "document_type": _prop("string"),
+            "description": _prop("string"),
+        }, ["award", "lab", "document_type"]),
+        "_subtypes": {},
+        "@type": ["JSONSchemas"],
+    }
+
+
+def percentile(values, pct):
+    """
+    Args:
+        values: `list`. Sorted numbers.
+        pct: `float`. The percentile, between 0 and 100.
+
+    Returns:
+        `float`: The nearest-rank percentile of `values`, or `None` if it's empty.
+    """
+    if not values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class MockPortal:
+    """
+    Runs the stand-in Portal in a background thread. Each request is handled in its own thread.
+
+    Args:
+        profiles: `dict`. The profiles document to serve. Defaults to ``get_default_profiles()``.
+        host: `str`. The interface to listen on.
+        port: `int`. The port to listen on. 0 picks a free port; see ``self.url``.
+        latency: `float`. The number of seconds each request takes at the least.
+        jitter: `float`. The maximum number of seconds added at random to `latency`.
+        error_rate: `float`. The fraction of requests answered with a 500 error.
+        throttle_rate: `float`. The fraction of requests answered with a 429 error, with a
+          `Retry-After` header set to `retry_after`.
+        retry_after: `int`. See above.
+        capacity: `int`. The maximum number of requests handled at once; the others wait for
+          their turn, as they would on a busy server. `None` means no limit.
+        seed: `int`. The seed of the random errors and jitter, for repeatable runs.
+    """
+
+    def __init__(self, profiles=None, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, capacity=None, seed=None):
+        if profiles is None:
+            profiles = get_default_profiles()
+        self._profiles_body = json.dumps(profiles).encode("utf-8")
+        self._profiles_etag = '"{}"'.format(hashlib.md5(self._profiles_body).hexdigest())
+        # Maps each profile ID to its type name and schema.
+        self._schemas = {}
+        for name, schema in profiles.items():
+            if not name.startswith("_") and name != "@type":
+                self._schemas[schema["id"].split("/")[-1].split(".json")[0]] = (name, schema)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._capacity = threading.BoundedSemaphore(capacity) if capacity else None
+        self._lock = threading.Lock()
+        #: Maps each identifier of a record (accession, uuid, aliases and `@id`) to the record.
+        self.records = {}
+        self._num_records = collections.Counter()
+        self.reset_stats()
+        self._server = http.server.ThreadingHTTPServer((host, port), _get_handler_class(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """The URL of the stand-in Portal."""
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        DEBUG_LOGGER.debug("Mock Portal listening on {}.".format(self.url))
+
+    def stop(self):
+        """Stops serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def serve_forever(self):
+        """Serves in the calling thread until interrupted."""
+        DEBUG_LOGGER.debug("Mock Portal listening on {}.".format(self.url))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def reset_stats(self):
+        """Clears the request statistics."""
+        with self._lock:
+            self._latencies = collections.defaultdict(list)
+            self._statuses = collections.defaultdict(collections.Counter)
+            self._records_written = 0
+            self._stats_start = time.time()
+
+    def stats(self):
+        """
+        Returns:
+            `dict`: The request statistics since the start or the last ``self.reset_stats()``: the
+            number of records created or modified, and for each HTTP method, the number of
+            requests per status code and the latency percentiles in seconds, measured from the
+            arrival of a request to its response (including the time spent waiting for `capacity`).
+        """
+        with self._lock:
+            methods = {}
+            for method, latencies in self._latencies.items():
+                latencies = sorted(latencies)
+                methods[method] = {
+                    "count": len(latencies),
+                    "statuses": {str(k): v for k, v in sorted(self._statuses[method].items())},
+                    "latency": {
+                        "mean": sum(latencies) / len(latencies),
+                        "p50": percentile(latencies, 50),
+                        "p90": percentile(latencies, 90),
+                        "p99": percentile(latencies, 99),
+                        "max": latencies[-1],
+                    },
+                }
+            return {"elapsed": time.time() - self._stats_start,
+                    "records_written": self._records_written,
+                    "methods": methods}
+
+    def _record(self, method, status, latency, written=False):
+        with self._lock:
+            self._latencies[method].append(latency)
+            self._statuses[method][status] += 1
+            if written:
+                self._records_written += 1
+
+    def _get_fault(self):
+        """
+        Returns:
+            `tuple`: The error status to answer a request with, or `None`, and the number of
+            seconds to wait before answering.
+        """
+        with self._random_lock:
+            delay = self.latency + self._random.uniform(0, self.jitter) if self.jitter else self.latency
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return 429, delay
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, delay
+        return None, delay
+
+    def _lookup(self, identifier):
+        identifier = urllib.parse.unquote(identifier).strip("/")
+        record = self.records.get(identifier)
+        if record is None and "/" in identifier:
+            # i.e. biosamples/ENCBS000AAA
+            record = self.records.get(identifier.split("/")[-1])
+        return record
+
+    def _index(self, record):
+        for key in [record["accession"], record["uuid"], record["@id"].strip("/")]:
+            self.records[key] = record
+        for alias in record.get(eu.ALIAS_PROP_NAME, []):
+            self.records[alias] = record
+
+    def _upload_credentials(self, record):
+        file_name = os.path.basename(record.get("submitted_file_name", record["accession"]))
+        return {
+            "access_key": "mock-access-key",
+            "secret_key": "mock-secret-key",
+            "session_token": "mock-session-token",
+            "upload_url": "s3://encode-files/{}/{}".format(record["uuid"], file_name),
+        }
+
+    def _get_profile_id(self, collection):
+        """
+        Returns the profile ID that the collection name in the URL of a POST refers to, i.e.
+        `genetic_modification` for `genetic-modifications`, or `None` if unknown.
+        """
+        name = collection.replace("-", "_")
+        for candidate in [name, name[:-1], name[:-3] + "y"]:
+            if candidate in self._schemas:
+                return candidate
+        return None
+
+    def _create(self, collection, payload):
+        profile_id = self._get_profile_id(collection)
+        if profile_id is None:
+            return 404, {"status": "error", "description": "Unknown profile."}
+        type_name, schema = self._schemas[profile_id]
+        missing = [x for x in schema.get("required", []) if x not in payload]
+        if missing:
+            return 422, {"status": "error", "description": "Missing required properties: {}".format(
+                ", ".join(missing))}
+        with self._lock:
+            for alias in payload.get(eu.ALIAS_PROP_NAME, []):
+                if alias in self.records:
+                    return 409, {"status": "error", "description": "Conflict: {}".format(alias)}
+            self._num_records[profile_id] += 1
+            number = sum(self._num_records.values())
+            accession = "ENC{}{:03d}{}".format(
+                profile_id[:2].upper(), number % 1000,
+                "".join(chr(65 + (number // 1000 // 26 ** i) % 26) for i in range(3)))
+            record = dict(payload)
+            record.update({
+                "accession": accession,
+                "uuid": str(uuid.uuid4()),
+                "@id": "/{}s/{}/".format(profile_id.replace("_", "-"), accession),
+                "@type": [type_name, "Item"],
+            })
+            if profile_id == "file":
+                record.setdefault("status", "uploading")
+                record["upload_credentials"] = self._upload_credentials(record)
+            else:
+                record.setdefault("status", "in progress")
+            self._index(record)
+        return 201, {"status": "success", "@graph": [record]}
+
+    def _update(self, identifier, payload, replace=False, delete_fields=()):
+        with self._lock:
+            record = self._lookup(identifier)
+            if record is None:
+                return 404, {"status": "error", "description": "Not found."}
+            for alias in payload.get(eu.ALIAS_PROP_NAME, []):
+                if self.records.get(alias, record) is not record:
+                    return 409, {"status": "error", "description": "Conflict: {}".format(alias)}
+            if replace:
+                for alias in record.get(eu.ALIAS_PROP_NAME, []):
+                    self.records.pop(alias, None)
+                kept = {k: record[k] for k in ["accession", "uuid", "@id", "@type"]}
+                record.clear()
+                record.update(kept)
+            for field in delete_fields:
+                record.pop(field, None)
+            record.update(payload)
+            self._index(record)
+        return 200, {"status": "success", "@graph": [record]}
+
+    def _search(self, params):
+        with self._lock:
+            matches = {}
+            for record in self.records.values():
+                if "type" in params and not set(params["type"]) & set(record["@type"]):
+                    continue
+                ok = True
+                for key, values in params.items():
+                    if key in NON_FILTER_PARAMS:
+                        continue
+                    value = record.get(key)
+                    candidates = value if isinstance(value, list) else [value]
+                    if not set(values) & set(str(x) for x in candidates):
+                        ok = False
+                        break
+                if ok:
+                    matches[record["uuid"]] = record
+        if not matches:
+            # As on the Portal, a search without results is a 404.
+            return 404, {"@graph": [], "total": 0}
+        graph = list(matches.values())
+        fields = params.get("field")
+        if fields:
+            graph = [{k: v for k, v in x.items() if k in fields or k in ("@id", "@type")}
+                     for x in graph]
+        return 200, {"@graph": graph, "total": len(graph)}
+
+
+def _get_handler_class(portal):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # The headers and the body are written separately, which would otherwise be delayed on
+        # kept-alive connections.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            data = self.rfile.read(length) if length else b""
+            return json.loads(data.decode("utf-8")) if data else {}
+
+        def _handle(self, method):
+            start = time.time()
+            parsed = urllib.parse.urlparse(self.path)
+            path = parsed.path
+            params = urllib.parse.parse_qs(parsed.query)
+            if path.rstrip("/") == "/_stats":
+                return self._send(200, portal.stats())
+            payload = self._read_json() if method in ("POST", "PATCH", "PUT") else None
+            if portal._capacity:
+                portal._capacity.acquire()
+            try:
+                fault, delay = portal._get_fault()
+                if delay:
+                    time.sleep(delay)
+                headers = {}
+                written = False
+                if fault == 429:
+                    status, body = 429, {"status": "error", "description": "Too many requests."}
+                    headers["Retry-After"] = str(portal.retry_after)
+                elif fault:
+                    status, body = fault, {"status": "error", "description": "Injected error."}
+                else:
+                    status, body, headers = self._route(method, path, params, payload)
+                    written = method != "GET" and status in (200, 201)
+                self._send(status, body, headers)
+            finally:
+                if portal._capacity:
+                    portal._capacity.release()
+            portal._record(method, status, time.time() - start, written)
+
+        def _route(self, method, path, params, payload):
+            parts = [x for x in path.split("/") if x]
+            if method == "GET":
+                if parts == ["profiles"]:
+                    if self.headers.get("If-None-Match") == portal._profiles_etag:
+                        return 304, b"", {"ETag": portal._profiles_etag}
+                    return 200, portal._profiles_body, {"ETag": portal._profiles_etag}
+                if len(parts) == 2 and parts[0] == "profiles" and parts[1].endswith(".json"):
+                    # A single profile, i.e. /profiles/biosample.json.
+                    profile_id = parts[1][:-len(".json")]
+                    if profile_id not in portal._schemas:
+                        return 404, {"status": "error", "description": "Not found."}, {}
+                    return 200, portal._schemas[profile_id][1], {}
+                if parts == ["search"]:
+                    return portal._search(params) + ({},)
+                record = portal._lookup(path)
+                if record is None:
+                    return 404, {"status": "error", "description": "Not found."}, {}
+                if params.get("frame") == ["edit"]:
+                    record = {k: v for k, v in record.items() if k not in CALCULATED_PROPS}
+                body = json.dumps(record).encode("utf-8")
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if self.headers.get("If-None-Match") == etag:
+                    return 304, b"", {"ETag": etag}
+                return 200, body, {"ETag": etag}
+            if method == "POST":
+                if parts and parts[-1] == "@@upload":
+                    record = portal._lookup("/".join(parts[:-1]))
+                    if record is None:
+                        return 404, {"status": "error", "description": "Not found."}, {}
+                    record = dict(record, upload_credentials=portal._upload_credentials(record))
+                    return 200, {"status": "success", "@graph": [record]}, {}
+                if len(parts) != 1:
+                    return 405, {"status": "error", "description": "Method not allowed."}, {}
+                return portal._create(parts[0], payload) + ({},)
+            delete_fields = []
+            for value in params.get("delete_fields", []):
+                delete_fields.extend(value.split(","))
+            return portal._update(path, payload, replace=method == "PUT",
+                                  delete_fields=delete_fields) + ({},)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+        def do_PUT(self):
+            self._handle("PUT")
+
+    return Handler
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="""
+    The interface to listen on (default: %(default)s).""")
+    parser.add_argument("--port", type=int, default=8000, help="""
+    The port to listen on (default: %(default)s).""")
+    parser.add_argument("--profiles", help="""
+    A JSON file holding the profiles document to serve, i.e. a copy of
+    https://www.encodeproject.org/profiles/?format=json. Defaults to a small built-in document.""")
+    parser.add_argument("--latency", type=float, default=0.0, help="""
+    The number of seconds each request takes at the least (default: %(default)s).""")
+    parser.add_argument("--jitter", type=float, default=0.0, help="""
+    The maximum number of seconds added at random to --latency (default: %(default)s).""")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="""
+    The fraction of requests answered with a 500 error (default: %(default)s).""")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="""
+    The fraction of requests answered with a 429 error (default: %(default)s).""")
+    parser.add_argument("--retry-after", type=int, default=1, help="""
+    The value of the Retry-After header of the 429 responses (default: %(default)s).""")
+    parser.add_argument("--capacity", type=int, help="""
+    The maximum number of requests handled at once. Default: no limit.""")
+    parser.add_argument("--seed", type=int, help="""
+    The seed of the random errors and jitter.""")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    profiles = None
+    if args.profiles:
+        with open(args.profiles) as fh:
+            profiles = json.load(fh)
+    portal = MockPortal(
+        profiles=profiles, host=args.host, port=args.port, latency=args.latency,
+        jitter=args.jitter, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after, capacity=args.capacity, seed=args.seed)
+    try:
+        portal.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
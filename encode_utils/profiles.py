@@ -9,14 +9,25 @@
 """
 Contains a ``Profile`` class for working with profiles on the ENCODE Portal.  Note that the terms
 'profile' and 'schema' are used interchangeably in this package.
+
+The profiles document of the Portal is parsed as it's downloaded (see ``iter_profiles()``), one
+profile at a time, so that only the profiles that are kept take up memory.
 """
 
+import codecs
+import collections.abc
+import hashlib
 import json
 import logging
+import mmap
 import os
-import requests
+import re
+import threading
+import time
+import urllib.parse
 
 import encode_utils as eu
+import encode_utils.metrics as eumetrics
 import encode_utils.utils as euu
 
 
@@ -33,21 +44,132 @@ class UnknownProfile(Exception):
     pass
 
 
-def get_profiles():
-    """Creates a dictionary storing all public profiles on the Portal.
+#: The size in bytes of the chunks in which the profiles document is read from the response.
+PROFILES_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _request_profiles(profiles_url, headers):
+    """
+    Sends a GET request to the Portal's profiles endpoint, through the session shared by the
+    package. The body of the response is streamed, so it's to be read with
+    ``iter_profiles(response.iter_content(PROFILES_CHUNK_SIZE))`` and the response closed.
+
+    Args:
+        profiles_url: `str`. The URL of the profiles endpoint, i.e. ``encode_utils.PROFILES_URL``.
+        headers: `dict`. The HTTP headers to send with the request.
 
     Returns:
-        `dict`: `dict` where each key is the profile's ID, and each value is a given profile's
-        JSON schema.  Each key is extracted from the profile's `id` property, after a
-        little formatting first.  The formatting works by removing the
-        '/profiles/' prefix and the '.json' suffix.  For example, the value of the `id` property
-        for the `genetic_modification.json` profile is
-        `/profiles/genetic_modification.json`. The corresponding key in this `dict` is
-        `genetic_modification`.
+        `requests.Response`: The response of the Portal.
+    """
+    # Imported here since requests takes longer to import than the rest of the module.
+    import encode_utils.sessions as eusessions
+    return eusessions.get_session().get(
+        profiles_url + "?format=json", timeout=eu.TIMEOUT, headers=headers, stream=True)
+
+
+def _get_profile_id(schema):
+    # I.e. /profiles/genetic_modification.json -> genetic_modification.
+    return schema["id"].split("/")[-1].split(".json")[0]
+
+
+def iter_profiles(chunks):
+    """
+    Parses the document returned by the Portal's profiles endpoint incrementally, as its chunks
+    come in. Each profile is decoded with ``json.JSONDecoder.raw_decode()`` as soon as its text is
+    complete, and the text is then dropped, so that no more than the text of a single profile is
+    buffered at a time. The "private" profiles (i.e. `_subtypes`) and the `@type` pseudo profile
+    are skipped, as in ``get_profiles()``.
+
+    Args:
+        chunks: An iterable of `bytes` holding the UTF-8 encoded document, i.e.
+          ``response.iter_content(PROFILES_CHUNK_SIZE)``.
+
+    Yields:
+        `tuple`: The profile ID and the JSON schema of each profile.
+
+    Raises:
+        ValueError: The document isn't a JSON object, or is truncated.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+
+    def read():
+        # Appends the next chunk to what is left of the buffer.
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            text = utf8.decode(b"", final=True)
+        else:
+            text = utf8.decode(chunk)
+        buf = buf[pos:] + text
+        pos = 0
+
+    def peek():
+        # Returns the next character that isn't whitespace, without consuming it.
+        nonlocal pos
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError("The profiles document is truncated.")
+            read()
+
+    def decode():
+        # Decodes the JSON value starting at the next character.
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                read()
+                continue
+            pos = end
+            return value
+
+    if peek() != "{":
+        raise ValueError("The profiles document isn't a JSON object.")
+    pos += 1
+    if peek() == "}":
+        return
+    while True:
+        name = decode()
+        if peek() != ":":
+            raise ValueError("Expected ':' after '{}' in the profiles document.".format(name))
+        pos += 1
+        schema = decode()
+        if not name.startswith("_") and name != "@type":
+            yield _get_profile_id(schema), schema
+        char = peek()
+        pos += 1
+        if char == "}":
+            return
+        if char != ",":
+            raise ValueError("Expected ',' or '}}' after '{}' in the profiles document.".format(
+                name))
+
+
+def _format_profiles(profiles):
+    """
+    Converts the document returned by the Portal's profiles endpoint into the `dict` that is
+    returned by ``get_profiles()``.
+
+    Args:
+        profiles: `dict`. The decoded JSON document, keyed by profile name.
+
+    Returns:
+        `dict`: See ``get_profiles()``.
     """
-    profiles = requests.get(eu.PROFILES_URL + "?format=json",
-                            timeout=eu.TIMEOUT,
-                            headers=euu.REQUEST_HEADERS_JSON).json()
     # Remove the "private" profiles, since these have differing semantics.
     private_profiles = [x for x in profiles if x.startswith("_")]  # i.e. _subtypes
     for i in private_profiles:
@@ -57,11 +179,710 @@ def get_profiles():
     for name in profiles:  # i.e. name=GeneticModification
         if name == "@type":
             continue  # A pseudo profile that doesn't count.
-        profile_id = profiles[name]["id"].split("/")[-1].split(".json")[0]
+        profile_id = _get_profile_id(profiles[name])
         profile_id_hash[profile_id] = profiles[name]
     return profile_id_hash
 
 
+def _download_profiles(profiles_url):
+    """
+    Yields:
+        `tuple`: The profile ID and the JSON schema of each profile on the Portal, as parsed by
+        ``iter_profiles()`` while the profiles document is downloaded.
+    """
+    response = _request_profiles(profiles_url, euu.REQUEST_HEADERS_JSON)
+    with response:
+        response.raise_for_status()
+        yield from iter_profiles(response.iter_content(PROFILES_CHUNK_SIZE))
+
+
+def get_profiles(profiles_url=eu.PROFILES_URL, profile_ids=None):
+    """Creates a dictionary storing all public profiles on the Portal.
+
+    This always downloads the profiles. ``Profile`` goes through a ``ProfilesCache`` instead.
+    The profiles document is parsed as it's downloaded, and the profiles not in `profile_ids` are
+    dropped as soon as they are parsed, so that the peak memory is about that of the profiles kept.
+
+    Args:
+        profiles_url: `str`. The URL of the Portal's profiles endpoint. Defaults to
+          ``encode_utils.PROFILES_URL``.
+        profile_ids: An iterable of `str`. The IDs of the profiles to keep. Defaults to all.
+
+    Returns:
+        `dict`: `dict` where each key is the profile's ID, and each value is a given profile's
+        JSON schema.  Each key is extracted from the profile's `id` property, after a
+        little formatting first.  The formatting works by removing the
+        '/profiles/' prefix and the '.json' suffix.  For example, the value of the `id` property
+        for the `genetic_modification.json` profile is
+        `/profiles/genetic_modification.json`. The corresponding key in this `dict` is
+        `genetic_modification`.
+    """
+    if profile_ids is not None:
+        profile_ids = set(profile_ids)
+    profiles = {}
+    for profile_id, schema in _download_profiles(profiles_url):
+        if profile_ids is None or profile_id in profile_ids:
+            profiles[profile_id] = schema
+    return profiles
+
+
+def get_lazy_profiles(profiles_url=eu.PROFILES_URL, profile_ids=()):
+    """
+    Downloads the profiles, keeping the schemas of the profiles in `profile_ids` only, and a
+    summary (the property names) of each of the others. The schema of another profile is
+    downloaded again the first time that it's looked up, on its own, i.e. from
+    https://www.encodeproject.org/profiles/biosample.json (see ``_download_profile()``).
+
+    Args:
+        profiles_url: `str`. The URL of the Portal's profiles endpoint. Defaults to
+          ``encode_utils.PROFILES_URL``.
+        profile_ids: An iterable of `str`. The IDs of the profiles to keep.
+
+    Returns:
+        ``LazyProfiles``: Same format as the return value of ``get_profiles()``.
+    """
+    profile_ids = set(profile_ids)
+    property_names = {}
+    schemas = {}
+    for profile_id, schema in _download_profiles(profiles_url):
+        property_names[profile_id] = list(schema["properties"])
+        if profile_id in profile_ids:
+            schemas[profile_id] = schema
+
+    def loader(profile_id):
+        DEBUG_LOGGER.debug("Downloading the profile {}.".format(profile_id))
+        return _download_profile(profiles_url, profile_id)
+
+    return LazyProfiles(property_names, loader, schemas)
+
+
+def _download_profile(profiles_url, profile_id):
+    """
+    Downloads the JSON schema of a single profile, i.e. from
+    https://www.encodeproject.org/profiles/biosample.json.
+
+    Args:
+        profiles_url: `str`. The URL of the Portal's profiles endpoint.
+        profile_id: `str`. The profile ID.
+
+    Returns:
+        `dict`: The JSON schema of the profile.
+    """
+    import encode_utils.sessions as eusessions
+    url = "{}/{}.json?format=json".format(profiles_url.rstrip("/"), profile_id)
+    response = eusessions.get_session().get(
+        url, timeout=eu.TIMEOUT, headers=euu.REQUEST_HEADERS_JSON)
+    response.raise_for_status()
+    return response.json()
+
+
+def _get_property_names(profiles, profile_id):
+    """
+    Returns the property names of the given profile, without loading its schema when `profiles`
+    is able to provide them on its own (as a ``LazyProfiles`` instance does).
+
+    Args:
+        profiles: `dict`-like. Maps profile IDs to schemas, i.e. ``Profile.PROFILES``.
+        profile_id: `str`. A key in `profiles`.
+
+    Returns:
+        An iterable of property names.
+    """
+    try:
+        return profiles.property_names(profile_id)
+    except AttributeError:
+        return profiles[profile_id]["properties"]
+
+
+class LazyProfiles(collections.abc.Mapping):
+    """
+    A read-only `dict` mapping profile IDs to JSON schemas, where a schema is only loaded the first
+    time it's looked up. The property names of each profile are known upfront, so that questions
+    such as whether a profile has the `award` property can be answered without loading it.
+
+    Args:
+        property_names: `dict`. Maps each profile ID to the list of its property names.
+        loader: callable. Given a profile ID, returns the JSON schema of that profile.
+        schemas: `dict`. The schemas already loaded, keyed by profile ID.
+    """
+
+    def __init__(self, property_names, loader, schemas=None):
+        self._property_names = property_names
+        self._loader = loader
+        self._schemas = dict(schemas or {})
+
+    def __getitem__(self, profile_id):
+        try:
+            return self._schemas[profile_id]
+        except KeyError:
+            if profile_id not in self._property_names:
+                raise
+        schema = self._loader(profile_id)
+        self._schemas[profile_id] = schema
+        return schema
+
+    def __contains__(self, profile_id):
+        return profile_id in self._property_names
+
+    def __iter__(self):
+        return iter(self._property_names)
+
+    def __len__(self):
+        return len(self._property_names)
+
+    def property_names(self, profile_id):
+        """
+        Args:
+            profile_id: `str`. A profile ID.
+
+        Returns:
+            `list`: The property names of the given profile.
+        """
+        return self._property_names[profile_id]
+
+
+class ProfilesCache:
+    """
+    An on-disk cache of the profiles of a single DCC host, which spares the download and parsing of
+    the entire profiles document on each run.
+
+    The cache is a directory named after the host, inside of ``encode_utils.PROFILES_CACHE_DIR``.
+    It holds one JSON file per profile, and an index file that records when the profiles were last
+    fetched, the `ETag` and `Last-Modified` headers of that response, and a digest, the schema
+    version and the property names of each profile. Loading from the cache only reads the index;
+    the file of a given profile is read on first access only (see ``LazyProfiles``), and should it
+    be missing or unreadable, that profile alone is downloaded again. When the profiles are
+    downloaded, each one is written to the cache as soon as it's parsed, and only kept in memory
+    should it fail to be written.
+
+    Once the cache is older than `ttl` seconds, the Portal is sent a conditional request.  If the
+    profiles didn't change, the cache is simply marked as fresh again. Otherwise, only the files of
+    the profiles that changed are rewritten.  Should the Portal be unreachable, or the download be
+    cut short, the stale cache is used.
+
+    Args:
+        profiles_url: `str`. The URL of the Portal's profiles endpoint. The cache is keyed on the
+          host in this URL.
+        cache_dir: `str`. The base directory of the cache. Defaults to
+          ``encode_utils.PROFILES_CACHE_DIR``.
+        ttl: `int`. The number of seconds that the cache is used without revalidation. Defaults to
+          ``encode_utils.PROFILES_CACHE_TTL``.
+    """
+    #: The name of the index file.
+    INDEX_FILE = "index.json"
+
+    def __init__(self, profiles_url=eu.PROFILES_URL, cache_dir=None, ttl=None):
+        self.profiles_url = profiles_url
+        if cache_dir is None:
+            cache_dir = eu.PROFILES_CACHE_DIR
+        if ttl is None:
+            ttl = eu.PROFILES_CACHE_TTL
+        #: The DCC host that the cache is for.
+        self.host = urllib.parse.urlparse(profiles_url).netloc
+        #: The directory holding the cached profiles of the host.
+        self.cache_dir = os.path.join(cache_dir, self.host)
+        self.ttl = ttl
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+
+    def _profile_path(self, profile_id):
+        return os.path.join(self.cache_dir, profile_id + ".json")
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, path, data):
+        """
+        Writes `data` as JSON to `path` atomically, so that concurrent runs never see a partially
+        written file.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+
+    def _read_profile(self, profile_id):
+        path = self._profile_path(profile_id)
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as e:
+            # I.e. the file was removed since the index was read.
+            ERROR_LOGGER.error("Failed to read the profile {} from the cache {} ({}). "
+                               "Downloading it again.".format(profile_id, self.cache_dir, e))
+        schema = _download_profile(self.profiles_url, profile_id)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._write_json(path, schema)
+        except OSError as e:
+            ERROR_LOGGER.error("Failed to update the profiles cache {}: {}".format(self.cache_dir, e))
+        return schema
+
+    def _lazy_profiles(self, index):
+        property_names = {}
+        for profile_id, entry in index["profiles"].items():
+            property_names[profile_id] = entry["properties"]
+        return LazyProfiles(property_names, self._read_profile)
+
+    def load(self):
+        """
+        Loads the profiles, going to the Portal only if the cache is missing or expired.
+
+        Returns:
+            `dict`-like: Same format as the return value of ``get_profiles()``.
+        """
+        index = self._read_index()
+        if index and time.time() - index["fetched_at"] < self.ttl:
+            DEBUG_LOGGER.debug("Loading profiles from cache {}.".format(self.cache_dir))
+            return self._lazy_profiles(index)
+
+        headers = dict(euu.REQUEST_HEADERS_JSON)
+        if index:
+            if index.get("etag"):
+                headers["If-None-Match"] = index["etag"]
+            if index.get("last_modified"):
+                headers["If-Modified-Since"] = index["last_modified"]
+        import requests
+        try:
+            response = _request_profiles(self.profiles_url, headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if not index:
+                raise
+            ERROR_LOGGER.error(
+                "Failed to revalidate the profiles cache {} ({}). Using the stale cache.".format(
+                    self.cache_dir, e))
+            return self._lazy_profiles(index)
+
+        with response:
+            if response.status_code == 304 and index:
+                DEBUG_LOGGER.debug("Cached profiles in {} are up to date.".format(self.cache_dir))
+                index["fetched_at"] = time.time()
+                self._save(index)
+                return self._lazy_profiles(index)
+            profiles = iter_profiles(response.iter_content(PROFILES_CHUNK_SIZE))
+            try:
+                return self._update(index, profiles, response)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # I.e. the connection dropped while the profiles were streaming in, leaving the
+                # document truncated. The index is only written once all the profiles are in.
+                if not index:
+                    raise
+                ERROR_LOGGER.error(
+                    "Failed to download the profiles into the cache {} ({}). Using the stale "
+                    "cache.".format(self.cache_dir, e))
+                return self._lazy_profiles(index)
+
+    def _update(self, old_index, profiles, response):
+        """
+        Brings the cache in line with freshly downloaded profiles, only rewriting the files of the
+        profiles that changed.
+
+        Args:
+            old_index: `dict`. The current index, if any.
+            profiles: An iterable of (profile ID, schema) tuples, i.e. ``iter_profiles()``.
+            response: `requests.Response`. The response that the profiles come from.
+
+        Returns:
+            ``LazyProfiles``: The profiles, read back from the cache on first access.
+        """
+        old_entries = old_index["profiles"] if old_index else {}
+        index = {
+            "fetched_at": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "profiles": {}
+        }
+        # The schemas that couldn't be written to the cache.
+        unsaved = {}
+        changed = 0
+        for profile_id, schema in profiles:
+            text = json.dumps(schema, sort_keys=True)
+            entry = {
+                "digest": hashlib.md5(text.encode("utf-8")).hexdigest(),
+                "version": schema["properties"].get("schema_version", {}).get("default"),
+                "properties": list(schema["properties"])
+            }
+            index["profiles"][profile_id] = entry
+            old_entry = old_entries.get(profile_id)
+            path = self._profile_path(profile_id)
+            if old_entry and old_entry["digest"] == entry["digest"] and os.path.exists(path):
+                continue
+            changed += 1
+            if unsaved:
+                # Don't try again after a failure.
+                unsaved[profile_id] = schema
+                continue
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._write_json(path, schema)
+            except OSError as e:
+                ERROR_LOGGER.error("Failed to update the profiles cache {}: {}".format(
+                    self.cache_dir, e))
+                unsaved[profile_id] = schema
+        property_names = {x: entry["properties"] for x, entry in index["profiles"].items()}
+        if unsaved:
+            # The index isn't saved, so the cache is updated again on the next run.
+            return LazyProfiles(property_names, self._read_profile, unsaved)
+        try:
+            for profile_id in old_entries:
+                if profile_id not in index["profiles"]:
+                    os.remove(self._profile_path(profile_id))
+        except OSError as e:
+            ERROR_LOGGER.error("Failed to update the profiles cache {}: {}".format(self.cache_dir, e))
+        self._save(index)
+        DEBUG_LOGGER.debug("Updated {} of {} profiles in cache {}.".format(
+            changed, len(index["profiles"]), self.cache_dir))
+        return LazyProfiles(property_names, self._read_profile)
+
+    def _save(self, index):
+        try:
+            self._write_json(self.index_path, index)
+        except OSError as e:
+            ERROR_LOGGER.error("Failed to write the profiles cache index {}: {}".format(
+                self.index_path, e))
+
+
+#: The name of the file format written by ``export_profiles_snapshot()``.
+SNAPSHOT_FORMAT = "encode_utils.profiles_snapshot"
+#: The version of the snapshot file format. Snapshots of other versions are refused by
+#: ``load_profiles_snapshot()``.
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def export_profiles_snapshot(path, profiles=None, profiles_url=eu.PROFILES_URL):
+    """
+    Writes the profiles to a snapshot file that can be loaded by ``load_profiles_snapshot()``,
+    i.e. on machines that can't reach the Portal.
+
+    The first line of the file is a JSON header holding the format version, the source URL, the
+    creation time and an index. The index maps each profile ID to the byte offset and length of its
+    schema in the rest of the file, and to its property names.  Each schema is written as a
+    separate JSON document so that it can be deserialized on its own.
+
+    Args:
+        path: `str`. The path of the snapshot file to write.
+        profiles: `dict`-like. The profiles to write, in the format returned by ``get_profiles()``.
+          Defaults to downloading them from `profiles_url`.
+        profiles_url: `str`. The URL of the Portal's profiles endpoint. Only used when `profiles`
+          isn't set.
+    """
+    if profiles is None:
+        profiles = get_profiles(profiles_url)
+    index = {}
+    chunks = []
+    offset = 0
+    for profile_id in sorted(profiles):
+        schema = profiles[profile_id]
+        chunk = json.dumps(schema, sort_keys=True).encode("utf-8") + b"\n"
+        index[profile_id] = [offset, len(chunk), list(schema["properties"])]
+        chunks.append(chunk)
+        offset += len(chunk)
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_FORMAT_VERSION,
+        "profiles_url": profiles_url,
+        "created": time.time(),
+        "index": index
+    }
+    with open(path, "wb") as fh:
+        fh.write(json.dumps(header).encode("utf-8") + b"\n")
+        for chunk in chunks:
+            fh.write(chunk)
+    DEBUG_LOGGER.debug("Wrote a snapshot of {} profiles to {}.".format(len(index), path))
+
+
+def load_profiles_snapshot(path):
+    """
+    Loads the profiles from a file written by ``export_profiles_snapshot()``.
+
+    The file is memory-mapped and only its header is parsed upfront. The schema of a given profile
+    is only deserialized when it's first looked up, so a process that touches a couple of profiles
+    pays for just those.
+
+    Args:
+        path: `str`. The path of the snapshot file.
+
+    Returns:
+        ``LazyProfiles``: Same format as the return value of ``get_profiles()``.
+
+    Raises:
+        ValueError: The file isn't a profiles snapshot, or is of an unsupported format version.
+    """
+    with open(path, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    header_line = data.readline()
+    try:
+        header = json.loads(header_line.decode("utf-8"))
+    except ValueError:
+        header = {}
+    if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("'{}' isn't a profiles snapshot.".format(path))
+    if header["version"] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError("Profiles snapshot '{}' is of format version {}, expected version {}.".format(
+            path, header["version"], SNAPSHOT_FORMAT_VERSION))
+
+    data_start = len(header_line)
+    index = header["index"]
+    property_names = {}
+    for profile_id in index:
+        property_names[profile_id] = index[profile_id][2]
+
+    def loader(profile_id):
+        offset, length = index[profile_id][:2]
+        start = data_start + offset
+        return json.loads(data[start:start + length].decode("utf-8"))
+
+    DEBUG_LOGGER.debug("Loading profiles from snapshot {}.".format(path))
+    return LazyProfiles(property_names, loader)
+
+
+#: Maps the JSON schema type names to the Python types that their values decode to.
+JSON_TYPES = {
+    "array": (list,),
+    "boolean": (bool,),
+    "integer": (int,),
+    "null": (type(None),),
+    "number": (int, float),
+    "object": (dict,),
+    "string": (str,)
+}
+
+
+def _no_error(value):
+    return None
+
+
+def compile_property_check(prop_schema):
+    """
+    Compiles the JSON schema of a property into a function that checks a value against it.  All of
+    the lookups in the schema happen here, once, rather than each time a value is checked.
+
+    The supported keywords are `type`, `enum`, `pattern`, `minimum`, `maximum`, `minLength`,
+    `minItems`, `maxItems`, `uniqueItems` and `linkTo` (whose values must be non-empty identifiers),
+    as well as `items` and `properties` (with `required` and `additionalProperties`), which are
+    compiled recursively.
+
+    Args:
+        prop_schema: `dict`. The JSON schema of the property.
+
+    Returns:
+        A function that takes a value and returns an error message, or `None` if the value is valid.
+    """
+    checks = []
+    json_type = prop_schema.get("type")
+    if json_type:
+        if isinstance(json_type, str):
+            json_type = [json_type]
+        py_types = tuple(t for name in json_type for t in JSON_TYPES.get(name, ()))
+        # bool is a subclass of int, but isn't a JSON integer or number.
+        allow_bool = "boolean" in json_type
+        type_error = "Expected type {}.".format(" or ".join(json_type))
+
+        def check_type(value):
+            if not isinstance(value, py_types) or (isinstance(value, bool) and not allow_bool):
+                return type_error
+        if py_types:
+            checks.append(check_type)
+
+    if "enum" in prop_schema:
+        enum = prop_schema["enum"]
+        try:
+            enum_set = frozenset(enum)
+        except TypeError:  # Unhashable enum members.
+            enum_set = enum
+
+        def check_enum(value):
+            try:
+                if value in enum_set:
+                    return
+            except TypeError:
+                pass
+            return "Value {!r} is not one of {}.".format(value, enum)
+        checks.append(check_enum)
+
+    if "pattern" in prop_schema:
+        regex = re.compile(prop_schema["pattern"])
+
+        def check_pattern(value):
+            if isinstance(value, str) and not regex.search(value):
+                return "Value {!r} doesn't match the pattern '{}'.".format(value, regex.pattern)
+        checks.append(check_pattern)
+
+    if "minLength" in prop_schema:
+        min_length = prop_schema["minLength"]
+
+        def check_min_length(value):
+            if isinstance(value, str) and len(value) < min_length:
+                return "Value {!r} is shorter than {} characters.".format(value, min_length)
+        checks.append(check_min_length)
+
+    if "minimum" in prop_schema or "maximum" in prop_schema:
+        minimum = prop_schema.get("minimum")
+        maximum = prop_schema.get("maximum")
+
+        def check_range(value):
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                return
+            if minimum is not None and value < minimum:
+                return "Value {!r} is less than the minimum of {}.".format(value, minimum)
+            if maximum is not None and value > maximum:
+                return "Value {!r} is greater than the maximum of {}.".format(value, maximum)
+        checks.append(check_range)
+
+    if "linkTo" in prop_schema:
+        def check_link(value):
+            if isinstance(value, str) and (not value.strip() or value != value.strip()):
+                return "Value {!r} isn't a valid identifier of a linked record.".format(value)
+        checks.append(check_link)
+
+    if "minItems" in prop_schema or "maxItems" in prop_schema:
+        min_items = prop_schema.get("minItems")
+        max_items = prop_schema.get("maxItems")
+
+        def check_num_items(value):
+            if not isinstance(value, list):
+                return
+            if min_items is not None and len(value) < min_items:
+                return "Array has fewer than {} items.".format(min_items)
+            if max_items is not None and len(value) > max_items:
+                return "Array has more than {} items.".format(max_items)
+        checks.append(check_num_items)
+
+    if prop_schema.get("uniqueItems"):
+        def check_unique_items(value):
+            if not isinstance(value, list):
+                return
+            try:
+                if len(set(value)) == len(value):
+                    return
+            except TypeError:  # Unhashable items, i.e. objects.
+                serialized = [json.dumps(x, sort_keys=True) for x in value]
+                if len(set(serialized)) == len(serialized):
+                    return
+            return "Array items aren't unique."
+        checks.append(check_unique_items)
+
+    if isinstance(prop_schema.get("items"), dict):
+        check_item = compile_property_check(prop_schema["items"])
+
+        def check_items(value):
+            if isinstance(value, list):
+                for item in value:
+                    error = check_item(item)
+                    if error:
+                        return "Array item: " + error
+        checks.append(check_items)
+
+    if isinstance(prop_schema.get("properties"), dict):
+        check_object = compile_object_check(prop_schema)
+
+        def check_properties(value):
+            if isinstance(value, dict):
+                errors = check_object(value)
+                if errors:
+                    return "; ".join("Property '{}': {}".format(*x) for x in errors)
+        checks.append(check_properties)
+
+    if not checks:
+        return _no_error
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(value):
+        for func in checks:
+            error = func(value)
+            if error:
+                return error
+    return check
+
+
+#: The maximum number of valid (property, value) pairs remembered by ``Profile.validate_many()``.
+VALID_VALUES_MEMO_SIZE = 100000
+
+# Types of values that Profile.validate_many() remembers when valid.
+_MEMO_TYPES = (str, int, float, bool)
+
+
+def compile_object_check(schema, prop_checks=None):
+    """
+    Compiles the JSON schema of an object, i.e. of a profile, into a function that checks an object
+    against it.
+
+    Args:
+        schema: `dict`. The JSON schema, with its `properties`, `required` and
+          `additionalProperties` keywords.
+        prop_checks: `dict`. The compiled check of each property, if already at hand. Compiled with
+          ``compile_property_check()`` otherwise.
+
+    Returns:
+        A function taking the object, a `check_required` flag (`True` by default) and an optional
+        `memo` `set`, and returning the list of errors as (property, message) tuples. The `memo`
+        records the (property, type, value) triples that were found valid, so that these are
+        skipped when seen again. The type is part of the key since `True`, `1` and `1.0` are equal
+        and hash the same, but aren't equally valid. Keys starting with an underscore, such as
+        ``encode_utils.PROFILE_KEY``, are ignored.
+    """
+    properties = schema.get("properties", {})
+    if prop_checks is None:
+        prop_checks = {}
+        for prop in properties:
+            prop_checks[prop] = compile_property_check(properties[prop])
+    required = tuple(schema.get("required", ()))
+    closed = schema.get("additionalProperties") is False
+
+    def check_object(obj, check_required=True, memo=None):
+        errors = []
+        for key, value in obj.items():
+            memo_key = None
+            if memo is not None and type(value) in _MEMO_TYPES:
+                memo_key = (key, type(value), value)
+                if memo_key in memo:
+                    continue
+            check = prop_checks.get(key)
+            if check is None:
+                if closed and not key.startswith("_"):
+                    errors.append((key, "Unknown property."))
+                continue
+            error = check(value)
+            if error:
+                errors.append((key, error))
+            elif memo_key is not None:
+                if len(memo) >= VALID_VALUES_MEMO_SIZE:
+                    memo.clear()
+                memo.add(memo_key)
+        if check_required:
+            for prop in required:
+                if prop not in obj:
+                    errors.append((prop, "Missing required property."))
+        return errors
+    return check_object
+
+
+# Compiled property checks and object checks, shared by all Profile instances of the same profile
+# and schema version, so that reloading the profiles doesn't mean recompiling them.
+_COMPILED_PROPERTY_CHECKS = {}
+_COMPILED_OBJECT_CHECKS = {}
+
+
+class _classproperty:
+    """
+    A read-only property of a class (rather than of its instances), which is used for the
+    ``Profile`` attributes that are only computed once the profiles are needed.
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, obj, owner):
+        return self.fget(owner)
+
+
 class Profile:
     """
     Encapsulates knowledge about the existing profiles on the Portal and contains useful methods
@@ -71,6 +892,9 @@ class Profile:
     to ``encode_utils.connection.Connection.post()``.  This class is used to ensure that the profile
     specified there is a known profile on the Portal.
 
+    The profiles are loaded the first time they are needed rather than at import time, by means of
+    ``Profile.load_profiles()``.
+
     Args:
         profile_id: str. Typically the value of a record's `@id` property. It will be
           normalized to match the syntax of the profile ID keys in the `dict`
@@ -78,41 +902,49 @@ class Profile:
           the function ``encode_utils.profiles.Profile``). You can also pass in the already normalized
           profile ID.
     """
+    _profiles = None
+    _awardless_profile_ids = None
+    _no_alias_profile_ids = None
+    _profiles_lock = threading.Lock()
+    # Maps the known spellings of each profile ID to the profile ID. See _get_normalized_ids().
+    _normalized_ids = None
+    # Memoized instances, keyed by profile ID.
+    _instances = {}
+    _instances_lock = threading.Lock()
+
     # Constant (`dict`) set to the return value of the function ``encode_utils.profiles.get_profiles()``.
     # See documentation there for details.
     # Don't comment for sphinx since it will break the build process on Read The Docs because the
     # list value is so large.
-    PROFILES = get_profiles()
-
-    #: List of profile IDs that don't have the `award` and `lab` properties. Consulted in
-    #: ``encode_utils.connection.Connection.post()`` to determine whether to set defaults for the
-    #: `lab` and `award` properties of a given profile.
-    AWARDLESS_PROFILE_IDS = []
-    NO_ALIAS_PROFILE_IDS = []
-    for profile_id in PROFILES:
-        profile_props = PROFILES[profile_id]["properties"]
-        if eu.AWARD_PROP_NAME not in profile_props:
-            AWARDLESS_PROFILE_IDS.append(profile_id)
-        if eu.ALIAS_PROP_NAME not in profile_props:
-            NO_ALIAS_PROFILE_IDS.append(profile_id)
+    @_classproperty
+    def PROFILES(cls):
+        return cls._get_profiles()
+
+    @_classproperty
+    def AWARDLESS_PROFILE_IDS(cls):
+        """
+        List of profile IDs that don't have the `award` and `lab` properties. Consulted in
+        ``encode_utils.connection.Connection.post()`` to determine whether to set defaults for the
+        `lab` and `award` properties of a given profile.
+        """
+        cls._get_profiles()
+        return cls._awardless_profile_ids
+
+    @_classproperty
+    def NO_ALIAS_PROFILE_IDS(cls):
+        """
+        List of profile IDs that don't have the `aliases` property.
+        """
+        cls._get_profiles()
+        return cls._no_alias_profile_ids
 
     #: Constant storing the `file.json` profile's ID.
     #: This is asserted for inclusion in ``Profile.PROFILES``.
     FILE_PROFILE_ID = "file"
-    try:
-        assert(FILE_PROFILE_ID in PROFILES)
-    except AssertionError:
-        raise Exception(
-            "Error: The profile for file.json has underwent a name change apparently and is no longer known to this package.")
 
     #: Constant storing a property name of the `file.json` profile.
     #: The stored name is asserted for inclusion in the set of `File` properties.
     SUBMITTED_FILE_PROP_NAME = "submitted_file_name"
-    try:
-        assert(SUBMITTED_FILE_PROP_NAME in PROFILES[FILE_PROFILE_ID]["properties"])
-    except AssertionError:
-        raise Exception(
-            "Error: The profile for file.json no longer includes the property {}.".format(FILE_PROFILE_ID))
 
     #: Constant storing a property name of the `file.json` profile.
     #: The stored name is asserted for inclusion in the set of `File` properties.
@@ -123,18 +955,120 @@ class Profile:
     #: Constant storing the name of the property in a JSON object sub-schema that indicates whether 
     #: the object is submittable.
     NOT_SUBMITTABLE_FLAG = "notSubmittable"
-    try:
-        assert(MD5SUM_NAME_PROP_NAME in PROFILES[FILE_PROFILE_ID]["properties"])
-    except AssertionError:
-        raise Exception(
-            "Error: The profile for file.json no longer includes the property {}.".format(MD5SUM_NAME_PROP_NAME))
+
+    @classmethod
+    def load_profiles(cls):
+        """
+        Loads the profiles from the snapshot file set in ``encode_utils.PROFILES_SNAPSHOT``, if
+        any. Otherwise, loads them from the Portal, going through a ``ProfilesCache`` unless
+        ``encode_utils.PROFILES_CACHE_DIR`` is empty, in which case only the schemas of the
+        profiles in ``encode_utils.PROFILES_KEEP`` (if set) are kept in memory.
+
+        Returns:
+            `dict`-like: Same format as the return value of ``get_profiles()``.
+        """
+        if eu.PROFILES_SNAPSHOT:
+            return load_profiles_snapshot(eu.PROFILES_SNAPSHOT)
+        if not eu.PROFILES_CACHE_DIR:
+            if eu.PROFILES_KEEP:
+                return get_lazy_profiles(profile_ids=eu.PROFILES_KEEP)
+            return get_profiles()
+        return ProfilesCache().load()
+
+    @classmethod
+    def set_profiles(cls, profiles):
+        """
+        Sets the profiles that are stored in ``Profile.PROFILES``, instead of having them loaded
+        through ``Profile.load_profiles()``.
+
+        Args:
+            profiles: `dict`-like. Same format as the return value of ``get_profiles()``.
+
+        Raises:
+            Exception: The profiles lack the `file` profile, or some of its properties that this
+              package depends on.
+        """
+        if cls.FILE_PROFILE_ID not in profiles:
+            raise Exception(
+                "Error: The profile for file.json has underwent a name change apparently and is no longer known to this package.")
+        file_props = _get_property_names(profiles, cls.FILE_PROFILE_ID)
+        for prop in [cls.SUBMITTED_FILE_PROP_NAME, cls.MD5SUM_NAME_PROP_NAME]:
+            if prop not in file_props:
+                raise Exception(
+                    "Error: The profile for file.json no longer includes the property {}.".format(prop))
+
+        awardless_profile_ids = []
+        no_alias_profile_ids = []
+        for profile_id in profiles:
+            profile_props = _get_property_names(profiles, profile_id)
+            if eu.AWARD_PROP_NAME not in profile_props:
+                awardless_profile_ids.append(profile_id)
+            if eu.ALIAS_PROP_NAME not in profile_props:
+                no_alias_profile_ids.append(profile_id)
+        cls._awardless_profile_ids = awardless_profile_ids
+        cls._no_alias_profile_ids = no_alias_profile_ids
+        cls._normalized_ids = None
+        with cls._instances_lock:
+            cls._instances = {}
+        cls._profiles = profiles
+
+    @classmethod
+    def _get_profiles(cls):
+        if cls._profiles is None:
+            with cls._profiles_lock:
+                if cls._profiles is None:
+                    with eumetrics.METRICS.timer(eumetrics.OP_PROFILE_LOAD):
+                        profiles = cls.load_profiles()
+                    cls.set_profiles(profiles)
+        return cls._profiles
+
+    @classmethod
+    def _get_normalized_ids(cls):
+        """
+        Returns the table used by ``Profile._set_profile_id()``, which maps the spellings that
+        a profile ID can take in a record's `@id` or `@type` to the profile ID itself.  For the
+        profile ID `genetic_modification`, these are `genetic-modifications` (the collection name),
+        `geneticmodification` (the lower-cased `@type` name) and the singular and plural forms of
+        each.
+        """
+        table = cls._normalized_ids
+        if table is None:
+            table = {}
+            profiles = cls._get_profiles()
+            for profile_id in profiles:
+                bases = [profile_id, profile_id.replace("_", "-"), profile_id.replace("_", "")]
+                for base in bases:
+                    table.setdefault(base, profile_id)
+                    table.setdefault(base + "s", profile_id)
+                    if base.endswith("y"):
+                        table.setdefault(base[:-1] + "ies", profile_id)
+            for profile_id in profiles:
+                # An actual profile ID always maps to itself.
+                table[profile_id] = profile_id
+            cls._normalized_ids = table
+        return table
+
+    def __new__(cls, profile_id):
+        # Instances are memoized by normalized profile ID since they are immutable. An instance is
+        # only published once it's fully set up, so that other threads never get a partial one.
+        normalized_id = cls._normalize_profile_id(profile_id)
+        instance = cls._instances.get(normalized_id)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance._setup(normalized_id)
+            with cls._instances_lock:
+                instance = cls._instances.setdefault(normalized_id, instance)
+        return instance
 
     def __init__(self, profile_id):
         """
         Args:
             profile_id: `str`. Typically the value of a record's `@id` property.
         """
+        # The instance, which may be memoized, was set up by __new__().
+        pass
 
+    def _setup(self, profile_id):
         #: The normalized version of the passed-in `profile_id` to ``self.__init__()``. The normalization
         #: is neccessary in order to match the format of the profile IDs in ``Profile.PROFILES``.
         self.profile_id = self._set_profile_id(profile_id)
@@ -142,25 +1076,57 @@ class Profile:
         self.schema = Profile.PROFILES[self.profile_id] 
         #: Equivalent to the 'properties' property in the schema. 
         self.properties = self.schema["properties"]
-        #: A list of the property names that are non-writable. These are determined as properties
+
+        non_writable_props = []
+        for i in self.properties:
+            if self.is_prop_not_submittable(i) or self.is_prop_read_only(i):
+                non_writable_props.append(i)
+
+        #: A `frozenset` of the property names that are non-writable. These are determined as properties
         #: in the schema whose subschemas include the property ``Profile.NOT_SUBMITTABLE_FLAG`` or
         #: the property ``Profile.READ_ONLY_FLAG``. 
-        self.non_writable_props = []
+        self.non_writable_props = frozenset(non_writable_props)
 
-        #: A list of the property names that are writable, which are those that don't fall into the
+        #: A `frozenset` of the property names that are writable, which are those that don't fall into the
         #: self.non_writable_props category.
-        self.writable_props = []
+        self.writable_props = frozenset(self.properties).difference(self.non_writable_props)
 
-        for i in self.properties:
-            if self.is_prop_not_submittable(i) or self.is_prop_read_only(i):
-                self.non_writable_props.append(i)
-            else:
-                self.writable_props.append(i)
+        self._required_props = frozenset(self.schema.get("required", []))
+        self._identifying_props = frozenset(self.schema.get("identifyingProperties", []))
+        # The properties removed by self.filter_non_writable_props() when keep_identifying is set.
+        self._non_writable_non_identifying_props = self.non_writable_props.difference(
+            self._identifying_props)
+        # Compiled checks, see self.get_property_check() and self.validate().
+        self._compiled_key = (self.profile_id, self.properties.get("schema_version", {}).get("default"))
+        self._property_checks = _COMPILED_PROPERTY_CHECKS.setdefault(self._compiled_key, {})
+
+    @classmethod
+    def _normalize_profile_id(cls, profile_id):
+        """
+        Implements ``Profile._set_profile_id()``.
+        """
+        table = cls._get_normalized_ids()
+        try:
+            return table[profile_id]
+        except KeyError:
+            pass
+        key = profile_id.strip("/").split("/")[0].lower()
+        try:
+            return table[key]
+        except KeyError:
+            pass
+        # Multi-word profile names are hypen-separated, i.e. genetic-modifications.
+        key = key.replace("-", "_").rstrip("s")
+        if key not in cls._get_profiles():
+            raise UnknownProfile("Unknown profile ID '{}'.".format(profile_id))
+        return key
 
     def _set_profile_id(self, profile_id):
         """
         Normalizes the `profile_id` so that it matches the format of the profile IDs stored in
         ``Profile.PROFILES``, and ensures that the normalized profile ID is a member of this list.
+        The normalization is a lookup in a table of the known spellings of each profile ID, which
+        is built once (see ``Profile._get_normalized_ids()``).
 
         Args:
             profile_id: `str`. The value of the ``profile_id`` argument in ``self.__init__()``.
@@ -170,15 +1136,7 @@ class Profile:
         Raises:
             UnknownProfile: The normalized profile ID is not a member of the list `Profile.PROFILES`.
         """
-        orig_profile = profile_id
-        profile_id = profile_id.strip("/").split("/")[0].lower()
-        # Multi-word profile names are hypen-separated, i.e. genetic-modifications.
-        profile_id = profile_id.replace("-", "_")
-        if not profile_id in Profile.PROFILES:
-            profile_id = profile_id.rstrip("s")
-            if not profile_id in Profile.PROFILES:
-                raise UnknownProfile("Unknown profile ID '{}'.".format(orig_profile))
-        return profile_id
+        return self._normalize_profile_id(profile_id)
 
     def filter_non_writable_props(self, rec_json, keep_identifying=False):
         """
@@ -193,11 +1151,12 @@ class Profile:
         Returns:
             `dict`: The input minus any keys that aren't writable. 
         """
-        for key in list(rec_json):
-            if keep_identifying and self.is_prop_identifying(key):
-                continue
-            if key in self.non_writable_props:
-                rec_json.pop(key)
+        if keep_identifying:
+            non_writable_props = self._non_writable_non_identifying_props
+        else:
+            non_writable_props = self.non_writable_props
+        for key in rec_json.keys() & non_writable_props:
+            rec_json.pop(key)
         return rec_json
 
 
@@ -231,9 +1190,7 @@ class Profile:
         Returns:
             `bool`: `True` if this is a identifying property, `False` otherwise. 
         """
-        if prop in self.schema["identifyingProperties"]:
-            return True
-        return False
+        return prop in self._identifying_props
 
     def is_prop_not_submittable(self, prop):
         """
@@ -273,9 +1230,66 @@ class Profile:
         Returns:
             `bool`: `True` if this is a required property, `False` otherwise. 
         """
-        if prop in self.required_properties():
-            return True
-        return False
+        return prop in self._required_props
+
+    def get_property_check(self, prop):
+        """
+        Returns the function that checks a value of the specified property against its JSON schema,
+        as compiled by ``compile_property_check()``. The function is compiled once per property.
+
+        Args:
+            prop: `str`. The name of a property found in the the `dict` returned by ``self.properties``.
+        Returns:
+            A function that takes a value and returns an error message, or `None` if the value is valid.
+        """
+        try:
+            return self._property_checks[prop]
+        except KeyError:
+            check = compile_property_check(self.property(prop))
+            self._property_checks[prop] = check
+            return check
+
+    def _get_object_check(self):
+        try:
+            return _COMPILED_OBJECT_CHECKS[self._compiled_key]
+        except KeyError:
+            prop_checks = {}
+            for prop in self.properties:
+                prop_checks[prop] = self.get_property_check(prop)
+            check = compile_object_check(self.schema, prop_checks)
+            _COMPILED_OBJECT_CHECKS[self._compiled_key] = check
+            return check
+
+    def validate(self, payload, check_required=True):
+        """
+        Validates a payload against the profile's JSON schema, by means of checks that are compiled
+        once per profile and schema version (see ``compile_object_check()``).
+
+        Args:
+            payload: `dict`. A record of this profile, i.e. a POST payload.
+            check_required: `bool`. Set to `False` to skip the check for required properties, i.e.
+              for a PATCH payload.
+        Returns:
+            `list`: The errors as (property, message) tuples. Empty if the payload is valid.
+        """
+        return self._get_object_check()(payload, check_required)
+
+    def validate_many(self, payloads, check_required=True):
+        """
+        Validates payloads in bulk. Works like ``self.validate()``, but remembers the scalar property
+        values that were found valid (up to ``VALID_VALUES_MEMO_SIZE`` of them), so that values that
+        repeat across payloads, such as `lab` or `status`, are only checked once.
+
+        Args:
+            payloads: iterable. The payloads.
+            check_required: `bool`. See ``self.validate()``.
+        Yields:
+            `list`: The errors of each payload, in order. See ``self.validate()``.
+        """
+        check_object = self._get_object_check()
+        memo = set()
+        for payload in payloads:
+            yield check_object(payload, check_required, memo)
 
     def get_profile(self):
         """Provides the JSON schema for the specified profile ID.
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains the instrumentation behind the --profile-run option of ``eu_register.py``, which breaks
+the time of a run down into its stages, i.e. reading the input file, converting the values,
+loading the profiles, the HTTP requests and logging.
+
+``instrument()`` swaps a function of a module or class for a wrapper that times each of its calls
+as a stage of a ``StageTimers`` registry, so that nothing is timed, and nothing slows down, unless
+profiling is on. Each stage has a total time, and a self time that leaves out the time of the
+stages nested in it on the same thread, so that the self times of the stages of a thread add up to
+no more than its time. Calls of generator functions are timed one item at a time, which leaves out
+the time that the consumer spends between items. Coroutines are timed from start to finish,
+waits included, and are never nested since they run concurrently.
+
+A ``RunProfiler`` ties the timers together with the optional ``cProfile`` and ``tracemalloc``
+profilers, and writes the results to files: the stage times as JSON, the ``cProfile`` statistics
+in the ``pstats`` format (which viewers such as SnakeViz, gprof2dot or pyprof2calltree open), and
+the ``tracemalloc`` snapshot.
+"""
+
+import cProfile
+import datetime
+import functools
+import inspect
+import json
+import linecache
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+import encode_utils as eu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The number of frames of the tracebacks kept by ``tracemalloc``.
+TRACEMALLOC_FRAMES = 10
+
+#: The number of allocation sites listed in the ``tracemalloc`` summary.
+TRACEMALLOC_TOP = 10
+
+
+class StageTimers:
+    """
+    A registry of the number of calls, the total time and the self time of each stage. Each thread
+    accumulates its own times, without locking, and these are merged by ``self.summary()``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # The tables of all threads, each mapping a stage to its [calls, total, self] times.
+        self._tables = []
+
+    def _get_state(self):
+        try:
+            return self._local.table, self._local.stack
+        except AttributeError:
+            table = {}
+            # The time of the nested stages of each stage in progress.
+            stack = []
+            self._local.table = table
+            self._local.stack = stack
+            with self._lock:
+                self._tables.append(table)
+            return table, stack
+
+    def start(self):
+        """
+        Starts timing a stage on the current thread.
+
+        Returns:
+            `float`: The start time, to be passed on to ``self.stop()``.
+        """
+        self._get_state()[1].append(0.0)
+        return time.perf_counter()
+
+    def stop(self, stage, start):
+        """
+        Stops timing the stage last started on the current thread.
+
+        Args:
+            stage: `str`. The name of the stage.
+            start: `float`. The return value of ``self.start()``.
+        """
+        elapsed = time.perf_counter() - start
+        table, stack = self._get_state()
+        nested = stack.pop()
+        entry = table.get(stage)
+        if entry is None:
+            entry = table[stage] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+    def add(self, stage, seconds):
+        """
+        Adds a call of a stage that isn't nested, i.e. of a coroutine.
+
+        Args:
+            stage: `str`. The name of the stage.
+            seconds: `float`. The time of the call.
+        """
+        table = self._get_state()[0]
+        entry = table.get(stage)
+        if entry is None:
+            entry = table[stage] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += seconds
+
+    def summary(self):
+        """
+        Returns:
+            `list`: One `dict` per stage with the `stage`, `calls`, `total` and `self` keys, the
+            times being in seconds, summed over the threads, by decreasing self time.
+        """
+        merged = {}
+        with self._lock:
+            tables = list(self._tables)
+        for table in tables:
+            for stage, (calls, total, self_time) in list(table.items()):
+                entry = merged.setdefault(stage, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] += self_time
+        rows = [{"stage": stage, "calls": calls, "total": total, "self": self_time}
+                for stage, (calls, total, self_time) in merged.items()]
+        return sorted(rows, key=lambda x: x["self"], reverse=True)
+
+
+def _timed_generator(timers, stage, generator):
+    try:
+        while True:
+            start = timers.start()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                timers.stop(stage, start)
+            yield item
+    finally:
+        generator.close()
+
+
+def instrument(owner, name, stage, timers):
+    """
+    Replaces a function of a module or class with a wrapper that times its calls as a stage.
+    Functions, generator functions, coroutine functions, class methods and static methods are
+    supported.
+
+    Args:
+        owner: The module or class.
+        name: `str`. The name of the function in `owner`.
+        stage: `str`. The name of the stage. Several functions may be timed as the same stage.
+        timers: ``StageTimers``. The registry of the times.
+
+    Returns:
+        A function taking no argument that puts the original function back.
+    """
+    own = name in vars(owner)
+    original = inspect.getattr_static(owner, name)
+    func = original
+    if isinstance(original, (classmethod, staticmethod)):
+        func = original.__func__
+
+    if inspect.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                timers.add(stage, time.perf_counter() - start)
+    elif inspect.isgeneratorfunction(func):
+        def wrapper(*args, **kwargs):
+            return _timed_generator(timers, stage, func(*args, **kwargs))
+    else:
+        def wrapper(*args, **kwargs):
+            start = timers.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timers.stop(stage, start)
+    wrapper = functools.wraps(func)(wrapper)
+    if isinstance(original, (classmethod, staticmethod)):
+        wrapper = type(original)(wrapper)
+    setattr(owner, name, wrapper)
+
+    def restore():
+        if own:
+            setattr(owner, name, original)
+        else:
+            # It was inherited.
+            delattr(owner, name)
+    return restore
+
+
+class RunProfiler:
+    """
+    Profiles a run: times the stages instrumented with ``self.instrument()``, and optionally runs
+    ``cProfile`` on all threads and ``tracemalloc``, between ``self.start()`` and ``self.stop()``.
+    The results are then printed with ``self.report()``.
+
+    Args:
+        out_dir: `str`. The directory to write the results to, in files named after the start
+          time of the run. Empty means not to write any.
+        use_cprofile: `bool`. `True` means to run ``cProfile``. Each thread started while it runs
+          is profiled with a profiler of its own, and the statistics of all of them are merged.
+        use_tracemalloc: `bool`. `True` means to trace the memory allocations, which slows the run
+          down a lot more than ``cProfile`` does.
+    """
+
+    def __init__(self, out_dir="", use_cprofile=False, use_tracemalloc=False):
+        self.out_dir = out_dir
+        self.use_cprofile = use_cprofile
+        self.use_tracemalloc = use_tracemalloc
+        #: The ``StageTimers`` of the instrumented stages.
+        self.timers = StageTimers()
+        self._restores = []
+        self._profilers = []
+        self._profilers_lock = threading.Lock()
+        self._start_time = None
+        self._wall = None
+        self._cpu = None
+        self._stats = None
+        self._snapshot = None
+        self._peak_memory = None
+
+    def instrument(self, owner, name, stage):
+        """
+        Times the calls of a function as a stage until ``self.stop()``. See ``instrument()``.
+        """
+        self._restores.append(instrument(owner, name, stage, self.timers))
+
+    def _profile_thread(self, *args):
+        # Set as the profile function of each new thread, which it replaces with a profiler of its
+        # own on the first event.
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python >= 3.12 allows a single profiler at a time.
+            sys.setprofile(None)
+            return
+        with self._profilers_lock:
+            self._profilers.append(profiler)
+
+    def start(self):
+        """Starts profiling."""
+        self._start_time = datetime.datetime.now()
+        if self.use_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.use_cprofile:
+            profiler = cProfile.Profile()
+            self._profilers.append(profiler)
+            threading.setprofile(self._profile_thread)
+            profiler.enable()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def stop(self):
+        """Stops profiling, and puts the instrumented functions back."""
+        self._wall = time.perf_counter() - self._wall
+        self._cpu = time.process_time() - self._cpu
+        if self.use_cprofile:
+            self._profilers[0].disable()
+            threading.setprofile(None)
+        if self.use_tracemalloc:
+            self._peak_memory = tracemalloc.get_traced_memory()[1]
+            self._snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+            tracemalloc.stop()
+        if self.use_cprofile:
+            with self._profilers_lock:
+                profilers = list(self._profilers)
+            self._stats = pstats.Stats(*profilers)
+        for restore in reversed(self._restores):
+            restore()
+        self._restores = []
+
+    def get_results(self, operations=None):
+        """
+        Args:
+            operations: `dict`. The latencies of the operations, as in the `operations` of
+              ``encode_utils.metrics.Metrics.snapshot()``.
+
+        Returns:
+            `dict`: The wall and CPU time of the run in seconds, the stages as returned by
+            ``StageTimers.summary()``, the count and total latency of each operation, and the
+            peak memory traced in bytes, if any.
+        """
+        operations = operations or {}
+        return {
+            "start": self._start_time.isoformat(),
+            "wall": self._wall,
+            "cpu": self._cpu,
+            "stages": self.timers.summary(),
+            "operations": [{"operation": op, "count": x["count"], "total": x["sum"]}
+                           for op, x in sorted(operations.items())],
+            "peak_memory": self._peak_memory,
+        }
+
+    def format_results(self, results):
+        """
+        Args:
+            results: `dict`. The return value of ``self.get_results()``.
+
+        Returns:
+            `str`: The results as tables.
+        """
+        # The self times of concurrent threads and requests overlap, so that the share of each
+        # stage is taken of their sum rather than of the wall time.
+        self_total = sum(x["self"] for x in results["stages"]) or 1e-9
+        lines = ["{:<20} {:>10} {:>10} {:>10} {:>7} {:>10}".format(
+            "stage", "calls", "total s", "self s", "share", "mean ms")]
+        for row in results["stages"]:
+            lines.append("{:<20} {:>10} {:>10.3f} {:>10.3f} {:>6.1f}% {:>10.3f}".format(
+                row["stage"], row["calls"], row["total"], row["self"],
+                100 * row["self"] / self_total, 1000 * row["total"] / row["calls"]))
+        lines.append("Wall time {:.3f} s, CPU time {:.3f} s. The times of concurrent threads and "
+                     "requests add up.".format(results["wall"], results["cpu"]))
+        if results["operations"]:
+            lines.append("")
+            lines.append("{:<20} {:>10} {:>10} {:>10}".format(
+                "operation", "count", "total s", "mean ms"))
+            for row in results["operations"]:
+                lines.append("{:<20} {:>10} {:>10.3f} {:>10.3f}".format(
+                    row["operation"], row["count"], row["total"],
+                    1000 * row["total"] / row["count"] if row["count"] else 0))
+        if self._snapshot is not None:
+            lines.append("")
+            lines.append("Peak traced memory {:.1f} MiB. Top allocation sites:".format(
+                results["peak_memory"] / 1024 / 1024))
+            for stat in self._snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                frame = stat.traceback[0]
+                lines.append("  {:>10.1f} KiB {:>8} blocks  {}:{}  {}".format(
+                    stat.size / 1024, stat.count, frame.filename, frame.lineno,
+                    linecache.getline(frame.filename, frame.lineno).strip()))
+        if self._stats is not None:
+            lines.append("")
+            lines.append("cProfile: see the .prof file, i.e. with 'python -m pstats' or snakeviz.")
+        return "\n".join(lines)
+
+    def write_results(self, results):
+        """
+        Writes the results to ``self.out_dir``: the stage times to a .stages.json file, and, if
+        they were collected, the ``cProfile`` statistics to a .prof file and the ``tracemalloc``
+        snapshot to a .tracemalloc file (see ``tracemalloc.Snapshot.load()``).
+
+        Args:
+            results: `dict`. The return value of ``self.get_results()``.
+
+        Returns:
+            `list`: The paths of the files written.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, self._start_time.strftime("%Y%m%d-%H%M%S"))
+        paths = [prefix + ".stages.json"]
+        with open(paths[0], "w") as fh:
+            json.dump(results, fh, indent=2)
+        if self._stats is not None:
+            paths.append(prefix + ".prof")
+            self._stats.dump_stats(paths[-1])
+        if self._snapshot is not None:
+            paths.append(prefix + ".tracemalloc")
+            self._snapshot.dump(paths[-1])
+        return paths
+
+    def report(self, operations=None, stream=None):
+        """
+        Prints the results as tables, and writes them to ``self.out_dir`` if set.
+
+        Args:
+            operations: `dict`. See ``self.get_results()``.
+            stream: The stream to print to. Defaults to `sys.stderr`.
+        """
+        stream = stream or sys.stderr
+        results = self.get_results(operations)
+        print(self.format_results(results), file=stream)
+        if self.out_dir:
+            for path in self.write_results(results):
+                print("Wrote {}".format(path), file=stream)
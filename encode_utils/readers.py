@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains the readers of the input files of ``eu_register.py``. A reader streams the rows of a file
+as lists of values lined up with the field names of its header, so that the same payload
+generator works on each format without ever holding the whole file in memory:
+
+* ``TsvReader``: tab-delimited text with a header line. The values are strings.
+* ``JsonLinesReader``: one JSON object per line. The field names are the keys found in any of the
+  objects, and the values keep their JSON types.
+* ``ParquetReader``: Parquet files, read in record batches. The values keep their Arrow types,
+  converted to Python ones.
+
+Text files may be gzip or zstd compressed, in which case they are decompressed on the fly. The
+format and compression are detected from the content of the file, so a file may be given by any
+name, or as '-' for STDIN (see ``spool_stdin()``).
+
+Rows that can't be read, i.e. lines of a JSON Lines file that aren't JSON objects, raise a
+``RowError``, or are passed to a callback and skipped (see ``Reader.iter_rows()``).
+
+Other formats can be plugged in by adding a subclass of ``Reader`` to ``READERS``.
+
+Reading zstd compressed files requires the optional `zstandard` package, and reading Parquet
+files the optional `pyarrow` package.
+"""
+
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import encode_utils as eu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The name that stands for STDIN.
+STDIN = "-"
+
+#: The first bytes of a gzip stream.
+GZIP_MAGIC = b"\x1f\x8b"
+#: The first bytes of a zstd frame.
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+#: The first bytes of a Parquet file.
+PARQUET_MAGIC = b"PAR1"
+
+#: The number of rows per record batch read from Parquet files.
+PARQUET_BATCH_SIZE = 10000
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "The zstandard package is required to read zstd compressed files. "
+            "Install it with 'pip install zstandard'.")
+    return zstandard
+
+
+def _import_parquet():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "The pyarrow package is required to read Parquet files. "
+            "Install it with 'pip install pyarrow'.")
+    return pyarrow.parquet
+
+
+def _peek(fh, size):
+    # Returns the first bytes of a buffered binary file without consuming them.
+    return fh.peek(size)[:size]
+
+
+def open_text(path):
+    """
+    Opens a text file for reading, decompressing it on the fly if it's gzip or zstd compressed.
+
+    Args:
+        path: `str`. The path to the file.
+
+    Returns:
+        A text file object.
+    """
+    fh = open(path, "rb")
+    try:
+        magic = _peek(fh, 4)
+        if magic.startswith(GZIP_MAGIC):
+            stream = gzip.GzipFile(fileobj=fh)
+        elif magic.startswith(ZSTD_MAGIC):
+            stream = _import_zstandard().ZstdDecompressor().stream_reader(fh, closefd=True)
+        else:
+            stream = fh
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    except Exception:
+        fh.close()
+        raise
+
+
+def spool_stdin(dir=None):
+    """
+    Copies STDIN, as is, to a temporary file. This is needed since ``eu_register.py`` reads its
+    input more than once (i.e. to validate it, and to key its journal on its md5sum). Compressed
+    input is copied compressed, and the copy is made in chunks, so that memory use is bounded.
+
+    Args:
+        dir: `str`. The directory of the temporary file. Defaults to the system's.
+
+    Returns:
+        `str`: The path to the temporary file, which the caller is to remove.
+    """
+    with tempfile.NamedTemporaryFile(prefix="eu_stdin.", dir=dir, delete=False) as fh:
+        shutil.copyfileobj(sys.stdin.buffer, fh, 1024 * 1024)
+    DEBUG_LOGGER.debug("Copied STDIN to {} ({} bytes).".format(fh.name, os.path.getsize(fh.name)))
+    return fh.name
+
+
+class RowError(ValueError):
+    """
+    Raised by a reader for a row of the input file that can't be read.
+
+    Args:
+        line: `int`. The line number of the row.
+        message: `str`. Why the row can't be read.
+    """
+
+    def __init__(self, line, message):
+        super().__init__("Line {}: {}".format(line, message))
+        #: `int`: The line number of the row.
+        self.line = line
+        #: `str`: Why the row can't be read.
+        self.message = message
+
+
+class Reader:
+    """
+    Base class of the readers. Iterating over a reader, or over ``self.iter_rows()``, yields one
+    (line number, values) tuple per row, where `values` is lined up with ``self.header``. Values
+    may be strings, which are to be parsed as in a TSV file, or already typed values; `None` and
+    the empty string mean that the value is missing. The line number identifies the row in the
+    reports and the journal.
+
+    Readers are context managers, closing the file on exit.
+
+    Args:
+        path: `str`. The path to the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #: `list`: The field names.
+        self.header = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def iter_rows(self, on_error=None):
+        """
+        Args:
+            on_error: callable. Called with the ``RowError`` of each row that can't be read, which
+              is then skipped. By default, the ``RowError`` is raised.
+
+        Yields:
+            `tuple`: The line number and the values of each row.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Closes the file."""
+        pass
+
+    def count_rows(self):
+        """
+        Returns:
+            `int`: The number of rows, counted without parsing them where possible.
+        """
+        return sum(1 for row in self)
+
+
+class TsvReader(Reader):
+    """
+    Reads tab-delimited text with a header line. Empty lines and lines starting with a '#' are
+    skipped. The line numbers are those of the file, the header line being line 1.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._fh = open_text(path)
+        self.header = self._fh.readline().strip("\n").split("\t")
+
+    def iter_rows(self, on_error=None):
+        line_count = 1  # already read header line
+        for line in self._fh:
+            line_count += 1
+            line = line.strip("\n")
+            if not line.strip() or line[0] == "#":
+                continue
+            yield line_count, line.split("\t")
+
+    def close(self):
+        self._fh.close()
+
+    def count_rows(self):
+        num_rows = 0
+        for line in self._fh:
+            if line.strip() and line[0] != "#":
+                num_rows += 1
+        return num_rows
+
+
+class JsonLinesReader(Reader):
+    """
+    Reads one JSON object per line. Empty lines are skipped. The field names are the keys found in
+    any of the objects, in the order in which they first appear, so that an object may lack some of
+    them; they are collected by a first pass over the file, which keeps only the keys in memory.
+    The line numbers are those of the file, the first line being line 1.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.header = self._scan_fields()
+        self._fh = open_text(path)
+
+    def _scan_fields(self):
+        fields = {}
+        with open_text(self.path) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    # Reported by iter_rows().
+                    continue
+                if isinstance(obj, dict):
+                    fields.update(dict.fromkeys(obj))
+        return list(fields)
+
+    def _parse(self, line, line_count):
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            raise RowError(line_count, "invalid JSON: {}".format(e))
+        if not isinstance(obj, dict):
+            raise RowError(line_count, "expected a JSON object.")
+        return obj
+
+    def iter_rows(self, on_error=None):
+        header = self.header
+        line_count = 0
+        for line in self._fh:
+            line_count += 1
+            if not line.strip():
+                continue
+            try:
+                obj = self._parse(line, line_count)
+            except RowError as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+                continue
+            yield line_count, [obj.get(x) for x in header]
+
+    def close(self):
+        self._fh.close()
+
+    def count_rows(self):
+        num_rows = 0
+        for line in self._fh:
+            if line.strip():
+                num_rows += 1
+        return num_rows
+
+
+class ParquetReader(Reader):
+    """
+    Reads a Parquet file in record batches of ``PARQUET_BATCH_SIZE`` rows, so that only one batch
+    is held in memory at a time. The line numbers are the row numbers, the first row being row 1.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._file = _import_parquet().ParquetFile(path)
+        self.header = list(self._file.schema_arrow.names)
+
+    def iter_rows(self, on_error=None):
+        row_count = 0
+        for batch in self._file.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+            columns = [column.to_pylist() for column in batch.columns]
+            for values in zip(*columns):
+                row_count += 1
+                yield row_count, list(values)
+
+    def close(self):
+        self._file.close()
+
+    def count_rows(self):
+        return self._file.metadata.num_rows
+
+
+#: Maps each input format to its reader.
+READERS = {
+    "tsv": TsvReader,
+    "jsonl": JsonLinesReader,
+    "parquet": ParquetReader,
+}
+
+
+def detect_format(path):
+    """
+    Detects the format of a file from its content: Parquet files start with ``PARQUET_MAGIC``,
+    JSON Lines files (once decompressed) with a '{', and anything else is taken to be TSV.
+
+    Args:
+        path: `str`. The path to the file.
+
+    Returns:
+        `str`: A key of ``READERS``.
+    """
+    with open(path, "rb") as fh:
+        if _peek(fh, 4) == PARQUET_MAGIC:
+            return "parquet"
+    with open_text(path) as fh:
+        for line in fh:
+            if line.strip():
+                return "jsonl" if line.lstrip().startswith("{") else "tsv"
+    return "tsv"
+
+
+def get_reader(path, fmt=None):
+    """
+    Args:
+        path: `str`. The path to the file.
+        fmt: `str`. A key of ``READERS``. Detected with ``detect_format()`` when not set.
+
+    Returns:
+        ``Reader``: The reader of the file.
+    """
+    if not fmt:
+        fmt = detect_format(path)
+    try:
+        reader_class = READERS[fmt]
+    except KeyError:
+        raise ValueError("Unknown input format '{}'. Choose from {}.".format(
+            fmt, ", ".join(sorted(READERS))))
+    return reader_class(path)
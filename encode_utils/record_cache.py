@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains a cache of the records GOTTEN from the Portal, so that a record looked up many times in a
+run (i.e. a dataset or library referenced by many rows) is only transferred once. Records are
+keyed on the host, the identifier they were looked up by and the frame.
+
+The cache has two tiers:
+
+* An LRU in memory, bounded by the size of the JSON text of the records (see
+  ``encode_utils.RECORD_CACHE_MAX_BYTES``). A record younger than ``encode_utils.RECORD_CACHE_TTL``
+  seconds is served from it without going to the Portal; an older one is revalidated with a
+  conditional request on its `ETag`, which the Portal answers with a 304 and no body when the
+  record didn't change.
+* An optional directory (see ``encode_utils.RECORD_CACHE_DIR``) to which the records are also
+  written, so that they outlive the process and can be shared by concurrent runs. Since other
+  processes may have modified them in the meantime, records read back from it are always
+  revalidated.
+
+The connection invalidates the cached frames of a record after its own POSTS and PATCHES to it,
+whichever identifier the record was looked up by. A GET that was sent before such an invalidation
+doesn't put its possibly outdated copy back in the cache (see ``RecordCache.get_generation()``).
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import encode_utils as eu
+import encode_utils.metrics as eumetrics
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The properties of a record whose values identify it.
+IDENTIFYING_PROPS = ("@id", "uuid", "accession", eu.ALIAS_PROP_NAME)
+
+#: The name of the counter of the lookups in ``encode_utils.metrics.METRICS``, labeled with their
+#: outcome: 'hit', 'revalidated', 'changed' or 'miss'.
+METRIC_NAME = "record_cache"
+
+#: A record found in the cache. `text` is the JSON text of the record, `etag` the `ETag` header
+#: of the response it came from, and `fresh` tells whether it may be used without revalidation.
+CachedRecord = collections.namedtuple("CachedRecord", ["text", "etag", "fresh"])
+
+#: The number of invalidated identifiers that the cache remembers, to refuse the copies of their
+#: records that were fetched before the invalidation. Beyond that, the copies fetched before the
+#: oldest invalidation forgotten are all refused.
+MAX_INVALIDATIONS = 100000
+
+
+def get_record_ids(record):
+    """
+    Args:
+        record: `dict`. The JSON serialization of a record.
+
+    Returns:
+        `set`: The identifiers of the record, without leading and trailing slashes.
+    """
+    ids = set()
+    for prop in IDENTIFYING_PROPS:
+        value = record.get(prop)
+        if not value:
+            continue
+        for x in value if isinstance(value, list) else [value]:
+            ids.add(str(x).strip("/"))
+    return ids
+
+
+class _Entry:
+    __slots__ = ("text", "etag", "fetched_at", "ids", "fresh")
+
+    def __init__(self, text, etag, fetched_at, ids, fresh=True):
+        self.text = text
+        self.etag = etag
+        self.fetched_at = fetched_at
+        self.ids = ids
+        #: `False` for records read back from the directory, which are to be revalidated.
+        self.fresh = fresh
+
+
+class RecordCache:
+    """
+    The cache of the records GOTTEN from the Portal. It may be shared by several connections, from
+    several threads.
+
+    Args:
+        max_bytes: `int`. The largest total size of the JSON text of the records kept in memory,
+          beyond which the least recently used ones are dropped. Defaults to
+          ``encode_utils.RECORD_CACHE_MAX_BYTES``.
+        ttl: `float`. The number of seconds for which a record is used without revalidation.
+          Defaults to ``encode_utils.RECORD_CACHE_TTL``.
+        cache_dir: `str`. The directory in which the records are also written. Defaults to
+          ``encode_utils.RECORD_CACHE_DIR``; empty means to keep the records in memory only.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None, cache_dir=None):
+        self.max_bytes = eu.RECORD_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = eu.RECORD_CACHE_TTL if ttl is None else ttl
+        self.cache_dir = eu.RECORD_CACHE_DIR if cache_dir is None else cache_dir
+        #: The total size of the JSON text of the records in memory.
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        # Maps each (host, identifier) to the keys of the entries of that record, so that all of
+        # them are invalidated whichever identifier is given.
+        self._keys_by_id = collections.defaultdict(set)
+        # The number of invalidations so far, the generation of the last invalidation of each
+        # (host, identifier), and the generation before which all copies are refused.
+        self._generation = 0
+        self._invalidated = collections.OrderedDict()
+        self._min_generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(host, rec_id, frame):
+        return (host, rec_id.strip("/"), frame or "")
+
+    def _path(self, key):
+        name = hashlib.md5("{}\t{}".format(key[1], key[2]).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[0], name + ".json")
+
+    def lookup(self, host, rec_id, frame=None):
+        """
+        Args:
+            host: `str`. The host name of the Portal.
+            rec_id: `str`. The identifier that the record is looked up by.
+            frame: `str`. The frame, i.e. 'edit'.
+
+        Returns:
+            ``CachedRecord``: The cached record, or `None` if there is none.
+        """
+        key = self._key(host, rec_id, frame)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.cache_dir:
+            entry = self._read(key)
+            if entry is not None:
+                with self._lock:
+                    self._add(key, entry)
+        if entry is None:
+            eumetrics.METRICS.inc(METRIC_NAME, result="miss")
+            return None
+        fresh = entry.fresh and time.time() - entry.fetched_at < self.ttl
+        if fresh:
+            eumetrics.METRICS.inc(METRIC_NAME, result="hit")
+        return CachedRecord(entry.text, entry.etag, fresh)
+
+    def get_generation(self):
+        """
+        Returns:
+            `int`: The number of invalidations so far, to be taken before sending a GET and passed
+            on to ``self.store()`` with its response.
+        """
+        with self._lock:
+            return self._generation
+
+    def store(self, host, rec_id, frame, text, etag, record, generation=None):
+        """
+        Caches a record.
+
+        Args:
+            host: `str`. The host name of the Portal.
+            rec_id: `str`. The identifier that the record was looked up by.
+            frame: `str`. The frame, i.e. 'edit'.
+            text: `str`. The JSON text of the record, as returned by the Portal.
+            etag: `str`. The `ETag` header of the response, if any.
+            record: `dict`. The decoded record, whose identifiers are indexed.
+            generation: `int`. The return value of ``self.get_generation()`` from before the GET
+              was sent. The record isn't cached if it was invalidated since, as it may predate the
+              write that caused the invalidation.
+        """
+        if len(text) > self.max_bytes:
+            return
+        key = self._key(host, rec_id, frame)
+        entry = _Entry(text, etag, time.time(), get_record_ids(record) | {key[1]})
+        with self._lock:
+            if generation is not None and (generation < self._min_generation or any(
+                    self._invalidated.get((host, x), 0) > generation for x in entry.ids)):
+                DEBUG_LOGGER.debug("Not caching {}, invalidated while it was GOTTEN.".format(
+                    key[1]))
+                return
+            if key in self._entries:
+                # A stale record that the Portal sent anew.
+                eumetrics.METRICS.inc(METRIC_NAME, result="changed")
+            self._add(key, entry)
+        if self.cache_dir:
+            self._write(key, entry)
+
+    def revalidated(self, host, rec_id, frame=None):
+        """
+        Marks a cached record as fresh again, after the Portal reported that it didn't change.
+
+        Args:
+            host: `str`. The host name of the Portal.
+            rec_id: `str`. The identifier that the record was looked up by.
+            frame: `str`. The frame, i.e. 'edit'.
+        """
+        key = self._key(host, rec_id, frame)
+        eumetrics.METRICS.inc(METRIC_NAME, result="revalidated")
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.fetched_at = time.time()
+            entry.fresh = True
+        if self.cache_dir:
+            self._write(key, entry)
+
+    def invalidate(self, host, rec_ids):
+        """
+        Drops all the cached frames of a record, i.e. after it was PATCHED.
+
+        Args:
+            host: `str`. The host name of the Portal.
+            rec_ids: An iterable of `str`. Identifiers of the record. Any of them suffices, but
+              giving all of them (see ``get_record_ids()``) also drops the frames that were looked
+              up by another identifier and have since been dropped from memory.
+        """
+        rec_ids = set(x.strip("/") for x in rec_ids)
+        keys = set()
+        with self._lock:
+            self._generation += 1
+            for rec_id in rec_ids:
+                keys.update(self._keys_by_id.get((host, rec_id), ()))
+                self._invalidated[(host, rec_id)] = self._generation
+                self._invalidated.move_to_end((host, rec_id))
+            while len(self._invalidated) > MAX_INVALIDATIONS:
+                self._min_generation = self._invalidated.popitem(last=False)[1]
+            for key in keys:
+                self._remove(key)
+        if self.cache_dir:
+            for rec_id in rec_ids:
+                # The frames that the package looks records up with.
+                for frame in ("", "edit", "object", "embedded"):
+                    keys.add(self._key(host, rec_id, frame))
+            for key in keys:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+        if keys:
+            DEBUG_LOGGER.debug("Invalidated the cached record {}.".format(sorted(rec_ids)[0]))
+
+    def clear(self):
+        """Drops the records in memory. Those in the directory are left alone."""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+            self.size = 0
+
+    def _add(self, key, entry):
+        self._remove(key)
+        self._entries[key] = entry
+        self.size += len(entry.text)
+        for rec_id in entry.ids:
+            self._keys_by_id[(key[0], rec_id)].add(key)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry.text)
+        for rec_id in entry.ids:
+            keys = self._keys_by_id.get((key[0], rec_id))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_id[(key[0], rec_id)]
+
+    def _read(self, key):
+        try:
+            with open(self._path(key)) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        return _Entry(data["text"], data["etag"], data["fetched_at"], set(data["ids"]),
+                      fresh=False)
+
+    def _write(self, key, entry):
+        """
+        Writes an entry to the directory atomically, so that concurrent runs never see a partially
+        written file.
+        """
+        path = self._path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        data = {"text": entry.text, "etag": entry.etag, "fetched_at": entry.fetched_at,
+                "ids": sorted(entry.ids)}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w") as fh:
+                json.dump(data, fh)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            DEBUG_LOGGER.debug("Failed to write the cached record {}: {}".format(key[1], e))
+
+
+_record_cache = None
+_record_cache_lock = threading.Lock()
+
+
+def get_record_cache():
+    """
+    Returns:
+        ``RecordCache``: The cache shared by the package, created on the first call with the
+        defaults, or `None` if ``encode_utils.RECORD_CACHE_MAX_BYTES`` is 0.
+    """
+    global _record_cache
+    if not eu.RECORD_CACHE_MAX_BYTES:
+        return None
+    with _record_cache_lock:
+        if _record_cache is None:
+            _record_cache = RecordCache()
+        return _record_cache
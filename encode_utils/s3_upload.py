@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains classes for uploading files to the AWS S3 locations that the Portal assigns to file
+records, as an alternative to running the AWS CLI. An ``S3Upload`` uploads a single file in parts
+sent in parallel, retries each part on failure and can be resumed, while an ``UploadPipeline``
+runs many uploads in the background so that they overlap with other work, such as POSTING the
+metadata of the next file records.
+
+This module uses `botocore`, which is installed along with the `awscli` dependency of this
+package. Set ``encode_utils.S3_ENDPOINT_URL`` to upload to an S3-compatible server other than AWS,
+i.e. a local one for testing.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import urllib.parse
+
+import encode_utils as eu
+import encode_utils.metrics as eumetrics
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+#: An error ``logging`` instance.
+ERROR_LOGGER = logging.getLogger(eu.ERROR_LOGGER_NAME + "." + __name__)
+
+#: The default size in bytes of the parts of a multipart upload. Files up to this size are uploaded
+#: in a single request.
+PART_SIZE = 64 * 1024 * 1024
+#: The minimum part size allowed by S3, except for the last part.
+MIN_PART_SIZE = 5 * 1024 * 1024
+#: The maximum number of parts of a multipart upload allowed by S3.
+MAX_PARTS = 10000
+
+#: The directory storing the state of the multipart uploads that are in progress, so that they can
+#: be resumed.
+UPLOAD_STATE_DIR = os.path.join(os.path.expanduser("~"), ".encode_utils", "uploads")
+
+
+def parse_s3_url(url):
+    """
+    Args:
+        url: `str`. An S3 URL, i.e. s3://mybucket/path/to/reads.fastq.gz.
+
+    Returns:
+        `tuple`: The bucket and the key.
+    """
+    parsed = urllib.parse.urlparse(url)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def get_s3_client(credentials, endpoint_url=None):
+    """
+    Creates an S3 client from the upload credentials of a file record.
+
+    Args:
+        credentials: `dict`. The `upload_credentials` of the file record, with the `access_key`,
+          `secret_key` and `session_token` keys.
+        endpoint_url: `str`. Defaults to ``encode_utils.S3_ENDPOINT_URL``, or AWS when that is
+          empty.
+
+    Returns:
+        A `botocore` S3 client.
+    """
+    import botocore.session
+    if endpoint_url is None:
+        endpoint_url = eu.S3_ENDPOINT_URL
+    session = botocore.session.get_session()
+    return session.create_client(
+        "s3",
+        endpoint_url=endpoint_url or None,
+        aws_access_key_id=credentials["access_key"],
+        aws_secret_access_key=credentials["secret_key"],
+        aws_session_token=credentials.get("session_token"))
+
+
+def _retry(func, retries, description):
+    """
+    Calls `func`, retrying up to `retries` times with exponential backoff should it raise.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = 2 ** (attempt - 1)
+            DEBUG_LOGGER.debug("{} failed ({}). Retrying in {} seconds.".format(description, e, delay))
+            time.sleep(delay)
+
+
+class S3Upload:
+    """
+    Uploads a local file to S3. Files larger than `part_size` are sent as a multipart upload, with
+    up to `max_concurrency` parts in flight at once, and each part retried up to `retries` times.
+
+    The progress of a multipart upload (its upload ID, part size and the ETags of the completed
+    parts) is saved in a state file in `state_dir`, keyed on the destination, on the path, size and
+    modification time of the file, and on the part size. Should the upload be interrupted, a new
+    ``S3Upload`` of the same file to the same destination, with the same part size, only sends the
+    missing parts.
+
+    Args:
+        file_path: `str`. The path to the local file.
+        upload_url: `str`. The S3 URL to upload to.
+        credentials: `dict`. See ``get_s3_client()``.
+        part_size: `int`. See above.
+        max_concurrency: `int`. See above.
+        retries: `int`. See above.
+        state_dir: `str`. Defaults to ``UPLOAD_STATE_DIR``.
+        endpoint_url: `str`. See ``get_s3_client()``.
+    """
+
+    def __init__(self, file_path, upload_url, credentials, part_size=PART_SIZE, max_concurrency=4,
+                 retries=3, state_dir=UPLOAD_STATE_DIR, endpoint_url=None):
+        self.file_path = file_path
+        self.upload_url = upload_url
+        self.bucket, self.key = parse_s3_url(upload_url)
+        self.client = get_s3_client(credentials, endpoint_url)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        stat = os.stat(file_path)
+        #: The size of the file in bytes.
+        self.size = stat.st_size
+        # The part size is raised when needed to stay within the limit on the number of parts.
+        self.part_size = max(part_size, MIN_PART_SIZE, int(math.ceil(self.size / MAX_PARTS)))
+        # The part size is part of the key, since parts of another size can't be mixed with these.
+        state_key = json.dumps([upload_url, os.path.realpath(file_path), self.size,
+                                stat.st_mtime_ns, self.part_size])
+        self.state_path = os.path.join(
+            state_dir, hashlib.md5(state_key.encode("utf-8")).hexdigest() + ".json")
+        self._state_lock = threading.Lock()
+
+    def run(self):
+        """
+        Uploads the file.
+        """
+        DEBUG_LOGGER.debug("Uploading {} to {}.".format(self.file_path, self.upload_url))
+        with eumetrics.METRICS.timer(eumetrics.OP_UPLOAD):
+            if self.size <= self.part_size:
+                with open(self.file_path, "rb") as fh:
+                    body = fh.read()
+                _retry(lambda: self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body),
+                       self.retries, "Upload of {}".format(self.file_path))
+            else:
+                self._run_multipart()
+        DEBUG_LOGGER.debug("Uploaded {} to {}.".format(self.file_path, self.upload_url))
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if state.get("part_size") != self.part_size:
+            DEBUG_LOGGER.debug("Can't resume the upload of {}: it used another part size.".format(
+                self.file_path))
+            return None
+        try:
+            # Make sure that the upload can still be resumed.
+            self.client.list_parts(Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"])
+        except Exception as e:
+            DEBUG_LOGGER.debug("Can't resume the upload of {}: {}".format(self.file_path, e))
+            return None
+        return state
+
+    def _save_state(self, state):
+        with self._state_lock:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump(state, fh)
+            os.replace(tmp_path, self.state_path)
+
+    def _upload_part(self, state, part_number):
+        offset = (part_number - 1) * self.part_size
+        with open(self.file_path, "rb") as fh:
+            fh.seek(offset)
+            body = fh.read(self.part_size)
+
+        def upload():
+            return self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"],
+                PartNumber=part_number, Body=body)
+        response = _retry(upload, self.retries, "Upload of part {} of {}".format(
+            part_number, self.file_path))
+        with self._state_lock:
+            state["parts"][str(part_number)] = response["ETag"]
+        self._save_state(state)
+
+    def _run_multipart(self):
+        state = self._load_state()
+        if state:
+            DEBUG_LOGGER.debug("Resuming the upload of {}: {} parts already uploaded.".format(
+                self.file_path, len(state["parts"])))
+        else:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            state = {"upload_id": response["UploadId"], "part_size": self.part_size, "parts": {}}
+            self._save_state(state)
+
+        num_parts = int(math.ceil(self.size / self.part_size))
+        missing = [x for x in range(1, num_parts + 1) if str(x) not in state["parts"]]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(self._upload_part, state, x) for x in missing]
+            for future in concurrent.futures.as_completed(futures):
+                # Raises the error of a part that failed for good, keeping the state for resuming.
+                future.result()
+
+        parts = [{"PartNumber": x, "ETag": state["parts"][str(x)]} for x in range(1, num_parts + 1)]
+        _retry(lambda: self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"],
+            MultipartUpload={"Parts": parts}), self.retries, "Completion of the upload of {}".format(
+                self.file_path))
+        os.remove(self.state_path)
+
+
+class UploadPipeline:
+    """
+    Runs uploads in background threads, up to `max_uploads` at once, so that the caller can go on
+    with other work in the meantime. Should be closed with ``self.close()`` (or used as a context
+    manager), which waits for the uploads that are still running.
+
+    Args:
+        max_uploads: `int`. The maximum number of files uploaded at once.
+        upload_kwargs: Passed on to each ``S3Upload``, i.e. `part_size` or `max_concurrency`.
+    """
+
+    def __init__(self, max_uploads=2, **upload_kwargs):
+        self.upload_kwargs = upload_kwargs
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_uploads)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, file_path, upload_url, credentials, label=None):
+        """
+        Queues the upload of a file.
+
+        Args:
+            file_path: `str`. See ``S3Upload``.
+            upload_url: `str`. See ``S3Upload``.
+            credentials: `dict`. See ``S3Upload``.
+            label: Anything identifying the upload in the return value of ``self.close()``, i.e. a
+              line number. Defaults to `file_path`.
+
+        Returns:
+            `concurrent.futures.Future`: Completes once the upload is done.
+        """
+        if label is None:
+            label = file_path
+
+        def upload():
+            S3Upload(file_path, upload_url, credentials, **self.upload_kwargs).run()
+        future = self._executor.submit(upload)
+        self._futures.append((label, file_path, future))
+        return future
+
+    def close(self):
+        """
+        Waits for all uploads to finish.
+
+        Returns:
+            `list`: The (label, exception) tuples of the uploads that failed.
+        """
+        self._executor.shutdown(wait=True)
+        failures = []
+        for label, file_path, future in self._futures:
+            error = future.exception()
+            if error:
+                ERROR_LOGGER.error("Failed to upload {}: {}".format(file_path, error))
+                failures.append((label, error))
+        self._futures = []
+        return failures
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Contains the factory of the ``requests.Session`` through which the package talks to the Portal.
+A session keeps its connections alive in a pool, so that the TCP and TLS handshakes are only done
+once per pooled connection rather than once per request, which is what dominates the latency of
+the small requests that the package makes. The package shares a single session, returned by
+``get_session()``, whose pool should be at least as large as the number of threads using it (see
+``set_pool_size()``).
+
+Requests made with the idempotent methods are retried by urllib3 on connection errors and on the
+statuses in ``RETRY_STATUSES``, with an exponential backoff that honors the `Retry-After` header.
+"""
+
+import logging
+import threading
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+import encode_utils as eu
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The methods whose requests are retried. The others are only retried when the connection
+#: couldn't be established, since the Portal can't have acted upon them then.
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+#: The statuses upon which the requests are retried.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+#: The backoff factor of the retries: the n-th retry waits for this many seconds times 2 ** (n - 1).
+RETRY_BACKOFF = 0.5
+
+#: The headers sent with each request of the sessions.
+DEFAULT_HEADERS = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+
+
+def get_retry(retries=None):
+    """
+    Args:
+        retries: `int`. The maximum number of retries of a request. Defaults to
+          ``encode_utils.HTTP_RETRIES``.
+
+    Returns:
+        `urllib3.util.retry.Retry`: The retry policy of the sessions.
+    """
+    if retries is None:
+        retries = eu.HTTP_RETRIES
+    kwargs = {"total": retries, "backoff_factor": RETRY_BACKOFF,
+              "status_forcelist": RETRY_STATUSES, "respect_retry_after_header": True,
+              # Leave it to the caller to handle the last response.
+              "raise_on_status": False}
+    try:
+        return urllib3.util.retry.Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26.
+        return urllib3.util.retry.Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def create_session(pool_size=None, retries=None):
+    """
+    Creates a session with a pool of keep-alive connections per host, the retry policy of
+    ``get_retry()`` and the ``DEFAULT_HEADERS``.
+
+    Args:
+        pool_size: `int`. The maximum number of connections kept alive per host. Defaults to
+          ``encode_utils.HTTP_POOL_SIZE``.
+        retries: `int`. See ``get_retry()``.
+
+    Returns:
+        `requests.Session`: The session.
+    """
+    if pool_size is None:
+        pool_size = eu.HTTP_POOL_SIZE
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=get_retry(retries))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session = None
+_pool_size = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns:
+        `requests.Session`: The session shared by the package, created on the first call.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = create_session(_pool_size)
+        return _session
+
+
+def set_pool_size(pool_size):
+    """
+    Sets the size of the connection pool of the shared session, which should be at least the
+    number of threads making requests, i.e. the --workers option of ``eu_register.py``. The pool
+    is never made smaller than ``encode_utils.HTTP_POOL_SIZE``. Should the shared session already
+    exist with another pool size, it's replaced, so this is best called before making requests.
+
+    Args:
+        pool_size: `int`. The size of the pool.
+    """
+    global _session, _pool_size
+    pool_size = max(pool_size, eu.HTTP_POOL_SIZE)
+    with _lock:
+        if pool_size == (_pool_size or eu.HTTP_POOL_SIZE):
+            return
+        _pool_size = pool_size
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+    DEBUG_LOGGER.debug("HTTP connection pool size set to {}.".format(pool_size))
+
+
+def close_session():
+    """Closes the connections of the shared session. It's created anew by ``get_session()``."""
+    global _session
+    with _lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
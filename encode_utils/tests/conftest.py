@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Fixtures shared by the tests, which run offline against a synthetic profiles document.
+"""
+
+import pytest
+
+import encode_utils.profiles as eup
+
+
+def make_profiles_doc():
+    """
+    Returns:
+        `dict`: A small profiles document, in the format served by the Portal's profiles endpoint.
+    """
+    file_props = {
+        "submitted_file_name": {"type": "string"},
+        "md5sum": {"type": "string"},
+    }
+    widget_props = {
+        "schema_version": {"type": "string", "default": "1"},
+        "count": {"type": "integer"},
+        "amount": {"type": "number"},
+        "flag": {"type": "boolean"},
+        "label": {"type": "string"},
+        "status": {"type": "string", "enum": ["in progress", "released"]},
+        "code": {"type": "string", "pattern": "^W[0-9]+$"},
+    }
+    genetic_modification_props = {
+        "uuid": {"type": "string", "readonly": True},
+        "accession": {"type": "string", "readonly": True},
+        "submitted_by": {"type": "string", "notSubmittable": True},
+        "aliases": {"type": "array", "items": {"type": "string"}},
+        "description": {"type": "string"},
+    }
+    gadget_props = {
+        "award": {"type": "string"},
+        "lab": {"type": "string"},
+        "aliases": {"type": "array", "items": {"type": "string"}},
+        "sizes": {"type": "array", "items": {"type": "integer"}},
+        "treatment": {"type": "object"},
+        "tags": {"type": "array", "items": {"type": "object"}},
+        "part_of": {"type": "string", "linkTo": "Gadget"},
+        "parts": {"type": "array", "items": {"type": "string", "linkTo": "Gadget"}},
+    }
+    return {
+        # Profile.set_profiles() requires the file profile.
+        "File": {"id": "/profiles/file.json", "title": "File", "type": "object",
+                 "required": [], "properties": file_props},
+        "Widget": {"id": "/profiles/widget.json", "title": "Widget", "type": "object",
+                   "required": [], "properties": widget_props},
+        "GeneticModification": {"id": "/profiles/genetic_modification.json",
+                                "title": "Genetic modification", "type": "object",
+                                "required": ["description"],
+                                "identifyingProperties": ["uuid", "accession", "aliases"],
+                                "properties": genetic_modification_props},
+        "Gadget": {"id": "/profiles/gadget.json", "title": "Gadget", "type": "object",
+                   "required": [], "properties": gadget_props},
+        "_subtypes": {},
+        "@type": ["JSONSchemas"],
+    }
+
+
+@pytest.fixture(scope="class")
+def profiles_doc(request):
+    """
+    The document of ``make_profiles_doc()``, also set as the `profiles_doc` attribute of the test
+    class.
+    """
+    doc = make_profiles_doc()
+    if request.cls is not None:
+        request.cls.profiles_doc = doc
+    return doc
+
+
+@pytest.fixture(scope="class")
+def synthetic_profiles(profiles_doc):
+    """
+    Sets the profiles of ``encode_utils.profiles.Profile`` to those of ``profiles_doc``.
+    """
+    eup.Profile.set_profiles(eup._format_profiles(make_profiles_doc()))
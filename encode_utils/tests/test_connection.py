@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.connection`` module, offline, with the requests to the Portal answered
+by the test.
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+import requests
+
+import encode_utils as eu
+import encode_utils.connection as euc
+import encode_utils.logs as eulogs
+import encode_utils.metrics as eumetrics
+import encode_utils.record_cache as eurc
+import encode_utils.sessions as eusessions
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+def make_response(status_code, doc=None, etag=None):
+    """
+    Returns:
+        `requests.Response`: A response with the given status code, JSON body and `ETag` header.
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(doc if doc is not None else {}).encode("utf-8")
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestConnection(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.connection.Connection``.
+    """
+
+    def setUp(self):
+        self.record_cache = eurc.RecordCache(max_bytes=1024 * 1024, ttl=300, cache_dir="")
+        with mock.patch.object(eulogs, "add_dcc_log_files"):
+            self.conn = euc.Connection("portal.example.org", record_cache=self.record_cache)
+        #: The (method, url, payload) of the requests sent.
+        self.requests = []
+        #: The other arguments of these requests.
+        self.request_kwargs = []
+        #: The responses to these requests, in order.
+        self.responses = []
+        patcher = mock.patch.object(self.conn.session, "request", self._request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request(self, method, url, data=None, **kwargs):
+        self.requests.append((method, url, json.loads(data) if data else None))
+        self.request_kwargs.append(kwargs)
+        return self.responses.pop(0)
+
+    def test_shared_session(self):
+        """
+        Tests that the requests go through the session shared by the package, with the credentials
+        and the JSON content type given per request rather than set on the session.
+        """
+        self.assertIs(self.conn.session, eusessions.get_session())
+        with mock.patch.dict(os.environ, {"DCC_API_KEY": "key", "DCC_SECRET_KEY": "secret"}), \
+                mock.patch.object(eulogs, "add_dcc_log_files"):
+            conn = euc.Connection("portal.example.org", record_cache=self.record_cache)
+        self.conn.auth = (None, None)
+        self.responses.extend([make_response(200, {}), make_response(200, {})])
+        conn.get("ENCGD000AAA")
+        self.conn.get("ENCGD000AAB")
+        self.assertEqual(self.request_kwargs[0]["auth"], ("key", "secret"))
+        self.assertEqual(self.request_kwargs[0]["headers"], {"content-type": "application/json"})
+        self.assertIsNone(self.request_kwargs[1]["auth"])
+        self.assertIsNone(eusessions.get_session().auth)
+
+    def test_post_sets_defaults(self):
+        """
+        Tests that a POST goes to the collection of the profile, without the profile key, and with
+        the default award and lab.
+        """
+        record = {"@id": "/gadgets/g1/", "uuid": "u1"}
+        self.responses.append(make_response(201, {"@graph": [record]}))
+        with mock.patch.object(eu, "AWARD", {"award": "a1"}), \
+                mock.patch.object(eu, "LAB", {"lab": "l1"}):
+            result = self.conn.post({eu.PROFILE_KEY: "gadget", "aliases": ["l1:g1"]})
+        self.assertEqual(result, record)
+        method, url, payload = self.requests[0]
+        self.assertEqual((method, url), ("POST", "https://portal.example.org/gadget/"))
+        self.assertEqual(payload, {"aliases": ["l1:g1"], "award": "a1", "lab": "l1"})
+
+    def test_post_requires_aliases(self):
+        """
+        Tests that a payload without aliases is refused unless aliases aren't required.
+        """
+        with self.assertRaises(Exception):
+            self.conn.post({eu.PROFILE_KEY: "gadget"})
+        self.assertEqual(self.requests, [])
+
+    def test_post_conflict_returns_existing_record(self):
+        """
+        Tests that a POST refused with a 409 returns the existing record with that alias.
+        """
+        record = {"@id": "/gadgets/g1/", "aliases": ["l1:g1"]}
+        self.responses.extend([make_response(409), make_response(200, record)])
+        self.assertEqual(self.conn.post({eu.PROFILE_KEY: "gadget", "aliases": ["l1:g1"]}), record)
+        self.assertEqual(self.requests[1][0], "GET")
+        self.assertIn("/l1:g1/", self.requests[1][1])
+
+    def test_post_error_raises_http_error(self):
+        """
+        Tests that a POST refused by the Portal raises a ``requests.HTTPError`` with the response.
+        """
+        self.responses.append(make_response(422, {"errors": ["bad"]}))
+        with self.assertRaises(requests.HTTPError) as cm:
+            self.conn.post({eu.PROFILE_KEY: "gadget", "aliases": ["l1:g1"]})
+        self.assertEqual(cm.exception.response.status_code, 422)
+
+    def test_post_file_record(self):
+        """
+        Tests that POSTING a file record sets its md5sum and file name, and uploads the file.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "reads.fastq")
+            with open(path, "wb") as fh:
+                fh.write(b"ACGT\n")
+            record = {"@id": "/files/f1/", "upload_credentials": {"upload_url": "s3://b/f1"}}
+            self.responses.append(make_response(201, {"@graph": [record]}))
+            with mock.patch.object(self.conn, "upload_file") as upload_file, \
+                    mock.patch.object(eu, "MD5_CACHE_PATH", ""):
+                self.conn.post({eu.PROFILE_KEY: "file", "aliases": ["l1:f1"],
+                                "submitted_file_name": path})
+        payload = self.requests[0][2]
+        self.assertEqual(payload["submitted_file_name"], "reads.fastq")
+        self.assertEqual(payload["md5sum"], hashlib.md5(b"ACGT\n").hexdigest())
+        upload_file.assert_called_once_with(record, path)
+
+    def test_patch_extends_arrays(self):
+        """
+        Tests that array values of a PATCH extend those of the record, without duplicates.
+        """
+        self.responses.extend([make_response(200, {"aliases": ["l1:g1"]}),
+                               make_response(200, {"@graph": [{"@id": "/gadgets/g1/"}]})])
+        self.conn.patch({eu.ENCID_KEY: "ENCGD000AAA", "aliases": ["l1:g1", "l1:g2"]})
+        self.assertIn("frame=edit", self.requests[0][1])
+        method, url, payload = self.requests[1]
+        self.assertEqual((method, url), ("PATCH", "https://portal.example.org/ENCGD000AAA"))
+        self.assertEqual(payload, {"aliases": ["l1:g1", "l1:g2"]})
+
+    def test_get_goes_through_record_cache(self):
+        """
+        Tests that a record GOTTEN again is served from the cache, and that an expired one is
+        revalidated with its ETag, whichever instance of the record the Portal sends back.
+        """
+        record = {"@id": "/gadgets/g1/", "accession": "ENCGD000AAA", "sizes": [1]}
+        self.responses.extend([make_response(200, record, etag='"v1"'), make_response(304)])
+        self.assertEqual(self.conn.get("ENCGD000AAA"), record)
+        self.assertEqual(self.conn.get("ENCGD000AAA"), record)
+        self.assertEqual(len(self.requests), 1)
+        self.record_cache.ttl = 0
+        self.assertEqual(self.conn.get("ENCGD000AAA"), record)
+        self.assertEqual(self.request_kwargs[1]["headers"]["If-None-Match"], '"v1"')
+        self.assertEqual(self.request_kwargs[1]["headers"]["content-type"], "application/json")
+
+    def test_patch_revalidates_and_invalidates(self):
+        """
+        Tests that the edit frame that arrays are extended from is revalidated even when fresh,
+        and that the PATCH drops the cached frames of the record, whichever identifier they were
+        GOTTEN by.
+        """
+        record = {"@id": "/gadgets/g1/", "accession": "ENCGD000AAA", "aliases": ["l1:g1"],
+                  "sizes": [1]}
+        self.responses.extend([
+            make_response(200, record, etag='"v1"'),
+            make_response(200, record, etag='"v1"'),
+            make_response(200, dict(record, sizes=[1, 2]), etag='"v2"'),
+            make_response(200, {"@graph": [dict(record, sizes=[1, 2, 3])]})])
+        self.conn.get("l1:g1")
+        self.conn.get("ENCGD000AAA", frame="edit")
+        self.conn.patch({eu.ENCID_KEY: "ENCGD000AAA", "sizes": [3]})
+        self.assertEqual(self.request_kwargs[2]["headers"]["If-None-Match"], '"v1"')
+        self.assertEqual(self.requests[3][2], {"sizes": [1, 2, 3]})
+        self.assertEqual(len(self.record_cache), 0)
+
+    def test_search(self):
+        """
+        Tests that the query tuples are URL encoded, and that a search without results gives an
+        empty list.
+        """
+        self.responses.extend([make_response(200, {"@graph": [{"@id": "/gadgets/g1/"}]}),
+                               make_response(404)])
+        self.assertEqual(self.conn.search([("type", "Gadget"), ("aliases", "l1:g1")]),
+                         [{"@id": "/gadgets/g1/"}])
+        self.assertIn("type=Gadget&aliases=l1%3Ag1", self.requests[0][1])
+        self.assertEqual(self.conn.search([("type", "Gadget")]), [])
+
+    def test_get_missing_record(self):
+        """
+        Tests that a missing record gives an empty `dict`, or an error when 404s aren't ignored.
+        """
+        self.responses.extend([make_response(404), make_response(404)])
+        self.assertEqual(self.conn.get("ENCGD000AAA"), {})
+        with self.assertRaises(requests.HTTPError):
+            self.conn.get("ENCGD000AAA", ignore404=False)
+
+    def test_records_metrics(self):
+        """
+        Tests that the latency of each request is recorded under its operation, and that only
+        error statuses other than 404 are counted as errors.
+        """
+        self.responses.extend([make_response(404), make_response(200, {"@graph": []}),
+                               make_response(500)])
+        with mock.patch.object(eumetrics, "METRICS", eumetrics.Metrics()) as metrics:
+            self.conn.get("ENCGD000AAA")
+            self.conn.search([("type", "Gadget")])
+            with self.assertRaises(requests.HTTPError):
+                self.conn.get("ENCGD000AAB")
+        operations = metrics.snapshot()["operations"]
+        self.assertEqual(sorted(operations), ["get", "search"])
+        self.assertEqual((operations["get"]["count"], operations["get"]["errors"]), (2, 1))
+        self.assertEqual((operations["search"]["count"], operations["search"]["errors"]), (1, 0))
+
+    def test_attachment_path(self):
+        """
+        Tests that an attachment given by its path is embedded as a data URI.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "protocol.txt")
+            with open(path, "w") as fh:
+                fh.write("hi")
+            payload = {"attachment": {"path": path}}
+            self.conn.set_attachment(payload)
+        self.assertEqual(payload["attachment"], {
+            "download": "protocol.txt", "type": "text/plain", "href": "data:text/plain;base64,aGk="})
+
+    def test_dry_run(self):
+        """
+        Tests that nothing is sent in dry-run mode.
+        """
+        self.conn.dry_run = True
+        self.assertEqual(self.conn.post({eu.PROFILE_KEY: "gadget", "aliases": ["l1:g1"]}), {})
+        self.assertEqual(self.conn.patch({eu.ENCID_KEY: "ENCGD000AAA", "sizes": [1]},
+                                         extend_array_values=False), {})
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests functions in the ``encode_utils.MetaDataRegistration.eu_register`` module, offline, against
+a synthetic profile.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pytest
+
+import encode_utils as eu
+import encode_utils.connection as euc
+import encode_utils.profiles as eup
+import encode_utils.utils as euu
+import encode_utils.MetaDataRegistration.eu_register as eur
+
+
+def _write_tsv(tmp_dir, lines):
+    """
+    Writes the given lines to a tab-delimited input file in `tmp_dir`, and returns its path.
+    """
+    infile = os.path.join(tmp_dir, "records.tsv")
+    with open(infile, "w") as fh:
+        for line in lines:
+            fh.write(line + "\n")
+    return infile
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestCreatePayloads(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.create_payloads()``.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def _create_payloads(self, profile_id, lines):
+        return list(eur.create_payloads(profile_id, _write_tsv(self.tmp_dir, lines)))
+
+    def test_scalar_types(self):
+        """
+        Tests that values are cast to the schema type of their column.
+        """
+        payloads = self._create_payloads("widget", [
+            "count\tamount\tflag\tlabel",
+            "3\t2.5\tTRUE\t7",
+            "4\t2\tfalse\tx",
+        ])
+        self.assertEqual(payloads, [
+            {eu.PROFILE_KEY: "widget", "count": 3, "amount": 2.5, "flag": True, "label": "7"},
+            {eu.PROFILE_KEY: "widget", "count": 4, "amount": 2, "flag": False, "label": "x"},
+        ])
+
+    def test_arrays_and_objects(self):
+        """
+        Tests that arrays are split on commas and their items cast, that the JSON array literal
+        is optional, and that objects are parsed as JSON.
+        """
+        payloads = self._create_payloads("gadget", [
+            "aliases\tsizes\ttreatment\ttags",
+            'lab:g1, "lab:g2"\t[1, 2]\t{"name": "a"}\t{"n": 1}, {"n": 2}',
+        ])
+        self.assertEqual(payloads, [{
+            eu.PROFILE_KEY: "gadget",
+            "aliases": ["lab:g1", "lab:g2"],
+            "sizes": [1, 2],
+            "treatment": {"name": "a"},
+            "tags": [{"n": 1}, {"n": 2}],
+        }])
+
+    def test_record_id_comment_and_empty_cells(self):
+        """
+        Tests that the record_id column is kept as is, that '#' columns and commented out rows
+        are dropped, and that empty cells are left out of the payload.
+        """
+        payloads = self._create_payloads("widget", [
+            "record_id\t#notes\tcount\tlabel",
+            "ENCW1\tignored\t\tx",
+            "#ENCW2\tignored\t2\ty",
+            "",
+            "ENCW3\tignored\t5",
+        ])
+        self.assertEqual(payloads, [
+            {eu.PROFILE_KEY: "widget", eur.RECORD_ID_FIELD: "ENCW1", "label": "x"},
+            {eu.PROFILE_KEY: "widget", eur.RECORD_ID_FIELD: "ENCW3", "count": 5},
+        ])
+
+    def test_unknown_field(self):
+        """
+        Tests that a column that isn't a property of the profile is refused.
+        """
+        with self.assertRaises(Exception) as cm:
+            self._create_payloads("widget", ["count\tcolour", "1\tred"])
+        self.assertIn("colour", str(cm.exception))
+
+    def test_invalid_value(self):
+        """
+        Tests that a value that can't be cast to the type of its column raises a ValueError.
+        """
+        with self.assertRaises(ValueError):
+            self._create_payloads("widget", ["flag", "maybe"])
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestValidate(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.validate()``.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def _validate(self, profile_id, lines, **kwargs):
+        errors = eur.validate(profile_id, _write_tsv(self.tmp_dir, lines), batch_size=2, **kwargs)
+        return [tuple(x) for x in errors]
+
+    def test_valid_file(self):
+        """
+        Tests that a valid file gives no errors.
+        """
+        self.assertEqual(self._validate("widget", [
+            "count\tstatus\tcode", "1\treleased\tW1", "2\treleased\tW2", "3\tin progress\tW3"]), [])
+
+    def test_header_errors(self):
+        """
+        Tests that non-writable properties and required properties without a column are reported
+        against the header rather than a row.
+        """
+        errors = self._validate("genetic_modification", ["accession\taliases", "ENCGM1\tlab:g1"])
+        self.assertEqual(errors, [(eur.HEADER_LINE, "accession", "Property isn't writable."),
+                                  (eur.HEADER_LINE, "description", "Missing required field.")])
+        errors = self._validate("widget", ["count\tcolour", "1\tred"])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("colour", errors[0][2])
+
+    def test_patch_requires_record_id(self):
+        """
+        Tests that in PATCH mode only the record_id field is required.
+        """
+        errors = self._validate("genetic_modification", ["aliases", "lab:g1"], patch=True)
+        self.assertEqual(errors, [
+            (eur.HEADER_LINE, eur.RECORD_ID_FIELD, "Missing required field.")])
+
+    def test_cell_errors(self):
+        """
+        Tests that values breaking the type, enum and pattern rules, and missing required values,
+        are reported with their line, across batches.
+        """
+        errors = self._validate("genetic_modification", [
+            "aliases\tdescription", "lab:g1\td", "lab:g2\t", "#lab:g3\t", "lab:g4\td"])
+        self.assertEqual(errors, [(3, "description", "Missing required value.")])
+        errors = self._validate("widget", [
+            "flag\tstatus\tcode", "true\treleased\tW1", "maybe\tdone\tW1", "false\treleased\tX1"])
+        self.assertEqual([x[:2] for x in errors], [(3, "flag"), (3, "status"), (4, "code")])
+
+    def test_json_lines(self):
+        """
+        Tests that the lines of a JSON Lines file that can't be read are reported one by one, and
+        that the others are still checked, with the fields of all the objects.
+        """
+        infile = os.path.join(self.tmp_dir, "records.jsonl")
+        with open(infile, "w") as fh:
+            fh.write('{"count": 1}\n{"count": 2, "status": "done"}\n{bad\n[1]\n{"code": "X1"}\n')
+        errors = [tuple(x) for x in eur.validate("widget", infile, batch_size=2)]
+        self.assertEqual([x[:2] for x in errors],
+                         [(2, "status"), (3, None), (4, None), (5, "code")])
+        self.assertIn("invalid JSON", errors[1][2])
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestReportValidationErrors(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.report_validation_errors()``.
+    """
+
+    def test_invalid_json_is_reported(self):
+        """
+        Tests that invalid JSON values are reported as rows of the tab-delimited report, and that
+        nothing else is written to STDOUT.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            infile = _write_tsv(tmp_dir, [
+                "aliases\ttreatment\ttags",
+                'lab:g1\t{"name": "a"}\t{"name": "b"}',
+                "lab:g2\t{bad\t{bad",
+            ])
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                num_errors = eur.report_validation_errors("gadget", infile)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(num_errors, 2)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual([x.split("\t")[:2] for x in lines], [["3", "treatment"], ["3", "tags"]])
+
+    def test_counts_rows(self):
+        """
+        Tests that the number of rows counted by the validation is the one of ``count_rows()``.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            infile = _write_tsv(tmp_dir, ["aliases\ttreatment", "# comment", ""] + [
+                'lab:g{}\t{{"name": "a"}}'.format(i) for i in range(25)])
+            counts = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                eur.report_validation_errors("gadget", infile, counts=counts)
+            self.assertEqual(counts, {"rows": eur.count_rows(infile)})
+            self.assertEqual(counts["rows"], 25)
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    """
+    Tests the resolution of link aliases by ``resolve_links()`` ahead of ``get_patch_diff()``.
+    """
+
+    def setUp(self):
+        self.record_index = eur.get_record_index([
+            {"@id": "/gadgets/ENCGD000AAA/", "accession": "ENCGD000AAA", "aliases": ["lab:g1"],
+             "documents": ["/documents/d1/"]},
+            {"@id": "/documents/d1/", "aliases": ["lab:doc1"]},
+            {"@id": "/documents/d2/", "aliases": ["lab:doc2"]},
+        ])
+        self.record = self.record_index["ENCGD000AAA"]
+
+    def _get_diff(self, props):
+        props = eur.resolve_links(props, ["documents"], self.record_index)
+        return eur.get_patch_diff(props, self.record, ["documents"], extend_arrays=True)
+
+    def test_alias_of_linked_record_is_unchanged(self):
+        """
+        Tests that a link given by the alias of a record already linked doesn't count as a change.
+        """
+        self.assertEqual(self._get_diff({"documents": ["lab:doc1"]}), {})
+
+    def test_extended_array_has_no_duplicates(self):
+        """
+        Tests that an array extended with aliases references each record once.
+        """
+        diff = self._get_diff({"documents": ["lab:doc1", "lab:doc2", "/documents/d2/"]})
+        self.assertEqual(diff, {"documents": ["/documents/d1/", "/documents/d2/"]})
+
+    def test_full_record_wins(self):
+        """
+        Tests that the identifiers of a linked record, listed last, don't replace its full record.
+        """
+        index = eur.get_record_index([self.record, {"@id": "/gadgets/ENCGD000AAA/"}])
+        self.assertIs(index["/gadgets/ENCGD000AAA/"], self.record)
+
+
+class FakeConnection:
+    """
+    Stands in for ``encode_utils.connection.Connection``, recording the payloads submitted. A
+    payload with an alias in ``refused`` is refused.
+    """
+    PROFILE_KEY = euc.Connection.PROFILE_KEY
+    ENCID_KEY = euc.Connection.ENCID_KEY
+
+    #: The aliases of the payloads that are refused.
+    refused = ("lab:bad",)
+    #: The records on the Portal, as returned by ``self.search()``.
+    existing = ()
+
+    def __init__(self, dcc_mode=None, dry_run=False):
+        self.posted = []
+        self.patched = []
+        self.queries = []
+        FakeConnection.instance = self
+
+    def post(self, payload, require_aliases=True):
+        if payload["aliases"][0] in self.refused:
+            raise Exception("Refused.")
+        self.posted.append(payload)
+        return {"uuid": payload["aliases"][0]}
+
+    def patch(self, payload, extend_array_values=True):
+        self.patched.append(payload)
+        return {"uuid": payload[self.ENCID_KEY]}
+
+    def search(self, query):
+        self.queries.append(query)
+        return list(self.existing)
+
+
+class TestSubmitConcurrently(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.submit_concurrently()``.
+    """
+
+    def test_results_in_input_order(self):
+        """
+        Tests that results come in the order of the rows, whatever the order of completion, and
+        that errors are stored in the results rather than raised.
+        """
+        def submit(payload):
+            time.sleep(payload["delay"])
+            if payload.get("fail"):
+                raise ValueError("Refused.")
+            return payload["delay"]
+
+        rows = [(2, {"delay": 0.03}), (3, {"delay": 0}), (4, {"delay": 0.01, "fail": True}),
+                (5, {"delay": 0})]
+        results = list(eur.submit_concurrently(submit, rows, workers=4))
+        self.assertEqual([x.line for x in results], [2, 3, 4, 5])
+        self.assertEqual([x.response for x in results], [0.03, 0, None, 0])
+        self.assertIsInstance(results[2].error, ValueError)
+
+    def test_pending_is_bounded(self):
+        """
+        Tests that no more than `max_pending` rows are read ahead of the results reported.
+        """
+        lock = threading.Lock()
+        state = {"read": 0, "reported": 0, "max_ahead": 0}
+
+        def rows():
+            for line in range(100):
+                with lock:
+                    state["read"] += 1
+                    state["max_ahead"] = max(state["max_ahead"], state["read"] - state["reported"])
+                yield line, {}
+
+        for result in eur.submit_concurrently(lambda payload: None, rows(), workers=2,
+                                              max_pending=3):
+            with lock:
+                state["reported"] += 1
+        self.assertEqual(state["reported"], 100)
+        self.assertLessEqual(state["max_ahead"], 3)
+
+    def test_async_results_in_input_order(self):
+        """
+        Tests that ``submit_concurrently_async()`` also gives the results in the order of the rows.
+        """
+        async def submit(payload):
+            await asyncio.sleep(payload["delay"])
+            if payload.get("fail"):
+                raise ValueError("Refused.")
+            return payload["delay"]
+
+        async def collect():
+            rows = [(2, {"delay": 0.03}), (3, {"delay": 0, "fail": True}), (4, {"delay": 0})]
+            return [x async for x in eur.submit_concurrently_async(submit, rows, workers=3)]
+
+        results = asyncio.run(collect())
+        self.assertEqual([x.line for x in results], [2, 3, 4])
+        self.assertEqual([x.response for x in results], [0.03, None, 0])
+        self.assertIsInstance(results[1].error, ValueError)
+
+
+class TestSubmitPayload(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.submit_payload()``.
+    """
+
+    def test_patch_uses_record_id(self):
+        """
+        Tests that a PATCH identifies the record by the record_id field.
+        """
+        conn = FakeConnection()
+        eur.submit_payload(conn, {eur.RECORD_ID_FIELD: "ENCGD000AAA", "sizes": [1]}, patch=True)
+        self.assertEqual(conn.patched, [{eu.ENCID_KEY: "ENCGD000AAA", "sizes": [1]}])
+
+    def test_patch_requires_record_id(self):
+        """
+        Tests that a PATCH without a record_id field is refused.
+        """
+        with self.assertRaises(Exception) as cm:
+            eur.submit_payload(FakeConnection(), {"sizes": [1]}, patch=True)
+        self.assertIn(eur.RECORD_ID_FIELD, str(cm.exception))
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestGetWaves(unittest.TestCase):
+    """
+    Tests the functions ``encode_utils.MetaDataRegistration.eu_register.get_link_fields()`` and
+    ``get_waves()``.
+    """
+
+    def setUp(self):
+        self.link_fields = eur.get_link_fields(eup.Profile("gadget"))
+
+    def test_link_fields(self):
+        """
+        Tests that properties linking to records, directly or through their items, are found.
+        """
+        self.assertEqual(sorted(self.link_fields), ["part_of", "parts"])
+
+    def test_waves(self):
+        """
+        Tests that rows come in the wave after those they reference, in input order within a wave,
+        whether the reference carries the lab prefix or not.
+        """
+        rows = [
+            (2, {"aliases": ["lab:a"], "part_of": "lab:b"}),
+            (3, {"aliases": ["lab:b"]}),
+            (4, {"aliases": ["lab:c"], "parts": ["a", "lab:b"]}),
+            (5, {"aliases": ["lab:d"], "part_of": "ENCGD000AAA"}),
+        ]
+        with mock.patch.object(eu, "LAB_PREFIX", "lab:"):
+            waves = eur.get_waves(rows, self.link_fields)
+        self.assertEqual([[(x[0], x[2]) for x in wave] for wave in waves], [
+            [(3, set()), (5, set())],
+            [(2, {3})],
+            [(4, {2, 3})],
+        ])
+
+    def test_cycle(self):
+        """
+        Tests that rows referencing each other in a cycle are refused, naming their lines.
+        """
+        rows = [
+            (2, {"aliases": ["lab:a"], "part_of": "lab:b"}),
+            (3, {"aliases": ["lab:b"], "part_of": "lab:a"}),
+            (4, {"aliases": ["lab:c"]}),
+        ]
+        with self.assertRaises(Exception) as cm:
+            eur.get_waves(rows, self.link_fields)
+        self.assertIn("2, 3", str(cm.exception))
+
+
+class TestPreflight(unittest.TestCase):
+    """
+    Tests the pre-flight functions of ``encode_utils.MetaDataRegistration.eu_register``.
+    """
+
+    def test_search_field(self):
+        """
+        Tests that identifiers are searched on the property matching their form.
+        """
+        self.assertEqual(eur.get_search_field("ENCBS123ABC"), ("accession", "ENCBS123ABC"))
+        self.assertEqual(eur.get_search_field("/biosamples/TSTBS123ABC/"),
+                         ("accession", "TSTBS123ABC"))
+        uuid = "0b5d1fa2-4a27-4c5e-9b7a-3f4a2e8c1d00"
+        self.assertEqual(eur.get_search_field(uuid), ("uuid", uuid))
+        self.assertEqual(eur.get_search_field("lab:b1"), ("aliases", "lab:b1"))
+
+    def test_queries_are_batched(self):
+        """
+        Tests that the identifiers are looked up in batches, one field at a time.
+        """
+        rows = [(i + 2, {"aliases": ["lab:g{}".format(i)]}) for i in range(5)]
+        rows.append((7, {"aliases": ["lab:g0"]}))
+        queries = eur.get_preflight_queries(rows, batch_size=2)
+        self.assertEqual(len(queries), 3)
+        values = [value for query in queries for field, value in query if field == "aliases"]
+        self.assertEqual(values, ["lab:g{}".format(i) for i in range(5)])
+        self.assertIn(("frame", "object"), queries[0])
+        rows = [(2, {eur.RECORD_ID_FIELD: "ENCGD000AAA"}), (3, {eur.RECORD_ID_FIELD: "lab:g1"})]
+        queries = eur.get_preflight_queries(rows, patch=True)
+        self.assertEqual([x[-1] for x in queries], [("accession", "ENCGD000AAA"),
+                                                    ("aliases", "lab:g1")])
+
+    def test_apply_preflight(self):
+        """
+        Tests that rows whose record exists are reported as succeeded when POSTING, and as failed
+        when their record is missing when PATCHING.
+        """
+        index = eur.get_record_index([{"@id": "/gadgets/ENCGD000AAA/", "accession": "ENCGD000AAA",
+                                       "aliases": ["lab:g1"]}])
+        report = eur.Report()
+        rows = [(2, {"aliases": ["lab:g1"]}), (3, {"aliases": ["lab:g2"]})]
+        self.assertEqual(list(eur.apply_preflight(rows, index, False, report)), rows[1:])
+        self.assertEqual((report.total, report.failed_lines), (1, []))
+
+        report = eur.Report()
+        rows = [(2, {eur.RECORD_ID_FIELD: "ENCGD000AAA"}), (3, {eur.RECORD_ID_FIELD: "lab:g1"}),
+                (4, {eur.RECORD_ID_FIELD: "lab:g2"})]
+        self.assertEqual(list(eur.apply_preflight(rows, index, True, report)), rows[:2])
+        self.assertEqual((report.total, report.failed_lines), (1, [4]))
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestAddMd5sums(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.add_md5sums()``.
+    """
+
+    def test_md5sums(self):
+        """
+        Tests that missing md5sums of local files are set, in order, going through the cache, and
+        that given md5sums, S3 objects and unreadable files are left alone.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for i in range(5):
+                paths.append(os.path.join(tmp_dir, "{}.fastq".format(i)))
+                with open(paths[-1], "w") as fh:
+                    fh.write("ACGT" * i)
+            cache = euu.Md5Cache(os.path.join(tmp_dir, "md5sums.jsonl"))
+            cache.set(cache.get_key(paths[0]), "cached")
+            rows = [(i + 2, {"submitted_file_name": x}) for i, x in enumerate(paths)]
+            rows[1][1]["md5sum"] = "given"
+            rows.append((7, {"submitted_file_name": "s3://bucket/reads.fastq"}))
+            rows.append((8, {"submitted_file_name": os.path.join(tmp_dir, "missing.fastq")}))
+            results = list(eur.add_md5sums(rows, processes=2, cache=cache))
+            md5sums = [payload.get("md5sum") for line, payload in results]
+            self.assertEqual([line for line, payload in results], [2, 3, 4, 5, 6, 7, 8])
+            self.assertEqual(md5sums[:2], ["cached", "given"])
+            self.assertEqual(md5sums[2:5], [hashlib.md5(b"ACGT" * i).hexdigest() for i in [2, 3, 4]])
+            self.assertEqual(md5sums[5:], [None, None])
+            self.assertEqual(cache.get(cache.get_key(paths[4])), md5sums[4])
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestMain(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.MetaDataRegistration.eu_register.main()``, with a fake
+    connection.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        patcher = mock.patch.object(euc, "Connection", FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _main(self, aliases, *options):
+        infile = _write_tsv(self.tmp_dir, ["aliases"] + aliases)
+        argv = ["eu_register.py", "-m", "dev", "-p", "gadget", "-i", infile, "--journal-dir",
+                self.tmp_dir] + list(options)
+        with mock.patch("sys.argv", argv):
+            eur.main()
+        return FakeConnection.instance
+
+    def test_sequential(self):
+        """
+        Tests that all the rows are POSTED in order by default.
+        """
+        conn = self._main(["lab:g1", "lab:g2"])
+        self.assertEqual([x["aliases"] for x in conn.posted], [["lab:g1"], ["lab:g2"]])
+
+    def test_workers(self):
+        """
+        Tests that all the rows are POSTED with --workers, and that a failed row makes the exit
+        status 1 without stopping the run.
+        """
+        aliases = ["lab:g{}".format(i) for i in range(20)]
+        conn = self._main(aliases, "--workers", "4")
+        self.assertEqual(sorted(x["aliases"][0] for x in conn.posted), sorted(aliases))
+        with self.assertRaises(SystemExit) as cm:
+            self._main(["lab:g1", "lab:bad", "lab:g2"], "--workers", "2")
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(len(FakeConnection.instance.posted), 2)
+
+    def test_preflight(self):
+        """
+        Tests that with --preflight, the rows whose record already exists aren't POSTED.
+        """
+        existing = [{"@id": "/gadgets/ENCGD000AAA/", "aliases": ["lab:g2"]}]
+        with mock.patch.object(FakeConnection, "existing", existing):
+            conn = self._main(["lab:g1", "lab:g2", "lab:g3"], "--preflight", "--workers", "2")
+        self.assertEqual(len(conn.queries), 1)
+        self.assertEqual(sorted(x["aliases"][0] for x in conn.posted), ["lab:g1", "lab:g3"])
+
+    def test_resume(self):
+        """
+        Tests that with --resume, only the rows that failed or weren't submitted are POSTED.
+        """
+        aliases = ["lab:g1", "lab:bad", "lab:g2"]
+        with self.assertRaises(SystemExit):
+            self._main(aliases, "--workers", "2")
+        with mock.patch.object(FakeConnection, "refused", ()):
+            conn = self._main(aliases, "--resume")
+        self.assertEqual([x["aliases"] for x in conn.posted], [["lab:bad"]])
+
+    def test_waves(self):
+        """
+        Tests that with --waves, rows are POSTED after those they reference, and that rows
+        referencing a failed row aren't POSTED.
+        """
+        lines = ["aliases\tpart_of", "lab:g1\tlab:g2", "lab:g2\t", "lab:g3\tlab:bad",
+                 "lab:bad\t"]
+        infile = _write_tsv(self.tmp_dir, lines)
+        argv = ["eu_register.py", "-m", "dev", "-p", "gadget", "-i", infile, "--journal-dir",
+                self.tmp_dir, "--workers", "2", "--waves"]
+        with mock.patch("sys.argv", argv), self.assertRaises(SystemExit):
+            eur.main()
+        posted = [x["aliases"][0] for x in FakeConnection.instance.posted]
+        self.assertEqual(posted, ["lab:g2", "lab:g1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests that the start-up of the package stays fast: that a cold ``import encode_utils`` and
+``eu_register.py --help`` stay under fixed budgets, and load none of the modules that are only
+needed once there is work to do. Each is run in fresh interpreters. See also
+``benchmarks/import_time.py``, which reports the slowest imports.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+import unittest
+
+import encode_utils as eu
+
+#: The root of the repository, which is put on the PYTHONPATH of the measured interpreters.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(eu.__file__)))
+
+#: The path to the ``eu_register.py`` script.
+EU_REGISTER = os.path.join(REPO_DIR, "encode_utils", "MetaDataRegistration", "eu_register.py")
+
+#: The modules that neither ``import encode_utils`` nor ``eu_register.py --help`` may import.
+HEAVY_MODULES = ("requests", "asyncio", "aiohttp", "botocore", "encode_utils.connection",
+                 "encode_utils.async_connection", "encode_utils.logs", "logging.handlers")
+
+#: The budget in seconds of a cold ``import encode_utils``.
+IMPORT_BUDGET = 0.05
+
+#: The budget in seconds of ``eu_register.py --help``, besides the start-up of the interpreter.
+HELP_BUDGET = 0.15
+
+#: The number of runs of each measurement, of which the median is kept.
+REPEAT = 5
+
+#: Prints the modules loaded by the code that precedes it, one per line, after a marker line.
+PRINT_MODULES = "import sys; print('--- modules'); print('\\n'.join(sys.modules))"
+
+
+def _run(args):
+    """
+    Runs a fresh interpreter with `args`, with the repository on its PYTHONPATH.
+
+    Returns:
+        `tuple`: The elapsed time in seconds, and the output.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + [x for x in [env.get("PYTHONPATH")] if x])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + args, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise Exception("{} failed:\n{}".format(" ".join(args), proc.stdout))
+    return elapsed, proc.stdout
+
+
+def _get_modules(output):
+    """
+    Returns:
+        `list`: The modules listed by ``PRINT_MODULES`` in `output`.
+    """
+    return output.split("--- modules\n")[-1].split()
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_import_loads_no_heavy_modules(self):
+        """Importing the package loads none of ``HEAVY_MODULES``."""
+        modules = _get_modules(_run(["-c", "import encode_utils; " + PRINT_MODULES])[1])
+        self.assertEqual([x for x in HEAVY_MODULES if x in modules], [])
+
+    def test_help_loads_no_heavy_modules(self):
+        """``eu_register.py --help`` loads none of ``HEAVY_MODULES``."""
+        code = ("import runpy, sys\n"
+                "sys.argv = [{path!r}, '--help']\n"
+                "try:\n"
+                "    runpy.run_path({path!r}, run_name='__main__')\n"
+                "except SystemExit:\n"
+                "    pass\n").format(path=EU_REGISTER) + PRINT_MODULES
+        # The help text itself is left out, since it names some of the modules.
+        modules = _get_modules(_run(["-c", code])[1])
+        self.assertIn("encode_utils.profiles", modules)
+        self.assertEqual([x for x in HEAVY_MODULES if x in modules], [])
+
+    def test_import_budget(self):
+        """A cold ``import encode_utils`` takes less than ``IMPORT_BUDGET``."""
+        code = ("import time; start = time.perf_counter(); import encode_utils; "
+                "print(time.perf_counter() - start)")
+        seconds = statistics.median(
+            float(_run(["-c", code])[1].split()[-1]) for i in range(REPEAT))
+        self.assertLess(seconds, IMPORT_BUDGET)
+
+    def test_help_budget(self):
+        """
+        ``eu_register.py --help`` takes less than ``HELP_BUDGET`` besides the start-up of the
+        interpreter.
+        """
+        baseline = statistics.median(_run(["-c", "pass"])[0] for i in range(REPEAT))
+        seconds = statistics.median(_run([EU_REGISTER, "--help"])[0] for i in range(REPEAT))
+        self.assertLess(seconds - baseline, HELP_BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
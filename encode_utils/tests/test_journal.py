@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.journal.SubmissionJournal`` class.
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+import encode_utils.journal as eujournal
+import encode_utils.logs as eulogs
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+class TestSubmissionJournal(unittest.TestCase):
+    """
+    Tests recording to a journal and resuming from it, including after a crash tore its last line.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "journal.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _resume_after(self, tail):
+        with open(self.path, "w") as fh:
+            fh.write('{"line": 2, "status": "ok", "id": "ENCBS000AAA"}\n' + tail)
+        with eujournal.SubmissionJournal(self.path, resume=True) as journal:
+            journal.record(4, eujournal.STATUS_OK, "ENCBS000CCC")
+        return eujournal.SubmissionJournal(self.path, resume=True)
+
+    def test_resume_after_torn_line(self):
+        """
+        Tests that the entry recorded after resuming from a journal with a torn last line is kept.
+        """
+        journal = self._resume_after('{"line": 3, "sta')
+        journal.close()
+        self.assertEqual(journal.completed, {2: "ENCBS000AAA", 4: "ENCBS000CCC"})
+
+    def test_resume_after_missing_newline(self):
+        """
+        Tests that a complete last entry lacking its newline is kept, as well as the next entry.
+        """
+        journal = self._resume_after('{"line": 3, "status": "ok", "id": "ENCBS000BBB"}')
+        journal.close()
+        self.assertEqual(journal.completed,
+                         {2: "ENCBS000AAA", 3: "ENCBS000BBB", 4: "ENCBS000CCC"})
+
+    def test_failed_rows_are_retried(self):
+        """
+        Tests that rows recorded as failed aren't completed, unless a later entry says otherwise,
+        and that a journal opened without resuming starts afresh.
+        """
+        with eujournal.SubmissionJournal(self.path) as journal:
+            journal.record(2, eujournal.STATUS_OK, "ENCBS000AAA")
+            journal.record(3, eujournal.STATUS_ERROR, message="Refused.")
+            journal.record(4, eujournal.STATUS_OK, "ENCBS000CCC")
+            journal.record(4, eujournal.STATUS_ERROR, message="Refused.")
+        with eujournal.SubmissionJournal(self.path, resume=True) as journal:
+            self.assertTrue(journal.is_completed(2))
+            self.assertFalse(journal.is_completed(3))
+            self.assertFalse(journal.is_completed(4))
+        with eujournal.SubmissionJournal(self.path) as journal:
+            self.assertFalse(journal.is_completed(2))
+        with eujournal.SubmissionJournal(self.path, resume=True) as journal:
+            self.assertFalse(journal.is_completed(2))
+
+    def test_journal_path(self):
+        """
+        Tests that the journal of an input file depends on its content, profile and mode.
+        """
+        infile = os.path.join(self.tmp_dir.name, "records.tsv")
+        with open(infile, "w") as fh:
+            fh.write("aliases\nlab:g1\n")
+        path = eujournal.get_journal_path(infile, "gadget", journal_dir=self.tmp_dir.name)
+        self.assertEqual(os.path.dirname(path), self.tmp_dir.name)
+        self.assertEqual(eujournal.get_journal_path(infile, "gadget", journal_dir=self.tmp_dir.name),
+                         path)
+        self.assertNotEqual(eujournal.get_journal_path(infile, "gadget", patch=True,
+                                                       journal_dir=self.tmp_dir.name), path)
+        self.assertNotEqual(eujournal.get_journal_path(infile, "widget",
+                                                       journal_dir=self.tmp_dir.name), path)
+        with open(infile, "a") as fh:
+            fh.write("lab:g2\n")
+        self.assertNotEqual(eujournal.get_journal_path(infile, "gadget",
+                                                       journal_dir=self.tmp_dir.name), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
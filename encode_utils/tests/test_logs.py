@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests functions in the ``encode_utils.logs`` module.
+"""
+
+import io
+import logging
+import threading
+import unittest
+
+import encode_utils as eu
+import encode_utils.logs as eulogs
+
+
+class TestFlush(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.logs.flush()``.
+    """
+
+    def test_flush_while_logging(self):
+        """
+        Tests that flushing repeatedly while other threads log neither hangs nor loses records.
+        """
+        stream = io.StringIO()
+        eulogs.configure_logging(level="DEBUG", stream=stream)
+        logger = logging.getLogger(eu.DEBUG_LOGGER_NAME + ".test")
+        # Bypass the handlers that the test runner may have attached to the root logger, which
+        # slow down the logging threads enough to hide the race.
+        debug_logger = logging.getLogger(eu.DEBUG_LOGGER_NAME)
+        debug_logger.propagate = False
+        self.addCleanup(setattr, debug_logger, "propagate", True)
+        started = threading.Event()
+        done = threading.Event()
+        counts = []
+
+        def log():
+            count = 0
+            while not done.is_set():
+                logger.debug("message")
+                count += 1
+                started.set()
+            counts.append(count)
+
+        def flush():
+            started.wait()
+            for i in range(300):
+                eulogs.flush()
+
+        threads = [threading.Thread(target=log, daemon=True) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        flusher = threading.Thread(target=flush, daemon=True)
+        flusher.start()
+        flusher.join(30)
+        done.set()
+        self.assertFalse(flusher.is_alive(), "flush() hung.")
+        for thread in threads:
+            thread.join()
+        eulogs.flush()
+        self.assertEqual(stream.getvalue().count("\n"), sum(counts))
+
+
+if __name__ == "__main__":
+    unittest.main()
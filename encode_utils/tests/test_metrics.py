@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.metrics`` module.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import encode_utils.metrics as eumetrics
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.metrics.Metrics``.
+    """
+
+    def setUp(self):
+        self.metrics = eumetrics.Metrics()
+
+    def test_histogram(self):
+        """
+        Tests that latencies land in the cumulative buckets of their operation, and that errors
+        are counted.
+        """
+        self.metrics.observe(eumetrics.OP_GET, 0.003)
+        self.metrics.observe(eumetrics.OP_GET, 0.2, error=True)
+        self.metrics.observe(eumetrics.OP_GET, 1000)
+        stats = self.metrics.snapshot()["operations"][eumetrics.OP_GET]
+        self.assertEqual((stats["count"], stats["errors"]), (3, 1))
+        self.assertAlmostEqual(stats["sum"], 1000.203)
+        self.assertEqual(stats["buckets"]["0.005"], 1)
+        self.assertEqual(stats["buckets"]["0.25"], 2)
+        self.assertEqual(stats["buckets"]["300.0"], 2)
+        self.assertEqual(stats["buckets"]["+Inf"], 3)
+
+    def test_timer_counts_exceptions_as_errors(self):
+        """
+        Tests that ``Metrics.timer()`` records the operation it wraps, as an error if it raises.
+        """
+        with self.metrics.timer(eumetrics.OP_UPLOAD):
+            pass
+        with self.assertRaises(OSError):
+            with self.metrics.timer(eumetrics.OP_UPLOAD):
+                raise OSError("disk")
+        stats = self.metrics.snapshot()["operations"][eumetrics.OP_UPLOAD]
+        self.assertEqual((stats["count"], stats["errors"]), (2, 1))
+
+    def test_concurrent_observations(self):
+        """
+        Tests that observations from many threads are all counted.
+        """
+        def work():
+            for _ in range(1000):
+                self.metrics.observe(eumetrics.OP_POST, 0.01)
+                self.metrics.add_row()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["operations"][eumetrics.OP_POST]["count"], 8000)
+        self.assertEqual(snapshot["progress"]["rows_done"], 8000)
+        self.assertEqual(snapshot["counters"],
+                         [{"name": "rows", "labels": {"status": "ok"}, "value": 8000}])
+
+    def test_progress(self):
+        """
+        Tests the rows per second and the ETA, and that the ETA is unknown without an expected
+        number of rows.
+        """
+        with mock.patch.object(eumetrics.time, "time", return_value=100.0):
+            self.metrics.start_run(10)
+        for _ in range(4):
+            self.metrics.add_row()
+        self.metrics.add_row(ok=False)
+        with mock.patch.object(eumetrics.time, "time", return_value=110.0):
+            progress = self.metrics.progress()
+        self.assertEqual(progress["rows_done"], 5)
+        self.assertAlmostEqual(progress["rows_per_sec"], 0.5)
+        self.assertAlmostEqual(progress["eta"], 10.0)
+        self.assertEqual(eumetrics.format_progress(progress), "5/10 rows, 0.5 rows/s, ETA 10s")
+        self.metrics.start_run()
+        self.metrics.add_row()
+        self.assertIsNone(self.metrics.progress()["eta"])
+
+    def test_prometheus(self):
+        """
+        Tests the Prometheus text format of the histograms, counters and progress.
+        """
+        self.metrics.start_run(3)
+        self.metrics.observe(eumetrics.OP_POST, 0.02, error=True)
+        self.metrics.add_row(ok=False)
+        lines = self.metrics.to_prometheus().splitlines()
+        self.assertIn('encode_utils_operation_seconds_bucket{op="post",le="0.025"} 1', lines)
+        self.assertIn('encode_utils_operation_seconds_count{op="post"} 1', lines)
+        self.assertIn('encode_utils_operation_errors_total{op="post"} 1', lines)
+        self.assertIn('encode_utils_rows_total{status="failed"} 1', lines)
+        self.assertIn("encode_utils_rows_expected 3", lines)
+
+
+class TestMetricsExporter(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.metrics.MetricsExporter``.
+    """
+
+    def test_format_from_extension(self):
+        """
+        Tests that '.prom' files default to the Prometheus format and others to JSON.
+        """
+        self.assertEqual(eumetrics.MetricsExporter("m.prom").fmt, "prometheus")
+        self.assertEqual(eumetrics.MetricsExporter("m.json").fmt, "json")
+        self.assertEqual(eumetrics.MetricsExporter("m.prom", fmt="json").fmt, "json")
+        with self.assertRaises(ValueError):
+            eumetrics.MetricsExporter("m.txt", fmt="csv")
+
+    def test_writes_last_snapshot_on_stop(self):
+        """
+        Tests that stopping the exporter writes a snapshot, without a leftover temporary file.
+        """
+        metrics = eumetrics.Metrics()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics.json")
+            with eumetrics.MetricsExporter(path, interval=60, metrics=metrics):
+                metrics.observe(eumetrics.OP_MD5, 0.5)
+            with open(path) as fh:
+                snapshot = json.load(fh)
+            self.assertEqual(os.listdir(tmp_dir), ["metrics.json"])
+        self.assertEqual(snapshot["operations"][eumetrics.OP_MD5]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
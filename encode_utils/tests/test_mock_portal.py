@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.mock_portal`` module, and runs ``eu_register.py`` end to end against it.
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+import encode_utils as eu
+import encode_utils.logs as eulogs
+import encode_utils.mock_portal as eumock
+
+#: The path to the ``eu_register.py`` script.
+EU_REGISTER = os.path.join(os.path.dirname(os.path.abspath(eu.__file__)), "MetaDataRegistration",
+                           "eu_register.py")
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+def _request(url, method="GET", payload=None):
+    """
+    Returns:
+        `tuple`: The status code and the JSON body of the response.
+    """
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, json.loads(response.read() or b"{}")
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+class TestMockPortal(unittest.TestCase):
+
+    def setUp(self):
+        self.portal = eumock.MockPortal()
+        self.portal.start()
+        self.addCleanup(self.portal.stop)
+
+    def test_profiles(self):
+        """Serves the profiles document it was given."""
+        status, doc = _request(self.portal.url + "/profiles/?format=json")
+        self.assertEqual(status, 200)
+        self.assertEqual(doc["Biosample"]["id"], "/profiles/biosample.json")
+
+    def test_post_then_get(self):
+        """A POSTED record can be fetched by its alias and counts as written."""
+        status, doc = _request(self.portal.url + "/biosample/", "POST", {
+            "aliases": ["lab:b1"], "biosample_term_name": "K562",
+            "award": "/awards/a/", "lab": "/labs/l/"})
+        self.assertEqual(status, 201)
+        accession = doc["@graph"][0]["accession"]
+        status, doc = _request(self.portal.url + "/lab:b1/?format=json")
+        self.assertEqual(status, 200)
+        self.assertEqual(doc["accession"], accession)
+        self.assertEqual(self.portal.stats()["records_written"], 1)
+
+    def test_duplicate_alias(self):
+        """A second POST with the same alias is answered with a 409."""
+        payload = {"aliases": ["lab:b1"], "biosample_term_name": "K562",
+                   "award": "/awards/a/", "lab": "/labs/l/"}
+        _request(self.portal.url + "/biosample/", "POST", payload)
+        status, _ = _request(self.portal.url + "/biosample/", "POST", payload)
+        self.assertEqual(status, 409)
+        self.assertEqual(self.portal.stats()["records_written"], 1)
+
+
+class TestEuRegisterAgainstMockPortal(unittest.TestCase):
+    """
+    Runs ``eu_register.py`` in a subprocess against a stand-in Portal, the way
+    ``benchmarks/load_test.py`` does.
+    """
+
+    NUM_ROWS = 5
+
+    def setUp(self):
+        self.portal = eumock.MockPortal()
+        self.portal.start()
+        self.addCleanup(self.portal.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.work_dir = tmp.name
+        self.infile = os.path.join(self.work_dir, "rows.tsv")
+        with open(self.infile, "w") as fh:
+            fh.write("aliases\tbiosample_term_name\tstarting_amount\tfractions\n")
+            for i in range(self.NUM_ROWS):
+                fh.write("lab:smoke-{}\tK562\t1.5\t1,2\n".format(i))
+
+    def _run(self, *args):
+        env = dict(os.environ)
+        env.update({
+            "EU_LOCAL_DCC_URL": self.portal.url,
+            "EU_PROFILES_URL": self.portal.url + "/profiles/",
+            "EU_PROFILES_CACHE_DIR": "",
+            "EU_PROFILES_SNAPSHOT": "",
+            "EU_MD5_CACHE": "",
+            "DCC_API_KEY": "smoke-test",
+            "DCC_SECRET_KEY": "smoke-test",
+            "DCC_LAB": "/labs/smoke-test/",
+            "DCC_AWARD": "/awards/smoke-test/",
+            "PYTHONPATH": os.pathsep.join(
+                [os.path.dirname(os.path.dirname(os.path.abspath(eu.__file__)))]
+                + [x for x in [env.get("PYTHONPATH")] if x]),
+        })
+        cmd = [sys.executable, EU_REGISTER, "-m", eu.DCC_LOCAL_MODE, "-p", "biosample",
+               "-i", self.infile, "--journal-dir", os.path.join(self.work_dir, "journals")]
+        return subprocess.run(cmd + list(args), env=env, cwd=self.work_dir,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, timeout=120)
+
+    def _check(self, result):
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(self.portal.stats()["records_written"], self.NUM_ROWS)
+        for i in range(self.NUM_ROWS):
+            record = self.portal.records["lab:smoke-{}".format(i)]
+            self.assertEqual(record["lab"], "/labs/smoke-test/")
+            self.assertEqual(record["fractions"], [1, 2])
+
+    def test_sequential(self):
+        """Each row is POSTED once, with the lab and award defaults."""
+        self._check(self._run())
+
+    def test_workers(self):
+        """The same records are written with --workers."""
+        self._check(self._run("--workers", "2"))
+
+    def test_profile_run(self):
+        """
+        --profile-run prints the time of the stages, including the requests, and writes them to
+        --profile-dir.
+        """
+        profile_dir = os.path.join(self.work_dir, "profiling")
+        result = self._run("--profile-run", "--profile-dir", profile_dir)
+        self._check(result)
+        for stage in ["read", "convert", "validate", "submit", "http"]:
+            self.assertRegex(result.stdout, r"\n{} +\d+ ".format(stage))
+        self.assertEqual([x.split(".", 1)[1] for x in os.listdir(profile_dir)], ["stages.json"])
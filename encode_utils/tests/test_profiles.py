@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests functions in the ``encode_utils.profiles`` module, offline, against a synthetic profile.
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pytest
+import requests
+
+import encode_utils.logs as eulogs
+import encode_utils.mock_portal as eumock
+import encode_utils.profiles as eup
+
+PROFILES_URL = "https://portal.example.org/profiles/"
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+class FakeResponse:
+    """
+    Stands in for the `requests.Response` of the Portal's profiles endpoint.
+    """
+
+    def __init__(self, doc=None, status_code=200, etag='"v1"', cut_at=None, error=None):
+        """
+        Args:
+            cut_at: `int`. The number of bytes of the body after which the stream stops, as if the
+              connection dropped.
+            error: `Exception`. Raised by the stream once `cut_at` bytes were read.
+        """
+        self.status_code = status_code
+        self.headers = {"ETag": etag}
+        self._body = json.dumps(doc).encode("utf-8") if doc is not None else b""
+        self._cut_at = cut_at
+        self._error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+    def iter_content(self, chunk_size=1):
+        body = self._body[:self._cut_at]
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+        if self._error:
+            raise self._error
+
+    def json(self):
+        return json.loads(self._body.decode("utf-8"))
+
+
+@pytest.mark.usefixtures("profiles_doc")
+class TestIterProfiles(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.profiles.iter_profiles()``.
+    """
+
+    def _chunks(self, body, size):
+        return [body[i:i + size] for i in range(0, len(body), size)]
+
+    def test_chunk_sizes(self):
+        """
+        Tests that the profiles are parsed alike whatever the chunks, even when these split the
+        UTF-8 encoding of a character, and that the private profiles are skipped.
+        """
+        doc = dict(self.profiles_doc)
+        doc["Widget"] = dict(doc["Widget"], title="Widgét ✓")
+        body = json.dumps(doc, ensure_ascii=False, indent=1).encode("utf-8")
+        expected = [(eup._get_profile_id(v), v) for k, v in doc.items()
+                    if not k.startswith("_") and k != "@type"]
+        for size in [1, 2, 7, len(body)]:
+            self.assertEqual(list(eup.iter_profiles(self._chunks(body, size))), expected, size)
+
+    def test_truncated(self):
+        """
+        Tests that a truncated document raises a ``ValueError`` after the profiles that are
+        complete.
+        """
+        body = json.dumps(self.profiles_doc).encode("utf-8")
+        expected = list(eup.iter_profiles([body]))
+        for cut_at in [0, len(body) // 2, len(body) - 1]:
+            profiles = []
+            with self.assertRaises(ValueError):
+                for profile in eup.iter_profiles(self._chunks(body[:cut_at], 5)):
+                    profiles.append(profile)
+            self.assertEqual(profiles, expected[:len(profiles)])
+        with self.assertRaises(ValueError):
+            list(eup.iter_profiles([b"[]"]))
+
+
+@pytest.mark.usefixtures("profiles_doc")
+class TestProfilesCache(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.profiles.ProfilesCache``, with the requests to the Portal
+    answered by the test.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_dir = tmp_dir.name
+        #: The headers of the requests sent to the profiles endpoint.
+        self.requests = []
+        #: The responses to these requests, in order. Exceptions are raised instead.
+        self.responses = []
+        patcher = mock.patch.object(eup, "_request_profiles", self._request_profiles)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _request_profiles(self, profiles_url, headers):
+        self.requests.append(headers)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _load(self, ttl):
+        return eup.ProfilesCache(PROFILES_URL, cache_dir=self.cache_dir, ttl=ttl).load()
+
+    def test_fresh_cache_is_used_offline(self):
+        """
+        Tests that profiles cached less than `ttl` seconds ago are loaded without a request.
+        """
+        self.responses.append(FakeResponse(self.profiles_doc))
+        self._load(ttl=3600)
+        profiles = self._load(ttl=3600)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(sorted(profiles), ["file", "gadget", "genetic_modification", "widget"])
+        self.assertEqual(profiles["widget"], self.profiles_doc["Widget"])
+
+    def test_expired_cache_is_revalidated(self):
+        """
+        Tests that an expired cache is revalidated with the ETag of the prior response, and used
+        when the Portal answers that the profiles didn't change.
+        """
+        self.responses.extend([FakeResponse(self.profiles_doc), FakeResponse(status_code=304)])
+        self._load(ttl=0)
+        profiles = self._load(ttl=0)
+        self.assertNotIn("If-None-Match", self.requests[0])
+        self.assertEqual(self.requests[1]["If-None-Match"], '"v1"')
+        self.assertEqual(profiles["widget"], self.profiles_doc["Widget"])
+
+    def test_stale_cache_is_used_when_portal_is_unreachable(self):
+        """
+        Tests that an expired cache is used when the Portal can't be reached.
+        """
+        self.responses.extend([FakeResponse(self.profiles_doc),
+                               requests.exceptions.ConnectionError("Portal is down.")])
+        self._load(ttl=0)
+        profiles = self._load(ttl=0)
+        self.assertEqual(profiles["widget"], self.profiles_doc["Widget"])
+
+    def test_stale_cache_is_used_when_download_is_cut_short(self):
+        """
+        Tests that an expired cache is used when the profiles document stops streaming in, and
+        that the error is raised when there is no cache to fall back on.
+        """
+        body_size = len(json.dumps(self.profiles_doc))
+        failures = [
+            FakeResponse(self.profiles_doc, etag='"v2"', cut_at=body_size // 2,
+                         error=requests.exceptions.ChunkedEncodingError("Connection reset.")),
+            FakeResponse(self.profiles_doc, etag='"v2"', cut_at=body_size // 2)]
+        for failure in failures:
+            with self.assertRaises((requests.exceptions.RequestException, ValueError)):
+                self.responses.append(failure)
+                self._load(ttl=0)
+        self.responses.append(FakeResponse(self.profiles_doc))
+        self._load(ttl=0)
+        for failure in failures:
+            self.responses.append(failure)
+            profiles = self._load(ttl=0)
+            self.assertEqual(profiles["widget"], self.profiles_doc["Widget"])
+        # The index of the cache was left alone, so the next revalidation is still conditional.
+        self.assertEqual(self.requests[-1]["If-None-Match"], '"v1"')
+
+    def test_missing_profile_file_is_downloaded_again(self):
+        """
+        Tests that a profile whose file was removed from the cache is downloaded again on its own,
+        and written back to the cache.
+        """
+        self.responses.append(FakeResponse(self.profiles_doc))
+        self._load(ttl=3600)
+        cache = eup.ProfilesCache(PROFILES_URL, cache_dir=self.cache_dir, ttl=3600)
+        os.remove(os.path.join(cache.cache_dir, "widget.json"))
+        profiles = cache.load()
+        with mock.patch.object(eup, "_download_profile",
+                               return_value=self.profiles_doc["Widget"]) as download:
+            self.assertEqual(profiles["widget"], self.profiles_doc["Widget"])
+        download.assert_called_once_with(PROFILES_URL, "widget")
+        self.assertTrue(os.path.exists(os.path.join(cache.cache_dir, "widget.json")))
+
+
+@pytest.mark.usefixtures("profiles_doc")
+class TestGetLazyProfiles(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.profiles.get_lazy_profiles()`` against a stand-in Portal.
+    """
+
+    def test_other_profiles_are_downloaded_on_their_own(self):
+        """
+        Tests that only the schemas asked for are kept, and that another one is downloaded from
+        its own URL on first access, without the profiles document being downloaded again.
+        """
+        with eumock.MockPortal(profiles=self.profiles_doc) as portal:
+            profiles_url = portal.url + "/profiles/"
+            with mock.patch.object(eup, "_request_profiles",
+                                   wraps=eup._request_profiles) as request_profiles:
+                profiles = eup.get_lazy_profiles(profiles_url, ["widget"])
+                self.assertEqual(sorted(profiles._schemas), ["widget"])
+                self.assertEqual(profiles.property_names("gadget"),
+                                 list(self.profiles_doc["Gadget"]["properties"]))
+                with mock.patch.object(eup, "_download_profile",
+                                       wraps=eup._download_profile) as download:
+                    self.assertEqual(profiles["gadget"], self.profiles_doc["Gadget"])
+                    self.assertEqual(profiles["gadget"], self.profiles_doc["Gadget"])
+            download.assert_called_once_with(profiles_url, "gadget")
+            request_profiles.assert_called_once()
+
+
+@pytest.mark.usefixtures("profiles_doc")
+class TestProfilesSnapshot(unittest.TestCase):
+    """
+    Tests the functions ``export_profiles_snapshot()`` and ``load_profiles_snapshot()``.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "profiles.snapshot")
+        self.profiles = eup._format_profiles(self.profiles_doc)
+
+    def test_round_trip(self):
+        """
+        Tests that the profiles of a snapshot are those that were exported, and that their property
+        names are known without deserializing any schema.
+        """
+        eup.export_profiles_snapshot(self.path, profiles=self.profiles, profiles_url=PROFILES_URL)
+        profiles = eup.load_profiles_snapshot(self.path)
+        self.assertEqual(sorted(profiles), sorted(self.profiles))
+        self.assertEqual(set(profiles.property_names("widget")),
+                         set(self.profiles["widget"]["properties"]))
+        for profile_id in self.profiles:
+            self.assertEqual(profiles[profile_id], self.profiles[profile_id])
+
+    def test_load_profiles_uses_snapshot(self):
+        """
+        Tests that ``Profile.load_profiles()`` reads the snapshot set in
+        ``encode_utils.PROFILES_SNAPSHOT`` rather than going to the Portal.
+        """
+        eup.export_profiles_snapshot(self.path, profiles=self.profiles, profiles_url=PROFILES_URL)
+        with mock.patch.object(eup.eu, "PROFILES_SNAPSHOT", self.path), \
+                mock.patch.object(eup, "get_profiles", side_effect=AssertionError):
+            profiles = eup.Profile.load_profiles()
+        self.assertEqual(profiles["file"], self.profiles["file"])
+
+    def test_other_version_is_refused(self):
+        """
+        Tests that a snapshot of another format version is refused.
+        """
+        eup.export_profiles_snapshot(self.path, profiles=self.profiles, profiles_url=PROFILES_URL)
+        with open(self.path, "rb") as fh:
+            lines = fh.readlines()
+        header = json.loads(lines[0].decode("utf-8"))
+        header["version"] = eup.SNAPSHOT_FORMAT_VERSION + 1
+        lines[0] = json.dumps(header).encode("utf-8") + b"\n"
+        with open(self.path, "wb") as fh:
+            fh.writelines(lines)
+        with self.assertRaises(ValueError):
+            eup.load_profiles_snapshot(self.path)
+
+    def test_other_file_is_refused(self):
+        """
+        Tests that a file that isn't a snapshot is refused.
+        """
+        with open(self.path, "w") as fh:
+            fh.write("id\tname\n")
+        with self.assertRaises(ValueError):
+            eup.load_profiles_snapshot(self.path)
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestProfile(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.profiles.Profile``.
+    """
+
+    def test_spellings_are_normalized(self):
+        """
+        Tests that the collection name, `@type` name and `@id` of a record all give the memoized
+        instance of the profile.
+        """
+        profile = eup.Profile("genetic_modification")
+        for spelling in ["genetic-modifications", "GeneticModification",
+                         "/genetic-modifications/ENCGM000AAA/", "genetic_modifications"]:
+            self.assertIs(eup.Profile(spelling), profile)
+        self.assertEqual(profile.profile_id, "genetic_modification")
+
+    def test_unknown_profile(self):
+        """
+        Tests that an unknown profile ID is refused.
+        """
+        with self.assertRaises(eup.UnknownProfile):
+            eup.Profile("gizmo")
+
+    def test_property_classification(self):
+        """
+        Tests the sets of writable, required and identifying properties.
+        """
+        profile = eup.Profile("genetic_modification")
+        self.assertEqual(profile.non_writable_props, {"uuid", "accession", "submitted_by"})
+        self.assertEqual(profile.writable_props, {"aliases", "description"})
+        self.assertTrue(profile.is_prop_required("description"))
+        self.assertTrue(profile.is_prop_identifying("aliases"))
+        record = {"uuid": "x", "accession": "ENCGM000AAA", "description": "d"}
+        self.assertEqual(profile.filter_non_writable_props(dict(record)), {"description": "d"})
+        self.assertEqual(profile.filter_non_writable_props(dict(record), keep_identifying=True),
+                         record)
+
+    def test_memoized_instance_is_complete(self):
+        """
+        Tests that threads creating the same profile at once all get a fully set up instance, even
+        when setting it up is slow.
+        """
+        eup.Profile.set_profiles(eup.Profile.PROFILES)
+        is_prop_read_only = eup.Profile.is_prop_read_only
+
+        def slow_is_prop_read_only(profile, prop):
+            time.sleep(0.001)
+            return is_prop_read_only(profile, prop)
+
+        barrier = threading.Barrier(8)
+        errors = []
+        instances = []
+
+        def create():
+            barrier.wait()
+            try:
+                profile = eup.Profile("widget")
+                instances.append(profile)
+                profile.writable_props
+            except AttributeError as e:
+                errors.append(e)
+
+        with mock.patch.object(eup.Profile, "is_prop_read_only", slow_is_prop_read_only):
+            threads = [threading.Thread(target=create) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(map(id, instances))), 1)
+
+
+@pytest.mark.usefixtures("synthetic_profiles")
+class TestValidateMany(unittest.TestCase):
+    """
+    Tests the methods ``encode_utils.profiles.Profile.validate()`` and ``validate_many()``.
+    """
+
+    def setUp(self):
+        self.profile = eup.Profile("widget")
+
+    def test_validate(self):
+        """
+        Tests that type, enum and pattern errors are reported per property.
+        """
+        self.assertEqual(self.profile.validate({"count": 1, "status": "released", "code": "W1"}), [])
+        errors = self.profile.validate({"count": "1", "status": "done", "code": "W1"})
+        self.assertEqual([x[0] for x in errors], ["count", "status"])
+
+    def test_agrees_with_validate_on_mixed_types(self):
+        """
+        Tests that values equal to a value already found valid, but of another type, i.e. `True`
+        and `1.0` after `1`, are still checked.
+        """
+        payloads = []
+        for value in [1, True, 1.0, 0, False, 0.0, 1.5, "1"]:
+            for prop in ["count", "amount", "flag", "label"]:
+                payloads.append({prop: value})
+        expected = [self.profile.validate(x) for x in payloads]
+        self.assertEqual(list(self.profile.validate_many(payloads)), expected)
+
+    def test_rejects_bool_after_int(self):
+        """
+        Tests that `True` is rejected for an integer property even after a valid `1`.
+        """
+        errors = list(self.profile.validate_many([{"count": 1}, {"count": True}]))
+        self.assertEqual(errors[0], [])
+        self.assertEqual(errors[1], [("count", "Expected type integer.")])
+
+
+if __name__ == "__main__":
+    unittest.main()
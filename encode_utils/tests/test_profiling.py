@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.profiling`` module.
+"""
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import encode_utils.profiling as euprofiling
+
+
+def _stages(timers):
+    return {x["stage"]: x for x in timers.summary()}
+
+
+class TestStageTimers(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.profiling.StageTimers``.
+    """
+
+    def test_self_time_leaves_out_nested_stages(self):
+        """
+        Tests that the self time of a stage leaves out the stages nested in it, and that the total
+        time doesn't.
+        """
+        timers = euprofiling.StageTimers()
+        clock = iter([0.0, 1.0, 3.0, 10.0])
+        with mock.patch.object(euprofiling.time, "perf_counter", lambda: next(clock)):
+            outer = timers.start()
+            inner = timers.start()
+            timers.stop("inner", inner)
+            timers.stop("outer", outer)
+        stages = _stages(timers)
+        self.assertEqual((stages["outer"]["calls"], stages["outer"]["total"],
+                          stages["outer"]["self"]), (1, 10.0, 8.0))
+        self.assertEqual((stages["inner"]["total"], stages["inner"]["self"]), (2.0, 2.0))
+
+
+class TestInstrument(unittest.TestCase):
+    """
+    Tests the function ``encode_utils.profiling.instrument()``.
+    """
+
+    def setUp(self):
+        self.timers = euprofiling.StageTimers()
+
+    def test_function_and_restore(self):
+        """
+        Tests that the calls of a function are counted, and that the function is put back.
+        """
+        def double(x):
+            return 2 * x
+
+        module = types.SimpleNamespace(double=double)
+        restore = euprofiling.instrument(module, "double", "math", self.timers)
+        self.assertEqual([module.double(1), module.double(2)], [2, 4])
+        restore()
+        self.assertIs(module.double, double)
+        self.assertEqual(_stages(self.timers)["math"]["calls"], 2)
+
+    def test_generator_and_inherited_method(self):
+        """
+        Tests that a generator method inherited from a base class is timed item by item, and that
+        restoring it leaves the base class alone.
+        """
+        class Base:
+            def rows(self):
+                yield 1
+                yield 2
+
+        class Child(Base):
+            pass
+
+        restore = euprofiling.instrument(Child, "rows", "read", self.timers)
+        self.assertEqual(list(Child().rows()), [1, 2])
+        self.assertEqual(list(Base().rows()), [1, 2])
+        restore()
+        self.assertNotIn("rows", vars(Child))
+        # Each item is a call, and so is the end of the iteration.
+        self.assertEqual(_stages(self.timers)["read"]["calls"], 3)
+
+    def test_coroutine_and_staticmethod(self):
+        """
+        Tests that coroutine functions and static methods keep their kind.
+        """
+        class Client:
+            @staticmethod
+            async def send(x):
+                return x
+
+        restore = euprofiling.instrument(Client, "send", "http", self.timers)
+        self.assertIsInstance(vars(Client)["send"], staticmethod)
+        self.assertEqual(asyncio.run(Client.send(3)), 3)
+        restore()
+        self.assertEqual(_stages(self.timers)["http"]["calls"], 1)
+
+
+class TestRunProfiler(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.profiling.RunProfiler``.
+    """
+
+    def test_report(self):
+        """
+        Tests that the stages and operations are printed, and that the results are written to
+        the output directory along with the ``cProfile`` statistics.
+        """
+        def work():
+            return sum(range(1000))
+
+        module = types.SimpleNamespace(work=work)
+        with tempfile.TemporaryDirectory() as out_dir:
+            profiler = euprofiling.RunProfiler(out_dir, use_cprofile=True)
+            profiler.instrument(module, "work", "work")
+            profiler.start()
+            try:
+                module.work()
+            finally:
+                profiler.stop()
+            self.assertIs(module.work, work)
+            stream = io.StringIO()
+            profiler.report({"get": {"count": 2, "sum": 0.5}}, stream=stream)
+            files = sorted(os.listdir(out_dir))
+            self.assertEqual([os.path.splitext(x)[1] for x in files], [".prof", ".json"])
+            with open(os.path.join(out_dir, files[1])) as fh:
+                results = json.load(fh)
+        output = stream.getvalue()
+        self.assertRegex(output, r"\nwork +1 ")
+        self.assertRegex(output, r"\nget +2 +0\.500 +250\.000")
+        self.assertEqual(results["stages"][0]["stage"], "work")
+        self.assertEqual(results["operations"], [{"operation": "get", "count": 2, "total": 0.5}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.readers`` module.
+"""
+
+import gzip
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+
+import encode_utils.logs as eulogs
+import encode_utils.readers as eureaders
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+class TestReaders(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return path
+
+    def _read(self, path, fmt=None):
+        with eureaders.get_reader(path, fmt) as reader:
+            return reader.header, list(reader)
+
+    def test_tsv(self):
+        """Comments and empty lines are skipped, and rows keep the line numbers of the file."""
+        path = self._write("rows", b"a\tb\n1\t2\n\n#3\t4\n5\t6\n")
+        self.assertEqual(eureaders.detect_format(path), "tsv")
+        self.assertEqual(self._read(path), (["a", "b"], [(2, ["1", "2"]), (5, ["5", "6"])]))
+
+    def test_gzip(self):
+        """gzip compressed input is detected and decompressed, whatever the file name."""
+        path = self._write("rows.txt", gzip.compress(b'{"a": 1}\n'))
+        self.assertEqual(eureaders.detect_format(path), "jsonl")
+        self.assertEqual(self._read(path), (["a"], [(1, [1])]))
+
+    def test_zstd(self):
+        """zstd compressed input is detected and decompressed."""
+        zstandard = pytest.importorskip("zstandard")
+        path = self._write("rows", zstandard.ZstdCompressor().compress(b"a\n1\n"))
+        self.assertEqual(self._read(path), (["a"], [(2, ["1"])]))
+
+    def test_json_lines_header_is_union_of_keys(self):
+        """
+        The field names are the keys of all the objects, in order of appearance, and the values
+        keep their JSON types.
+        """
+        path = self._write("rows", b'{"a": 1}\n\n{"b": [true], "a": null}\n{"c": "x"}\n')
+        self.assertEqual(self._read(path), (
+            ["a", "b", "c"], [(1, [1, None, None]), (3, [None, [True], None]),
+                              (4, [None, None, "x"])]))
+
+    def test_json_lines_row_errors(self):
+        """
+        Lines that aren't JSON objects raise a ``RowError`` naming the line, or are passed to
+        `on_error` and skipped.
+        """
+        path = self._write("rows", b'{"a": 1}\n{bad\n[1]\n{"a": 2}\n')
+        with eureaders.get_reader(path) as reader:
+            with self.assertRaises(eureaders.RowError) as cm:
+                list(reader)
+        self.assertEqual(cm.exception.line, 2)
+        self.assertIsInstance(cm.exception, ValueError)
+        errors = []
+        with eureaders.get_reader(path) as reader:
+            rows = list(reader.iter_rows(on_error=errors.append))
+        self.assertEqual(rows, [(1, [1]), (4, [2])])
+        self.assertEqual([x.line for x in errors], [2, 3])
+        self.assertIn("invalid JSON", errors[0].message)
+        self.assertEqual(errors[1].message, "expected a JSON object.")
+
+    def test_parquet(self):
+        """Parquet files are read across record batches, with the row numbers as line numbers."""
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+        path = os.path.join(self.tmp_dir, "rows")
+        pyarrow.parquet.write_table(
+            pyarrow.table({"a": [1, 2, 3], "b": ["x", None, "z"]}), path)
+        self.assertEqual(eureaders.detect_format(path), "parquet")
+        with mock.patch.object(eureaders, "PARQUET_BATCH_SIZE", 2):
+            self.assertEqual(self._read(path), (
+                ["a", "b"], [(1, [1, "x"]), (2, [2, None]), (3, [3, "z"])]))
+        with eureaders.get_reader(path) as reader:
+            self.assertEqual(reader.count_rows(), 3)
+
+    def test_count_rows(self):
+        """The rows are counted as they are read."""
+        for data in [b"a\n1\n#2\n\n3\n", b'{"a": 1}\n\n{"a": 3}\n']:
+            with eureaders.get_reader(self._write("rows", data)) as reader:
+                self.assertEqual(reader.count_rows(), 2)
+
+    def test_unknown_format(self):
+        """An unknown format is refused."""
+        with self.assertRaises(ValueError):
+            eureaders.get_reader(self._write("rows", b"a\n"), "xlsx")
+
+    def test_spool_stdin(self):
+        """STDIN is copied as is, still compressed, to a file that can be read again."""
+        data = gzip.compress(b"a\n1\n")
+        stdin = mock.Mock(buffer=io.BytesIO(data))
+        with mock.patch.object(sys, "stdin", stdin):
+            path = eureaders.spool_stdin(dir=self.tmp_dir)
+        with open(path, "rb") as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(self._read(path), (["a"], [(2, ["1"])]))
+
+
+if __name__ == "__main__":
+    unittest.main()
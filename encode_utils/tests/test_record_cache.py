@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.record_cache`` module.
+"""
+
+import io
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import encode_utils as eu
+import encode_utils.logs as eulogs
+import encode_utils.record_cache as eurc
+
+HOST = "test.host"
+RECORD = {"@id": "/biosamples/ENCBS000AAA/", "accession": "ENCBS000AAA", "aliases": ["lab:s"]}
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+class TestRecordCache(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.record_cache.RecordCache``.
+    """
+
+    def _store(self, cache, rec_id, record, frame=None, etag='"v1"'):
+        cache.store(HOST, rec_id, frame, json.dumps(record), etag, record)
+
+    def test_lookup(self):
+        """
+        Tests that a stored record is fresh until the TTL runs out, and that the hosts and frames
+        are kept apart.
+        """
+        cache = eurc.RecordCache(max_bytes=1024 * 1024, ttl=300, cache_dir="")
+        self._store(cache, "/biosamples/ENCBS000AAA/", RECORD)
+        cached = cache.lookup(HOST, "biosamples/ENCBS000AAA")
+        self.assertEqual((json.loads(cached.text), cached.etag, cached.fresh),
+                         (RECORD, '"v1"', True))
+        self.assertIsNone(cache.lookup(HOST, "biosamples/ENCBS000AAA", "edit"))
+        self.assertIsNone(cache.lookup("other.host", "biosamples/ENCBS000AAA"))
+        cache.ttl = 0
+        self.assertFalse(cache.lookup(HOST, "biosamples/ENCBS000AAA").fresh)
+        cache.revalidated(HOST, "biosamples/ENCBS000AAA")
+        cache.ttl = 300
+        self.assertTrue(cache.lookup(HOST, "biosamples/ENCBS000AAA").fresh)
+
+    def test_size_bound(self):
+        """
+        Tests that the least recently used records are dropped to stay within `max_bytes`, and
+        that a record larger than that isn't cached.
+        """
+        size = len(json.dumps(RECORD))
+        cache = eurc.RecordCache(max_bytes=2 * size, ttl=300, cache_dir="")
+        self._store(cache, "a", RECORD)
+        self._store(cache, "b", RECORD)
+        cache.lookup(HOST, "a")
+        self._store(cache, "c", RECORD)
+        self.assertIsNotNone(cache.lookup(HOST, "a"))
+        self.assertIsNone(cache.lookup(HOST, "b"))
+        self.assertEqual(cache.size, 2 * size)
+        self._store(cache, "d", dict(RECORD, description="x" * 2 * size))
+        self.assertIsNone(cache.lookup(HOST, "d"))
+
+    def test_invalidate_by_any_identifier(self):
+        """
+        Tests that invalidating a record by one of its identifiers drops all its frames, however
+        they were looked up.
+        """
+        cache = eurc.RecordCache(max_bytes=1024 * 1024, ttl=300, cache_dir="")
+        self._store(cache, "lab:s", RECORD)
+        self._store(cache, "ENCBS000AAA", RECORD, frame="edit")
+        self._store(cache, "ENCBS111BBB", dict(RECORD, accession="ENCBS111BBB", aliases=[],
+                                               **{"@id": "/biosamples/ENCBS111BBB/"}))
+        cache.invalidate(HOST, ["/biosamples/ENCBS000AAA/"])
+        self.assertIsNone(cache.lookup(HOST, "lab:s"))
+        self.assertIsNone(cache.lookup(HOST, "ENCBS000AAA", "edit"))
+        self.assertIsNotNone(cache.lookup(HOST, "ENCBS111BBB"))
+        self.assertEqual(len(cache), 1)
+
+    def test_directory(self):
+        """
+        Tests that records written to the directory are read back by another cache, to be
+        revalidated, and are removed upon invalidation.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self._store(eurc.RecordCache(ttl=300, cache_dir=cache_dir), "lab:s", RECORD)
+            cache = eurc.RecordCache(ttl=300, cache_dir=cache_dir)
+            cached = cache.lookup(HOST, "lab:s")
+            self.assertEqual((json.loads(cached.text), cached.fresh), (RECORD, False))
+            cache.invalidate(HOST, ["ENCBS000AAA"])
+            self.assertIsNone(eurc.RecordCache(ttl=300, cache_dir=cache_dir).lookup(HOST, "lab:s"))
+
+    def test_disabled(self):
+        """
+        Tests that there is no shared cache when ``encode_utils.RECORD_CACHE_MAX_BYTES`` is 0.
+        """
+        with mock.patch.object(eu, "RECORD_CACHE_MAX_BYTES", 0):
+            self.assertIsNone(eurc.get_record_cache())
+
+
+class TestStoreGeneration(unittest.TestCase):
+    """
+    Tests that ``encode_utils.record_cache.RecordCache.store()`` refuses the copies of records
+    that were invalidated while they were GOTTEN.
+    """
+
+    def setUp(self):
+        self.cache = eurc.RecordCache(max_bytes=1024 * 1024, ttl=300, cache_dir="")
+
+    def _store(self, generation):
+        self.cache.store(HOST, "lab:s", "edit", json.dumps(RECORD), '"etag"', RECORD, generation)
+
+    def test_store_without_invalidation(self):
+        """
+        Tests that a copy is cached when nothing was invalidated meanwhile.
+        """
+        self._store(self.cache.get_generation())
+        self.assertIsNotNone(self.cache.lookup(HOST, "lab:s", "edit"))
+
+    def test_store_after_invalidation(self):
+        """
+        Tests that a copy fetched before an invalidation of its record, by another of its
+        identifiers, isn't cached.
+        """
+        generation = self.cache.get_generation()
+        self.cache.invalidate(HOST, ["ENCBS000AAA"])
+        self._store(generation)
+        self.assertIsNone(self.cache.lookup(HOST, "lab:s", "edit"))
+
+    def test_store_after_other_invalidation(self):
+        """
+        Tests that the invalidation of another record doesn't prevent caching.
+        """
+        generation = self.cache.get_generation()
+        self.cache.invalidate(HOST, ["ENCBS999ZZZ"])
+        self._store(generation)
+        self.assertIsNotNone(self.cache.lookup(HOST, "lab:s", "edit"))
+
+    def test_store_after_forgotten_invalidation(self):
+        """
+        Tests that copies fetched before the oldest invalidation forgotten are refused.
+        """
+        generation = self.cache.get_generation()
+        with mock.patch.object(eurc, "MAX_INVALIDATIONS", 2):
+            for rec_id in ["ENCBS000AAA", "ENCBS111BBB", "ENCBS222CCC"]:
+                self.cache.invalidate(HOST, [rec_id])
+        self._store(generation)
+        self.assertIsNone(self.cache.lookup(HOST, "lab:s", "edit"))
+
+
+if __name__ == "__main__":
+    unittest.main()
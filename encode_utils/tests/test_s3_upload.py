@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.s3_upload`` module against an S3 mocked by `moto`.
+"""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+
+import encode_utils.s3_upload as eus3
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "encode-files"
+UPLOAD_URL = "s3://{}/2024/01/01/ENCFF000AAA.fastq.gz".format(BUCKET)
+CREDENTIALS = {"access_key": "testing", "secret_key": "testing", "session_token": "testing"}
+PART_SIZE = eus3.MIN_PART_SIZE
+
+
+class TestS3Upload(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.s3_upload.S3Upload``.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.state_dir = os.path.join(tmp_dir.name, "uploads")
+        self.file_path = os.path.join(tmp_dir.name, "reads.fastq.gz")
+        # Three parts, the last one short.
+        self.content = os.urandom(2 * PART_SIZE + 1024)
+        with open(self.file_path, "wb") as fh:
+            fh.write(self.content)
+        patchers = [moto.mock_aws(), mock.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "us-east-1"}),
+                    mock.patch.object(eus3.time, "sleep")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = eus3.get_s3_client(CREDENTIALS, endpoint_url="")
+        self.client.create_bucket(Bucket=BUCKET)
+
+    def _upload(self, part_size=PART_SIZE, **kwargs):
+        upload = eus3.S3Upload(self.file_path, UPLOAD_URL, CREDENTIALS, part_size=part_size,
+                               state_dir=self.state_dir, endpoint_url="", **kwargs)
+        # Same client as the test's, so that the calls can be counted and failed.
+        upload.client = self.client
+        return upload
+
+    def _uploaded_content(self):
+        bucket, key = eus3.parse_s3_url(UPLOAD_URL)
+        return self.client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    def _fail_parts(self, part_numbers, times):
+        """
+        Makes the upload of the given parts fail the given number of times.
+
+        Returns:
+            `list`: The numbers of the parts whose upload was attempted.
+        """
+        upload_part = self.client.upload_part
+        attempts = []
+        failures = {x: times for x in part_numbers}
+
+        def failing_upload_part(**kwargs):
+            part_number = kwargs["PartNumber"]
+            attempts.append(part_number)
+            if failures.get(part_number):
+                failures[part_number] -= 1
+                raise ConnectionError("Connection reset.")
+            return upload_part(**kwargs)
+        patcher = mock.patch.object(self.client, "upload_part", side_effect=failing_upload_part)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return attempts
+
+    def test_small_file(self):
+        """
+        Tests that a file no larger than the part size is uploaded in a single request.
+        """
+        with open(self.file_path, "wb") as fh:
+            fh.write(b"ACGT\n")
+        with mock.patch.object(self.client, "create_multipart_upload") as create:
+            self._upload().run()
+        create.assert_not_called()
+        self.assertEqual(self._uploaded_content(), b"ACGT\n")
+
+    def test_multipart(self):
+        """
+        Tests that a larger file is uploaded in parts, and that the state file is removed once
+        it's done.
+        """
+        attempts = self._fail_parts([], 0)
+        upload = self._upload(max_concurrency=3)
+        upload.run()
+        self.assertEqual(sorted(attempts), [1, 2, 3])
+        self.assertEqual(hashlib.md5(self._uploaded_content()).hexdigest(),
+                         hashlib.md5(self.content).hexdigest())
+        self.assertFalse(os.path.exists(upload.state_path))
+
+    def test_part_is_retried(self):
+        """
+        Tests that a part that fails is retried on its own.
+        """
+        attempts = self._fail_parts([2], 2)
+        self._upload(retries=3).run()
+        self.assertEqual(sorted(attempts), [1, 2, 2, 2, 3])
+        self.assertEqual(self._uploaded_content(), self.content)
+
+    def test_resume(self):
+        """
+        Tests that an upload interrupted by a part that failed for good is resumed by sending the
+        missing parts only.
+        """
+        attempts = self._fail_parts([2], 1)
+        with self.assertRaises(ConnectionError):
+            self._upload(retries=0, max_concurrency=1).run()
+        self.assertEqual(attempts, [1, 2, 3])
+        del attempts[:]
+        self._upload(retries=0).run()
+        self.assertEqual(attempts, [2])
+        self.assertEqual(self._uploaded_content(), self.content)
+
+    def test_no_resume_with_another_part_size(self):
+        """
+        Tests that an interrupted upload isn't resumed with another part size, whose parts
+        wouldn't line up with those already sent.
+        """
+        attempts = self._fail_parts([2], 1)
+        with self.assertRaises(ConnectionError):
+            self._upload(retries=0, max_concurrency=1).run()
+        del attempts[:]
+        self._upload(part_size=PART_SIZE + 1024, retries=0).run()
+        self.assertEqual(sorted(attempts), [1, 2])
+        self.assertEqual(self._uploaded_content(), self.content)
+
+
+class TestUploadPipeline(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.s3_upload.UploadPipeline``.
+    """
+
+    def test_failures_are_reported(self):
+        """
+        Tests that the uploads run in the background, and that those that failed are returned by
+        ``close()`` with their label.
+        """
+        def run(upload):
+            if upload.file_path == "bad":
+                raise ValueError("Refused.")
+
+        with mock.patch.object(eus3.S3Upload, "__init__", lambda self, file_path, *args: setattr(
+                self, "file_path", file_path)), mock.patch.object(eus3.S3Upload, "run", run):
+            pipeline = eus3.UploadPipeline(max_uploads=2)
+            for i, file_path in enumerate(["good", "bad", "good"]):
+                pipeline.submit(file_path, UPLOAD_URL, CREDENTIALS, label=i + 2)
+            failures = pipeline.close()
+        self.assertEqual([(label, type(error)) for label, error in failures], [(3, ValueError)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.sessions`` module.
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import encode_utils as eu
+import encode_utils.mock_portal as eumock
+import encode_utils.sessions as eusessions
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        # Start each test without a shared session, and leave the one of the package alone.
+        for name in ["_session", "_pool_size"]:
+            patcher = mock.patch.object(eusessions, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(eusessions.close_session)
+
+    def test_create_session(self):
+        """The session has the default headers, the pool size and the retry policy."""
+        session = eusessions.create_session(pool_size=7, retries=2)
+        self.assertEqual(session.headers["Accept-Encoding"], "gzip, deflate")
+        for prefix in ["http://", "https://"]:
+            adapter = session.get_adapter(prefix + "portal.example.org")
+            self.assertEqual(adapter._pool_maxsize, 7)
+            self.assertEqual(adapter.max_retries.total, 2)
+            self.assertIn(429, adapter.max_retries.status_forcelist)
+            self.assertNotIn("POST", adapter.max_retries.allowed_methods)
+
+    def test_get_session_is_shared(self):
+        """Threads asking for the session at once all get the same one."""
+        barrier = threading.Barrier(8)
+        sessions = []
+
+        def get():
+            barrier.wait()
+            sessions.append(eusessions.get_session())
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, sessions))), 1)
+        self.assertIs(eusessions.get_session(), sessions[0])
+
+    def test_set_pool_size(self):
+        """
+        Growing the pool replaces the shared session, while sizes below the default leave it be.
+        """
+        session = eusessions.get_session()
+        eusessions.set_pool_size(1)
+        self.assertIs(eusessions.get_session(), session)
+        eusessions.set_pool_size(eu.HTTP_POOL_SIZE + 5)
+        grown = eusessions.get_session()
+        self.assertIsNot(grown, session)
+        self.assertEqual(grown.get_adapter("https://x")._pool_maxsize, eu.HTTP_POOL_SIZE + 5)
+        eusessions.set_pool_size(eu.HTTP_POOL_SIZE + 5)
+        self.assertIs(eusessions.get_session(), grown)
+
+    def test_keep_alive(self):
+        """Consecutive requests to the Portal reuse one pooled connection."""
+        with eumock.MockPortal() as portal:
+            session = eusessions.get_session()
+            for _ in range(3):
+                response = session.get(portal.url + "/profiles/?format=json", timeout=10)
+                self.assertEqual(response.status_code, 200)
+            pools = session.get_adapter(portal.url).poolmanager.pools
+            self.assertEqual([(pools[key].num_connections, pools[key].num_requests)
+                              for key in pools.keys()], [(1, 3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests the ``encode_utils.throttle`` module.
+"""
+
+import io
+import unittest
+from unittest import mock
+
+import requests
+
+import encode_utils.logs as eulogs
+import encode_utils.throttle as euthrottle
+
+
+def setUpModule():
+    # Log to a buffer rather than to STDOUT, which the test runner closes before the queued log
+    # records are flushed at exit.
+    eulogs.configure_logging(stream=io.StringIO())
+
+
+def _http_error(status, retry_after=None):
+    """
+    Returns:
+        `requests.HTTPError`: An error like those raised by ``encode_utils.connection.Connection``.
+    """
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return requests.HTTPError(response=response)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.throttle.TokenBucket``.
+    """
+
+    def test_rate(self):
+        """
+        Tests that a burst is sent at once, and that the requests past it are spaced by the rate.
+        """
+        with mock.patch.object(euthrottle.time, "monotonic", return_value=100.0):
+            bucket = euthrottle.TokenBucket(rate=2, burst=2)
+            delays = [bucket.reserve() for _ in range(4)]
+        self.assertEqual(delays, [0.0, 0.0, 0.5, 1.0])
+
+    def test_pause(self):
+        """
+        Tests that a pause holds back the requests even without a rate limit.
+        """
+        with mock.patch.object(euthrottle.time, "monotonic", return_value=100.0):
+            bucket = euthrottle.TokenBucket(rate=0)
+            self.assertEqual(bucket.reserve(), 0.0)
+            bucket.pause(3)
+            self.assertEqual(bucket.reserve(), 3.0)
+
+    def test_parse_retry_after(self):
+        """
+        Tests that `Retry-After` is read as a number of seconds or as an HTTP date.
+        """
+        self.assertEqual(euthrottle.parse_retry_after("2.5"), 2.5)
+        self.assertIsNone(euthrottle.parse_retry_after(""))
+        self.assertIsNone(euthrottle.parse_retry_after("soon"))
+        with mock.patch.object(euthrottle.time, "time", return_value=784111767.0):
+            self.assertEqual(
+                euthrottle.parse_retry_after("Sun, 06 Nov 1994 08:49:37 GMT"), 10.0)
+
+
+class TestAimdController(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.throttle.AimdController``.
+    """
+
+    def _release(self, controller, latency, overloaded=False):
+        controller.acquire()
+        controller.release(latency, overloaded)
+
+    def test_slow_start_then_halving(self):
+        """
+        Tests that the limit grows by one per request up to the maximum, and is halved once per
+        round trip upon overload.
+        """
+        controller = euthrottle.AimdController(10, latency_target=1.0)
+        self.assertEqual(controller.limit, euthrottle.INITIAL_CONCURRENCY)
+        for _ in range(10):
+            self._release(controller, 0.1)
+        self.assertEqual(controller.limit, 10)
+        self._release(controller, 0.1, overloaded=True)
+        self._release(controller, 0.1, overloaded=True)
+        self.assertEqual(controller.limit, 5)
+        # Out of the slow start, the limit grows by about one per round trip.
+        for _ in range(6):
+            self._release(controller, 0.1)
+        self.assertEqual(controller.limit, 6)
+
+    def test_latency(self):
+        """
+        Tests that the limit is halved when the latency rises above the target, unless
+        `adapt_to_latency` is `False`.
+        """
+        for adapt_to_latency, limit in [(True, 2), (False, 5)]:
+            controller = euthrottle.AimdController(
+                10, latency_target=1.0, adapt_to_latency=adapt_to_latency)
+            self._release(controller, 10.0)
+            self.assertEqual(controller.limit, limit)
+
+
+class TestCall(unittest.TestCase):
+    """
+    Tests the method ``encode_utils.throttle.Throttle.call()``.
+    """
+
+    def setUp(self):
+        self.throttle = euthrottle.Throttle("call.test.host", 4, rate=0, retries=2)
+        patcher = mock.patch.object(euthrottle.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_429(self):
+        """
+        Tests that a POST rejected with a 429 is retried after the `Retry-After` delay.
+        """
+        func = mock.Mock(side_effect=[_http_error(429, "1"), {"ok": True}])
+        self.assertEqual(self.throttle.call(func, method="POST"), {"ok": True})
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(self.sleep.call_args_list[0], mock.call(1.0))
+
+    def test_gives_up(self):
+        """
+        Tests that the error is raised once the retries are used up, or right away when the
+        request isn't to be retried.
+        """
+        func = mock.Mock(side_effect=_http_error(429))
+        with self.assertRaises(requests.HTTPError):
+            self.throttle.call(func, method="POST")
+        self.assertEqual(func.call_count, 3)
+        func = mock.Mock(side_effect=_http_error(503))
+        with self.assertRaises(requests.HTTPError):
+            self.throttle.call(func, method="POST")
+        self.assertEqual(func.call_count, 1)
+
+    def test_other_errors_not_retried(self):
+        """
+        Tests that errors that aren't failures of the request are raised right away, and give
+        back their slot.
+        """
+        func = mock.Mock(side_effect=ValueError("invalid payload"))
+        with self.assertRaises(ValueError):
+            self.throttle.call(func, method="GET")
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.throttle.controller.in_flight, 0)
+
+
+class TestGetRetryDelay(unittest.TestCase):
+    """
+    Tests the method ``encode_utils.throttle.Throttle.get_retry_delay()``.
+    """
+
+    def setUp(self):
+        self.throttle = euthrottle.Throttle("test.host", 4)
+
+    def _is_retried(self, method, status):
+        return self.throttle.get_retry_delay(method, 0, status) is not None
+
+    def test_non_idempotent_retried_on_429_only(self):
+        """
+        Tests that POSTS and PATCHES are retried upon a 429, but not upon a 503, which a proxy may
+        return after the record was written, nor upon other failures.
+        """
+        for method in ["POST", "PATCH"]:
+            self.assertTrue(self._is_retried(method, 429))
+            for status in [500, 502, 503, 504, None]:
+                self.assertFalse(self._is_retried(method, status), (method, status))
+
+    def test_idempotent_retried_on_overload(self):
+        """
+        Tests that GETS are retried upon the overload statuses and upon failing to connect.
+        """
+        for status in [429, 502, 503, 504, None]:
+            self.assertTrue(self._is_retried("GET", status), status)
+        self.assertFalse(self._is_retried("GET", 500))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Tests functions in the ``encode_utils.utils`` module.
+"""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import encode_utils.utils as euu
+
+
+class TestMd5Cache(unittest.TestCase):
+    """
+    Tests the class ``encode_utils.utils.Md5Cache`` and the function ``get_md5sum()``.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.cache_path = os.path.join(self.tmp_dir, "md5sums.jsonl")
+
+    def _write_file(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as fh:
+            fh.write(content)
+        return path
+
+    def _num_lines(self):
+        with open(self.cache_path) as fh:
+            return len(fh.readlines())
+
+    def test_calculate_md5sum(self):
+        """
+        Tests that the md5sum is that of hashlib, for a file larger than the read buffer.
+        """
+        content = os.urandom(1000)
+        path = self._write_file("reads.fastq", content)
+        with mock.patch.object(euu, "MD5_BUFFER_SIZE", 64):
+            self.assertEqual(euu.calculate_md5sum(path), hashlib.md5(content).hexdigest())
+
+    def test_unchanged_file_isnt_hashed_again(self):
+        """
+        Tests that the md5sum of an unchanged file is taken from the cache, across instances, and
+        that a changed file is hashed again.
+        """
+        path = self._write_file("reads.fastq", b"ACGT\n")
+        md5sum = euu.get_md5sum(path, cache=euu.Md5Cache(self.cache_path))
+        self.assertEqual(md5sum, hashlib.md5(b"ACGT\n").hexdigest())
+        with mock.patch.object(euu, "calculate_md5sum") as calculate_md5sum:
+            self.assertEqual(euu.get_md5sum(path, cache=euu.Md5Cache(self.cache_path)), md5sum)
+        calculate_md5sum.assert_not_called()
+        self._write_file("reads.fastq", b"ACGTACGT\n")
+        self.assertEqual(euu.get_md5sum(path, cache=euu.Md5Cache(self.cache_path)),
+                         hashlib.md5(b"ACGTACGT\n").hexdigest())
+
+    def test_superseded_lines_are_compacted(self):
+        """
+        Tests that the cache file is rewritten once most of its lines are superseded, keeping the
+        latest md5sum of each key.
+        """
+        cache = euu.Md5Cache(self.cache_path)
+        key = ("/data/reads.fastq", 5, 1, 1)
+        for i in range(10):
+            cache.set(key, "md5-{}".format(i))
+            self.assertLessEqual(self._num_lines(), 2)
+        self.assertEqual(euu.Md5Cache(self.cache_path).get(key), "md5-9")
+
+    def test_oldest_entries_are_dropped(self):
+        """
+        Tests that only the newest `max_entries` md5sums are kept.
+        """
+        cache = euu.Md5Cache(self.cache_path, max_entries=3)
+        keys = [("/data/{}.fastq".format(i), 5, 1, i) for i in range(5)]
+        for key in keys:
+            cache.set(key, key[0])
+        cache.set(keys[1], "newer")
+        self.assertLessEqual(self._num_lines(), 6)
+        cache = euu.Md5Cache(self.cache_path, max_entries=3)
+        self.assertEqual([cache.get(x) for x in keys], [None, "newer", None, keys[3][0], keys[4][0]])
+        self.assertEqual(self._num_lines(), 3)
+
+    def test_torn_line_is_skipped(self):
+        """
+        Tests that a torn last line is skipped when loading the cache.
+        """
+        cache = euu.Md5Cache(self.cache_path)
+        cache.set(("/data/reads.fastq", 5, 1, 1), "abc")
+        with open(self.cache_path, "a") as fh:
+            fh.write('{"key": ["/data/')
+        self.assertEqual(euu.Md5Cache(self.cache_path).get(("/data/reads.fastq", 5, 1, 1)), "abc")
+
+
+if __name__ == "__main__":
+    unittest.main()
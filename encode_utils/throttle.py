@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+###
+# © 2018 The Board of Trustees of the Leland Stanford Junior University
+# Nathaniel Watson
+# nathankw@stanford.edu
+###
+
+"""
+Paces the requests sent to the Portal, so that a large run goes as fast as the Portal allows
+without overloading it:
+
+* A ``TokenBucket`` per host caps the rate of the requests (see ``encode_utils.RATE_LIMIT``), and
+  holds all of them back for as long as the Portal asks to with a `Retry-After` header.
+* An ``AimdController`` adapts the number of requests in flight: it grows by one per round trip
+  as long as the Portal keeps up (after doubling per round trip at first, as in TCP slow start),
+  and is halved when the Portal answers with an overload status (``OVERLOAD_STATUSES``), when a
+  request fails to connect, or when the latency climbs above a target.
+* Requests that were rejected for overload are retried after a jittered exponential backoff, or
+  after the delay given by the `Retry-After` header. POSTS and PATCHES are only retried upon a 429
+  (see ``RETRY_STATUSES``).
+
+A ``Throttle`` ties these together for one connection, for threads as well as for asyncio code.
+"""
+
+import asyncio
+import collections
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import encode_utils as eu
+import encode_utils.metrics as eumetrics
+
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
+
+#: The statuses by which the Portal, or a proxy in front of it, signals that it's overloaded.
+OVERLOAD_STATUSES = (429, 502, 503, 504)
+
+#: The statuses of the requests that are retried whatever their method, since the Portal rejected
+#: them without acting upon them. Not 503, which a proxy may return after the Portal wrote the
+#: record, so that a POST retried upon it could create a duplicate. Requests with idempotent
+#: methods are retried upon any of the ``OVERLOAD_STATUSES``, or upon failing to connect.
+RETRY_STATUSES = (429,)
+
+#: The methods of the requests that can be retried upon any failure.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+#: The delay in seconds before the first retry of a request. Each retry waits up to twice as
+#: long as the prior one, picked at random ("full jitter").
+BACKOFF_BASE = 0.5
+
+#: The longest delay in seconds before a retry.
+BACKOFF_MAX = 60.0
+
+#: The number of requests in flight at the start, before the slow start.
+INITIAL_CONCURRENCY = 4
+
+#: The factor by which the number of requests in flight is multiplied upon overload.
+DECREASE_FACTOR = 0.5
+
+#: Without an explicit latency target, the latency is deemed too high once its moving average
+#: exceeds this many times the lowest moving average seen.
+LATENCY_TOLERANCE = 3.0
+
+#: The weight of the latest latency in the moving average.
+LATENCY_ALPHA = 0.2
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Args:
+        attempt: `int`. The number of retries made so far.
+        base: `float`. See ``BACKOFF_BASE``.
+        maximum: `float`. See ``BACKOFF_MAX``.
+
+    Returns:
+        `float`: A random delay in seconds between 0 and ``base * 2 ** attempt``, capped at
+        `maximum`.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """
+    Args:
+        value: `str`. The value of a `Retry-After` header: a number of seconds, or an HTTP date.
+
+    Returns:
+        `float`: The number of seconds to wait, or `None` if `value` is empty or can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, holding up to `burst` tokens and refilled at `rate` tokens per
+    second. Each request takes a token, and waits for one when the bucket is empty.
+
+    Args:
+        rate: `float`. The number of requests per second. 0 means no limit.
+        burst: `int`. The number of requests that may be sent at once after a pause. Defaults to
+          one second's worth.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, which may only become available in the future.
+
+        Returns:
+            `float`: The number of seconds to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            pause = max(self._paused_until - now, 0.0)
+            if not self.rate:
+                return pause
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, pause)
+
+    def pause(self, seconds):
+        """
+        Holds back all requests for a number of seconds, i.e. as asked by a `Retry-After` header.
+
+        Args:
+            seconds: `float`. The length of the pause.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(host, rate=None, burst=None):
+    """
+    Returns the token bucket of a host, which is shared by all the connections to it. The rate
+    given when the bucket is first created is kept.
+
+    Args:
+        host: `str`. The host name.
+        rate: `float`. See ``TokenBucket``. Defaults to ``encode_utils.RATE_LIMIT``.
+        burst: `int`. See ``TokenBucket``.
+
+    Returns:
+        ``TokenBucket``: The bucket.
+    """
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(eu.RATE_LIMIT if rate is None else rate, burst)
+        return _buckets[host]
+
+
+class AimdController:
+    """
+    Adapts the number of requests in flight with additive increase and multiplicative decrease
+    (AIMD). Requests take a slot with ``acquire()`` (or ``acquire_async()``) and give it back with
+    ``release()``, telling whether the Portal was overloaded. At most one decrease is made per
+    round trip, so that the requests that were in flight at the time of an overload don't each
+    halve the limit.
+
+    Args:
+        max_limit: `int`. The largest number of requests in flight, i.e. the number of workers.
+        min_limit: `int`. The smallest number of requests in flight.
+        latency_target: `float`. The latency in seconds above which the Portal is deemed overloaded.
+          Defaults to ``LATENCY_TOLERANCE`` times the lowest moving average of the latency.
+        adapt_to_latency: `bool`. `False` means to only adapt to overload statuses and failures to
+          connect, i.e. when the latency of the requests depends on their size.
+    """
+
+    def __init__(self, max_limit, min_limit=1, latency_target=None, adapt_to_latency=True):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = min(max(min_limit, 1), self.max_limit)
+        self.latency_target = latency_target
+        self.adapt_to_latency = adapt_to_latency
+        self._limit = float(max(min(INITIAL_CONCURRENCY, self.max_limit), self.min_limit))
+        self._slow_start = True
+        self._in_flight = 0
+        self._latency = None
+        self._min_latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = collections.deque()
+
+    @property
+    def limit(self):
+        """`int`: The current number of requests that may be in flight."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """`int`: The number of requests in flight."""
+        return self._in_flight
+
+    def _try_acquire(self):
+        if self._in_flight < int(self._limit):
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        """Waits for a slot, from a thread."""
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        """Waits for a slot, from asyncio code."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency, overloaded=False):
+        """
+        Gives back a slot, and adapts the limit.
+
+        Args:
+            latency: `float`. The latency of the request in seconds.
+            overloaded: `bool`. `True` if the Portal signaled an overload, or if the request
+              failed to connect.
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self._update(latency, overloaded)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, collections.deque()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _update(self, latency, overloaded):
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_ALPHA * (latency - self._latency)
+        if self._min_latency is None or self._latency < self._min_latency:
+            self._min_latency = self._latency
+        target = self.latency_target or LATENCY_TOLERANCE * self._min_latency
+        if overloaded or (self.adapt_to_latency and self._latency > target):
+            now = time.monotonic()
+            if now - self._last_decrease >= self._latency:
+                self._last_decrease = now
+                self._slow_start = False
+                old = self.limit
+                self._limit = max(self.min_limit, self._limit * DECREASE_FACTOR)
+                if self.limit != old:
+                    DEBUG_LOGGER.debug("{}: in-flight requests limited to {}.".format(
+                        "Overload" if overloaded else "High latency", self.limit))
+        elif self._slow_start:
+            self._limit = min(self.max_limit, self._limit + 1)
+        else:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Throttle:
+    """
+    Paces the requests of a connection to a host: each request waits for a token of the host's
+    ``TokenBucket`` and for a slot of an ``AimdController``, and requests rejected for overload
+    are retried.
+
+    Args:
+        host: `str`. The host name of the Portal.
+        max_concurrency: `int`. The largest number of requests in flight.
+        rate: `float`. The largest number of requests per second to the host. Defaults to
+          ``encode_utils.RATE_LIMIT``.
+        latency_target: `float`. See ``AimdController``.
+        adapt_to_latency: `bool`. See ``AimdController``.
+        retries: `int`. The number of retries of a request. Defaults to
+          ``encode_utils.HTTP_RETRIES``.
+    """
+
+    def __init__(self, host, max_concurrency, rate=None, latency_target=None,
+                 adapt_to_latency=True, retries=None):
+        self.host = host
+        self.bucket = get_bucket(host, rate)
+        self.controller = AimdController(max_concurrency, latency_target=latency_target,
+                                         adapt_to_latency=adapt_to_latency)
+        self.retries = eu.HTTP_RETRIES if retries is None else retries
+
+    def acquire(self):
+        """Waits until a request may be sent, from a thread."""
+        delay = self.bucket.reserve()
+        if delay:
+            time.sleep(delay)
+        self.controller.acquire()
+
+    async def acquire_async(self):
+        """Waits until a request may be sent, from asyncio code."""
+        delay = self.bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        await self.controller.acquire_async()
+
+    def release(self, latency, status=None, failed=False):
+        """
+        Records the outcome of a request sent after ``acquire()``.
+
+        Args:
+            latency: `float`. The latency of the request in seconds.
+            status: `int`. The HTTP status of the response, if any.
+            failed: `bool`. `True` if the request failed without a response, i.e. to connect.
+        """
+        self.controller.release(latency, overloaded=failed or status in OVERLOAD_STATUSES)
+
+    def get_retry_delay(self, method, attempt, status=None, retry_after=None):
+        """
+        Determines whether a request is to be retried, and when.
+
+        Args:
+            method: `str`. The HTTP method of the request.
+            attempt: `int`. The number of retries made so far.
+            status: `int`. The HTTP status of the response, or `None` if the request failed without
+              a response.
+            retry_after: `str`. The value of the `Retry-After` header of the response, if any.
+              All the requests to the host are held back for that long.
+
+        Returns:
+            `float`: The number of seconds to wait before retrying, or `None` to not retry.
+        """
+        if attempt >= self.retries:
+            return None
+        if status not in RETRY_STATUSES and not (
+                method.upper() in IDEMPOTENT_METHODS
+                and (status is None or status in OVERLOAD_STATUSES)):
+            return None
+        eumetrics.METRICS.inc("retries", status=status or "error")
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            self.bucket.pause(delay)
+            return delay
+        return backoff_delay(attempt)
+
+    def call(self, func, method="POST", get_status=None):
+        """
+        Calls a function that sends a request, from a thread, pacing and retrying it. Exceptions
+        that carry no response and aren't an `OSError` (which includes the connection errors and
+        timeouts of `requests`) aren't failures of the request, and are raised right away.
+
+        Args:
+            func: A function taking no argument that sends a request. It may be called more than
+              once.
+            method: `str`. The HTTP method of the request.
+            get_status: A function that is given the exception raised by `func`, and returns the
+              HTTP status and the `Retry-After` header of the failed response, or `None` twice if
+              the request failed without a response. Defaults to ``get_exception_status()``.
+
+        Returns:
+            The return value of `func`.
+        """
+        get_status = get_status or get_exception_status
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                status, retry_after = get_status(e)
+                if status is None and not isinstance(e, OSError):
+                    # I.e. an invalid payload.
+                    self.release(time.perf_counter() - start)
+                    raise
+                self.release(time.perf_counter() - start, status, failed=status is None)
+                delay = self.get_retry_delay(method, attempt, status, retry_after)
+                if delay is None:
+                    raise
+                DEBUG_LOGGER.debug("{} request failed with {}; retrying in {:.1f}s.".format(
+                    method, status or type(e).__name__, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.release(time.perf_counter() - start)
+            return result
+
+
+def get_exception_status(error):
+    """
+    Args:
+        error: `Exception`. An exception raised while sending a request, i.e. a
+          `requests.exceptions.HTTPError`.
+
+    Returns:
+        `tuple`: The HTTP status and the `Retry-After` header of the response attached to the
+        exception, or `None` twice if there is none.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None, None
+    status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    return status, response.headers.get("Retry-After")
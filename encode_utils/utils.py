@@ -10,8 +10,219 @@
 Contains utilities that don't require authorization on the DCC servers.
 """
 
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
 import encode_utils as eu
+import encode_utils.metrics as eumetrics
+
+#: A debug ``logging`` instance.
+DEBUG_LOGGER = logging.getLogger(eu.DEBUG_LOGGER_NAME + "." + __name__)
 
 #: Stores the HTTP headers to indicate JSON content in a request.
 REQUEST_HEADERS_JSON = {'content-type': 'application/json'}
 
+#: The size in bytes of the reads done by ``calculate_md5sum()``.
+MD5_BUFFER_SIZE = 8 * 1024 * 1024
+
+#: The maximum number of md5sums kept by ``Md5Cache``. Beyond that, the oldest ones are dropped
+#: when the cache file is compacted.
+MD5_CACHE_MAX_ENTRIES = 100000
+
+
+def calculate_md5sum(file_path):
+    """
+    Calculates the md5sum of a local file. The file is read in large chunks into a reusable buffer,
+    bypassing Python's own buffering.
+
+    Args:
+        file_path: `str`. The path to a local file.
+
+    Returns:
+        `str`: The md5sum, as a hexadecimal digest.
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(MD5_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as fh:
+        while True:
+            num_bytes = fh.readinto(buf)
+            if not num_bytes:
+                break
+            md5.update(view[:num_bytes])
+    return md5.hexdigest()
+
+
+def calculate_md5sum_timed(file_path):
+    """
+    Like ``calculate_md5sum()``, but also returns how long it took. Meant to be run in another
+    process, whose own metrics would be lost, so that the caller can record the time in
+    ``encode_utils.metrics.METRICS``.
+
+    Returns:
+        `tuple`: The md5sum and the number of seconds.
+    """
+    start = time.perf_counter()
+    md5sum = calculate_md5sum(file_path)
+    return md5sum, time.perf_counter() - start
+
+
+class Md5Cache:
+    """
+    A persistent cache of the md5sums of local files, keyed on the real path, size, modification
+    time and inode of each file, so that a file is hashed again only if it changed.  The cache is
+    an append-only file with one JSON line per md5sum, which is read in full on instantiation.
+
+    The file is rewritten (compacted) once more than half of its lines are superseded, i.e. by the
+    md5sums of files that changed, or once it holds more than `max_entries` md5sums, in which case
+    only the newest `max_entries` are kept.
+
+    Args:
+        path: `str`. The path to the cache file. Defaults to ``encode_utils.MD5_CACHE_PATH``.
+        max_entries: `int`. The maximum number of md5sums kept. Defaults to
+          ``MD5_CACHE_MAX_ENTRIES``.
+    """
+
+    def __init__(self, path=None, max_entries=MD5_CACHE_MAX_ENTRIES):
+        if path is None:
+            path = eu.MD5_CACHE_PATH
+        #: The path to the cache file.
+        self.path = path
+        self.max_entries = max_entries
+        # Ordered from the oldest to the newest md5sum.
+        self._md5sums = {}
+        self._num_lines = 0
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fh:
+                for line in fh:
+                    self._num_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write.
+                    self._put(tuple(entry["key"]), entry["md5sum"])
+        except OSError:
+            pass
+        if self._needs_compaction():
+            self._compact()
+
+    def _put(self, key, md5sum):
+        # Moves the key to the end, i.e. makes it the newest.
+        self._md5sums.pop(key, None)
+        self._md5sums[key] = md5sum
+
+    def _needs_compaction(self):
+        return (self._num_lines > 2 * len(self._md5sums)
+                or len(self._md5sums) > self.max_entries)
+
+    def _compact(self):
+        """
+        Rewrites the cache file with one line per md5sum, keeping the newest ``self.max_entries``
+        ones. The new file replaces the old one atomically.
+        """
+        num_dropped = len(self._md5sums) - self.max_entries
+        if num_dropped > 0:
+            for key in list(itertools.islice(self._md5sums, num_dropped)):
+                del self._md5sums[key]
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fh:
+                for key, md5sum in self._md5sums.items():
+                    fh.write(json.dumps({"key": key, "md5sum": md5sum}) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            DEBUG_LOGGER.debug("Failed to compact the md5sum cache {}: {}".format(self.path, e))
+            return
+        self._num_lines = len(self._md5sums)
+
+    @staticmethod
+    def get_key(file_path):
+        """
+        Args:
+            file_path: `str`. The path to a local file.
+
+        Returns:
+            `tuple`: The key of the file in the cache.
+        """
+        stat = os.stat(file_path)
+        return (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def get(self, key):
+        """
+        Args:
+            key: `tuple`. The return value of ``self.get_key()``.
+
+        Returns:
+            `str`: The cached md5sum, or `None` if not cached.
+        """
+        return self._md5sums.get(key)
+
+    def set(self, key, md5sum):
+        """
+        Caches an md5sum.
+
+        Args:
+            key: `tuple`. The return value of ``self.get_key()``, taken before hashing the file.
+            md5sum: `str`. The md5sum.
+        """
+        with self._lock:
+            self._put(key, md5sum)
+            try:
+                cache_dir = os.path.dirname(self.path)
+                if cache_dir:
+                    os.makedirs(cache_dir, exist_ok=True)
+                with open(self.path, "a") as fh:
+                    fh.write(json.dumps({"key": key, "md5sum": md5sum}) + "\n")
+            except OSError as e:
+                DEBUG_LOGGER.debug("Failed to write to the md5sum cache {}: {}".format(self.path, e))
+                return
+            self._num_lines += 1
+            if self._needs_compaction():
+                self._compact()
+
+
+_md5_cache = None
+
+
+def get_md5_cache():
+    """
+    Returns:
+        ``Md5Cache``: The cache at ``encode_utils.MD5_CACHE_PATH``, or `None` if that is empty.
+    """
+    global _md5_cache
+    if not eu.MD5_CACHE_PATH:
+        return None
+    if _md5_cache is None or _md5_cache.path != eu.MD5_CACHE_PATH:
+        _md5_cache = Md5Cache()
+    return _md5_cache
+
+
+def get_md5sum(file_path, cache=None):
+    """
+    Like ``calculate_md5sum()``, but goes through a cache.
+
+    Args:
+        file_path: `str`. The path to a local file.
+        cache: ``Md5Cache``. Defaults to ``get_md5_cache()``.
+
+    Returns:
+        `str`: The md5sum, as a hexadecimal digest.
+    """
+    if cache is None:
+        cache = get_md5_cache()
+    if cache is None:
+        with eumetrics.METRICS.timer(eumetrics.OP_MD5):
+            return calculate_md5sum(file_path)
+    key = cache.get_key(file_path)
+    md5sum = cache.get(key)
+    if md5sum is None:
+        with eumetrics.METRICS.timer(eumetrics.OP_MD5):
+            md5sum = calculate_md5sum(file_path)
+        cache.set(key, md5sum)
+    return md5sum
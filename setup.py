@@ -32,6 +32,10 @@ setup(
     "awscli",
     "requests",
     "urllib3"],
+  extras_require = {
+    "async": ["aiohttp"],
+    "parquet": ["pyarrow"],
+    "zstd": ["zstandard"]},
   scripts = scripts,
   package_data = {"encode_utils": ["tests/data/*"]}
 )